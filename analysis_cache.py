@@ -0,0 +1,94 @@
+"""Caché en disco de análisis clínicos, direccionada por el contenido de la solicitud."""
+import hashlib
+import json
+import os
+import threading
+import time
+from functools import lru_cache
+
+ANALYSIS_CACHE_DIR = os.environ.get(
+    "SUGOS_ANALYSIS_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "analyses")
+)
+ANALYSIS_CACHE_MAX_BYTES = 200 * 1024 * 1024  # Tamaño total en disco antes de desalojar los menos usados
+
+@lru_cache(maxsize=8)
+def prompt_template_version(prompt_instructions_template):
+    """Versión del prompt: cambia automáticamente cuando cambia el texto de la plantilla."""
+    return hashlib.sha256(prompt_instructions_template.encode("utf-8")).hexdigest()[:12]
+
+class AnalysisCache:
+    """Análisis generados, guardados como <hash>.json y desalojados por LRU (fecha de último uso)."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def key(self, payload_json, model_name, prompt_instructions_template):
+        """Hash del payload compactado, el modelo y la versión del prompt."""
+        digest = hashlib.sha256()
+        for part in (model_name, prompt_template_version(prompt_instructions_template), payload_json):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Devuelve el texto del análisis cacheado o None."""
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(path) # Marca de último uso para el desalojo LRU
+            return entry["text"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, key, text, model_name):
+        """Guarda un análisis y desaloja los menos usados si se supera el límite."""
+        entry = {"text": text, "model": model_name, "created_at": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+            self._evict()
+
+    def stats(self):
+        """Devuelve (número de análisis, bytes en disco)."""
+        entries = self._entries()
+        return len(entries), sum(size for _, size, _ in entries)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _entries(self):
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((name, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total_bytes = sum(size for _, size, _ in entries)
+        for name, size, _ in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                total_bytes -= size
+            except OSError:
+                pass
+
+analysis_cache = AnalysisCache(ANALYSIS_CACHE_DIR, ANALYSIS_CACHE_MAX_BYTES)
@@ -0,0 +1,164 @@
+"""Cola de análisis en segundo plano, compartida por todas las sesiones de Streamlit del proceso."""
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from concurrency_limits import bind_session
+from ui_messages import call_collecting_messages
+
+ANALYSIS_WORKERS = int(os.environ.get("SUGOS_ANALYSIS_WORKERS", "2"))  # Análisis generados con Gemini a la vez
+JOB_HISTORY = 100       # Trabajos terminados que se conservan con su resultado
+WAIT_HISTORY = 20       # Esperas recientes usadas para el promedio de la cola
+
+class AnalysisCancelled(Exception):
+    """El trabajo se canceló; lo lanzan add_chunk y add_section para cortar la generación."""
+
+class AnalysisJob:
+    """Un análisis encolado: estado, progreso (texto o secciones recibidas), resultado y mensajes."""
+
+    def __init__(self, job_id, label):
+        self.id = job_id
+        self.label = label
+        self.status = "queued"  # queued, running, done, error o cancelled
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.first_output_at = None
+        self.text = ""          # Fragmentos recibidos en streaming
+        self.sections = None    # Secciones terminadas en la generación por secciones
+        self.result = None
+        self.messages = []
+        self.stats = {}
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """Pide detener el trabajo: el próximo fragmento o sección lanza AnalysisCancelled."""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def add_chunk(self, chunk_text):
+        """on_chunk de generate_clinical_analysis_with_llm."""
+        if self.cancelled:
+            raise AnalysisCancelled(self.id)
+        if self.first_output_at is None:
+            self.first_output_at = time.time()
+        self.text += chunk_text
+
+    def add_section(self, index, section_count, section_text):
+        """on_section de generate_clinical_analysis_with_llm."""
+        if self.cancelled:
+            raise AnalysisCancelled(self.id)
+        if self.first_output_at is None:
+            self.first_output_at = time.time()
+        if self.sections is None:
+            self.sections = [None] * section_count
+        self.sections[index] = section_text
+
+    @property
+    def finished(self):
+        return self.status in ("done", "error", "cancelled")
+
+    def wait_seconds(self):
+        """Tiempo en cola (hasta ahora si aún no empezó)."""
+        return (self.started_at or time.time()) - self.submitted_at
+
+    def run_seconds(self):
+        """Tiempo de ejecución (hasta ahora si aún no terminó); 0 si no empezó."""
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+class AnalysisJobQueue:
+    """Ejecuta los trabajos con a lo sumo max_workers hilos y guarda los últimos resultados."""
+
+    def __init__(self, max_workers, history=JOB_HISTORY):
+        self.max_workers = max_workers
+        self.history = history
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis")
+        self._jobs = {}  # id -> AnalysisJob, en orden de llegada
+        self._waits = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, func, label=""):
+        """Encola func(job) y devuelve el id del trabajo.
+
+        El valor devuelto por func queda en job.result; los mensajes de UI que emita, en job.messages.
+        """
+        with self._lock:
+            job = AnalysisJob(f"{next(self._ids)}-{int(time.time())}", label)
+            self._jobs[job.id] = job
+            self._evict()
+        # El trabajo conserva la sesión que lo encoló, para la cola justa de concurrency_limits
+        self._executor.submit(self._run, job, bind_session(func))
+        return job.id
+
+    def get(self, job_id):
+        """El trabajo o None si no existe (o ya se descartó)."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancela el trabajo y lo descarta de la cola.
+
+        Uno en espera ya no se ejecuta; uno en curso se detiene en el próximo
+        fragmento o sección y se descarta al terminar.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.cancel()
+            if job.status != "running":
+                del self._jobs[job_id]
+
+    def position(self, job_id):
+        """Posición (1 = el siguiente) del trabajo entre los que esperan; 0 si no está en cola."""
+        with self._lock:
+            queued = [job.id for job in self._jobs.values() if job.status == "queued"]
+        return queued.index(job_id) + 1 if job_id in queued else 0
+
+    def stats(self):
+        """{"queued", "running", "workers", "mean_wait_seconds", "max_wait_seconds"} de la cola."""
+        with self._lock:
+            jobs = list(self._jobs.values())
+            waits = list(self._waits)
+        queued = [job for job in jobs if job.status == "queued"]
+        # La espera de los que siguen en cola también cuenta para el máximo
+        waits_now = waits + [job.wait_seconds() for job in queued]
+        return {
+            "queued": len(queued),
+            "running": sum(1 for job in jobs if job.status == "running"),
+            "workers": self.max_workers,
+            "mean_wait_seconds": sum(waits) / len(waits) if waits else None,
+            "max_wait_seconds": max(waits_now) if waits_now else None,
+        }
+
+    def _run(self, job, func):
+        if job.cancelled:
+            job.status = "cancelled"
+            return
+        job.started_at = time.time()
+        job.status = "running"
+        with self._lock:
+            self._waits = (self._waits + [job.wait_seconds()])[-WAIT_HISTORY:]
+        job.result, job.messages = call_collecting_messages(func, job)
+        job.finished_at = time.time()
+        if job.cancelled:
+            job.status = "cancelled"
+            with self._lock:
+                self._jobs.pop(job.id, None)
+            return
+        job.status = "done" if job.result else "error"
+
+    def _evict(self):
+        finished = [job.id for job in self._jobs.values() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+analysis_job_queue = AnalysisJobQueue(ANALYSIS_WORKERS)
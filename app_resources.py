@@ -0,0 +1,64 @@
+"""Recursos del proceso: clientes de Gemini, configuración de los entornos y el import diferido de google.generativeai.
+
+Se construyen la primera vez que se piden y se reutilizan en todos los reruns
+y sesiones de Streamlit, porque este módulo se importa una sola vez por proceso.
+"""
+import os
+import threading
+
+_lock = threading.Lock()
+_gemini_models = {}           # (api_key, modelo) -> GenerativeModel
+_configured_api_key = None
+_environment_configs = (None, None)  # (huella de los secretos, configuraciones)
+
+def genai():
+    """Módulo google.generativeai, importado al primer uso (tarda casi un segundo)."""
+    import google.generativeai
+    return google.generativeai
+
+def gemini_model(api_key, model_name):
+    """GenerativeModel de model_name, creado una sola vez por (api_key, modelo).
+
+    genai.configure es global: se vuelve a llamar solo si cambia la API key.
+    """
+    global _configured_api_key
+    with _lock:
+        if _configured_api_key != api_key:
+            genai().configure(api_key=api_key)
+            _configured_api_key = api_key
+        model = _gemini_models.get((api_key, model_name))
+        if model is None:
+            model = _gemini_models[(api_key, model_name)] = genai().GenerativeModel(model_name)
+        return model
+
+def _file_fingerprint(paths):
+    fingerprint = []
+    for path in paths:
+        try:
+            fingerprint.append((path, os.stat(path).st_mtime_ns))
+        except OSError:
+            fingerprint.append((path, None))
+    return tuple(fingerprint)
+
+def environment_configs(secrets, secrets_files=()):
+    """{display_name: (clave en secrets.toml, configuración como dict)} de los entornos con api_base_url.
+
+    Se recorre secrets solo si cambiaron sus secciones o la fecha de modificación
+    de alguno de secrets_files; las configuraciones son dicts simples que se
+    pueden pasar a hilos de trabajo.
+    """
+    global _environment_configs
+    fingerprint = (_file_fingerprint(secrets_files), tuple(secrets.keys()))
+    with _lock:
+        if _environment_configs[0] == fingerprint:
+            return _environment_configs[1]
+    configs = {}
+    for section_key in secrets.keys():
+        section_content = secrets[section_key]
+        if hasattr(section_content, "to_dict"):
+            section_content = section_content.to_dict()
+        if isinstance(section_content, dict) and section_content.get('display_name') and section_content.get('api_base_url'):
+            configs[section_content['display_name']] = (section_key, dict(section_content))
+    with _lock:
+        _environment_configs = (fingerprint, configs)
+    return configs
@@ -0,0 +1,347 @@
+"""Modo batch: genera análisis clínicos para una lista de cédulas sin la interfaz de Streamlit.
+
+Uso:
+    python batch_runner.py cedulas.csv --env cliente_a --output-dir reportes
+
+Lee las credenciales y la GOOGLE_API_KEY de .streamlit/secrets.toml (o de las
+opciones/variables de entorno). Escribe un reporte <cédula>.md por paciente
+(y <cédula>_laboratorios.csv con la tabla de laboratorios, si los hay),
+un progress.jsonl que permite reanudar tras una interrupción y un summary.csv.
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from crm_api import get_api_token, fetch_patient_data, fetch_kpis, PATIENT_DATA_SOURCES, KPI_BATCH_SIZE_DEFAULT
+from clinical_llm import (
+    generate_clinical_analysis_with_llm,
+    PROMPT_INSTRUCTIONS_TEMPLATE,
+    PROMPT_TOKEN_BUDGET_DEFAULT,
+    build_llm_payload,
+    compact_llm_payload,
+    last_analysis_stats,
+    raw_response_bytes,
+)
+from model_router import FLASH_MODEL
+from lab_table import build_lab_results_table, lab_results_csv
+from ui_messages import call_collecting_messages
+
+DEFAULT_SECRETS_PATH = os.path.join(".streamlit", "secrets.toml")
+DEFAULT_MODEL = FLASH_MODEL
+PROGRESS_FILE = "progress.jsonl"
+SUMMARY_FILE = "summary.csv"
+SUMMARY_FIELDS = ["cedula", "status", "medical_records", "exams", "labs", "fetch_seconds", "llm_seconds", "model", "report", "error", "finished_at"]
+CEDULA_HEADERS = {"cedula", "cédula", "country_id", "country-id", "country-ids"}
+
+logger = logging.getLogger("batch_runner")
+
+def load_secrets(path):
+    """Lee el archivo secrets.toml de Streamlit."""
+    try:
+        import tomllib
+    except ImportError: # Python < 3.11; el paquete toml se instala con Streamlit
+        import toml
+        return toml.load(path)
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+def find_environment(secrets, env_name):
+    """Busca el entorno por su clave en secrets.toml o por su display_name."""
+    for section_key, section_content in secrets.items():
+        if not isinstance(section_content, dict) or not section_content.get('api_base_url'):
+            continue
+        if env_name in (section_key, section_content.get('display_name')):
+            return section_content
+    return None
+
+def read_cedulas(path):
+    """Lee las cédulas de la primera columna de un CSV (con o sin encabezado), sin duplicados."""
+    cedulas = []
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        for row_number, row in enumerate(csv.reader(f)):
+            if not row or not row[0].strip():
+                continue
+            value = row[0].strip()
+            if row_number == 0 and value.lower() in CEDULA_HEADERS:
+                continue
+            if value not in cedulas:
+                cedulas.append(value)
+    return cedulas
+
+def load_progress(output_dir):
+    """Devuelve el último registro de progreso por cédula de una ejecución anterior."""
+    progress = {}
+    path = os.path.join(output_dir, PROGRESS_FILE)
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # Línea truncada por una interrupción
+                progress[entry["cedula"]] = entry
+    return progress
+
+def report_path(output_dir, cedula):
+    """Ruta del reporte de un paciente."""
+    safe_name = re.sub(r"[^0-9A-Za-z_-]", "_", cedula)
+    return os.path.join(output_dir, f"{safe_name}.md")
+
+def lab_table_path(output_dir, cedula):
+    """Ruta del CSV de laboratorios a través del tiempo de un paciente."""
+    return report_path(output_dir, cedula)[:-len(".md")] + "_laboratorios.csv"
+
+def _write_atomic(path, text):
+    """Escribe el archivo completo o nada (se renombra al final)."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def _log_messages(cedula, messages):
+    """Envía al log los mensajes que en la UI se mostrarían con st.error/st.warning."""
+    for level, text in messages:
+        log_level = logging.ERROR if level == "error" else logging.WARNING if level == "warning" else logging.INFO
+        logger.log(log_level, "[%s] %s", cedula, text)
+
+def _record_count(record_set):
+    """Número de registros de un KpiRecordSet (0 si la consulta falló)."""
+    return len(record_set.records) if record_set else 0
+
+class BatchRunner:
+    """Procesa cédulas con concurrencia acotada por separado para el CRM y para Gemini."""
+
+    def __init__(self, config, api_username, api_password, gemini_api_key, model_name, output_dir, crm_workers=4, llm_workers=2, token_budget=PROMPT_TOKEN_BUDGET_DEFAULT, incremental=True, sectioned=False, templated_sections=False):
+        self.config = config
+        self.api_username = api_username
+        self.api_password = api_password
+        self.gemini_api_key = gemini_api_key
+        self.model_name = model_name
+        self.output_dir = output_dir
+        self.crm_workers = crm_workers
+        self.llm_workers = llm_workers
+        self.token_budget = token_budget
+        self.incremental = incremental
+        self.sectioned = sectioned
+        self.templated_sections = templated_sections
+        self._crm_slots = threading.BoundedSemaphore(crm_workers)
+        self._llm_slots = threading.BoundedSemaphore(llm_workers)
+        self._progress_lock = threading.Lock()
+        # Lotes de cédulas que se consultan juntas al CRM (si el entorno acepta varias en country-ids)
+        self._prefetch_batches = {}
+        self._prefetched = set()
+        self._prefetch_lock = threading.Lock()
+
+    def pending(self, cedulas, force=False):
+        """Filtra las cédulas que ya tienen reporte de una ejecución anterior."""
+        if force:
+            return list(cedulas)
+        progress = load_progress(self.output_dir)
+        return [
+            cedula for cedula in cedulas
+            if not (progress.get(cedula, {}).get("status") == "ok" and os.path.exists(report_path(self.output_dir, cedula)))
+        ]
+
+    def fetch(self, cedula):
+        """Obtiene HMs, Exámenes y Laboratorios de un paciente. Devuelve {clave: datos} o None."""
+        token, messages = call_collecting_messages(get_api_token, self.api_username, self.api_password, self.config)
+        _log_messages(cedula, messages)
+        if not token:
+            return None
+        self._prefetch(token, cedula)
+        raw = {}
+        for result in fetch_patient_data(token, cedula, self.config, concurrent=False):
+            _log_messages(cedula, result.messages)
+            raw[result.state_key] = result.data
+        return raw
+
+    def plan_prefetch(self, cedulas):
+        """Agrupa las cédulas en lotes de kpi_batch_size si el entorno acepta lotes y usa la caché de respuestas."""
+        ttl = self.config.get("kpi_cache_ttl")
+        if not self.config.get("kpi_batch_country_ids") or (ttl is not None and float(ttl) <= 0):
+            return
+        batch_size = int(self.config.get("kpi_batch_size") or KPI_BATCH_SIZE_DEFAULT)
+        for start in range(0, len(cedulas), batch_size):
+            batch = tuple(cedulas[start:start + batch_size])
+            for cedula in batch:
+                self._prefetch_batches[cedula] = batch
+
+    def _prefetch(self, token, cedula):
+        """Consulta de una vez el lote de la cédula; fetch_patient_data luego lo sirve desde la caché."""
+        batch = self._prefetch_batches.get(cedula)
+        if batch is None:
+            return
+        with self._prefetch_lock:
+            if batch in self._prefetched:
+                return
+            self._prefetched.add(batch)
+            kpi_names = [kpi_name for _, kpi_name, _, _ in PATIENT_DATA_SOURCES]
+            _, messages = call_collecting_messages(fetch_kpis, token, kpi_names, batch, self.config)
+        _log_messages(f"lote de {len(batch)}", messages)
+
+    def analyse(self, cedula, raw, force=False):
+        """Genera el análisis clínico del paciente. Devuelve el texto o None.
+
+        Con force=True no se sirve desde la caché de análisis ni se reutiliza o
+        actualiza de forma incremental el análisis anterior del paciente.
+        """
+        combined_data_for_llm, messages = call_collecting_messages(
+            build_llm_payload, raw.get("kpi_data"), raw.get("exam_data"), raw.get("lab_data")
+        )
+        _log_messages(cedula, messages)
+        if not combined_data_for_llm:
+            return None
+        combined_data_for_llm, compaction_stats = compact_llm_payload(
+            combined_data_for_llm, raw_response_bytes(raw.get("kpi_data"), raw.get("exam_data"), raw.get("lab_data"))
+        )
+        if compaction_stats["saved_ratio"] is not None:
+            logger.info("[%s] Payload compactado: %d → %d bytes (~%d tokens de entrada menos).",
+                        cedula, compaction_stats["original_bytes"], compaction_stats["compact_bytes"],
+                        compaction_stats["estimated_tokens_saved"])
+        analysis_text, messages = call_collecting_messages(
+            generate_clinical_analysis_with_llm,
+            combined_data_for_llm, self.model_name, PROMPT_INSTRUCTIONS_TEMPLATE, self.gemini_api_key,
+            token_budget=self.token_budget,
+            use_cache=not force,
+            report_key=(self.config.get('api_base_url'), cedula),
+            incremental=self.incremental and not force,
+            sectioned=self.sectioned,
+            templated_sections=self.templated_sections
+        )
+        _log_messages(cedula, messages)
+        return analysis_text
+
+    def process(self, cedula, force=False):
+        """Pipeline completo de una cédula; siempre devuelve su registro de progreso."""
+        entry = {"cedula": cedula, "status": "error_crm", "report": "", "error": ""}
+        start_time = time.time()
+        with self._crm_slots:
+            raw = self.fetch(cedula)
+        entry["fetch_seconds"] = round(time.time() - start_time, 2)
+        if raw is None:
+            entry["error"] = "Fallo en la autenticación API del Entorno."
+            return self._save_progress(entry)
+
+        entry["medical_records"] = _record_count(raw.get("kpi_data"))
+        entry["exams"] = _record_count(raw.get("exam_data"))
+        entry["labs"] = _record_count(raw.get("lab_data"))
+        if not any(raw.values()):
+            entry["status"] = "sin_datos"
+            entry["error"] = "No se pudo obtener información de Historias Médicas ni de Exámenes ni de Laboratorios."
+            return self._save_progress(entry)
+
+        start_time = time.time()
+        with self._llm_slots:
+            analysis_text = self.analyse(cedula, raw, force)
+        entry["llm_seconds"] = round(time.time() - start_time, 2)
+        entry["model"] = last_analysis_stats().get("model") or ""
+        if not analysis_text:
+            entry["status"] = "error_llm"
+            entry["error"] = "Fallo al generar el análisis clínico con el LLM."
+            return self._save_progress(entry)
+
+        path = report_path(self.output_dir, cedula)
+        lab_results_table = build_lab_results_table(raw.get("lab_data"))
+        if not lab_results_table.empty:
+            with open(lab_table_path(self.output_dir, cedula), "wb") as f:
+                f.write(lab_results_csv(lab_results_table))
+        _write_atomic(path, analysis_text)
+        entry["status"] = "ok"
+        entry["report"] = os.path.basename(path)
+        return self._save_progress(entry)
+
+    def _save_progress(self, entry):
+        entry["finished_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        with self._progress_lock:
+            with open(os.path.join(self.output_dir, PROGRESS_FILE), "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        return entry
+
+    def run(self, cedulas, force=False):
+        """Procesa las cédulas pendientes y escribe el summary.csv. Devuelve los registros de progreso."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        pending = self.pending(cedulas, force)
+        self.plan_prefetch(pending)
+        logger.info("%d cédulas, %d pendientes (CRM: %d en paralelo, Gemini: %d en paralelo).",
+                    len(cedulas), len(pending), self.crm_workers, self.llm_workers)
+
+        executor = ThreadPoolExecutor(max_workers=self.crm_workers + self.llm_workers)
+        try:
+            futures = {executor.submit(self.process, cedula, force): cedula for cedula in pending}
+            for done_count, future in enumerate(as_completed(futures), start=1):
+                entry = future.result()
+                logger.info("[%d/%d] %s: %s", done_count, len(pending), entry["cedula"], entry["status"])
+        except KeyboardInterrupt:
+            logger.warning("Interrumpido: se terminan las cédulas en curso; el resto queda pendiente para la próxima ejecución.")
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        finally:
+            executor.shutdown(wait=True)
+            self.write_summary(cedulas)
+        return [load_progress(self.output_dir).get(cedula) for cedula in cedulas]
+
+    def write_summary(self, cedulas):
+        """Escribe summary.csv con el último estado conocido de cada cédula."""
+        progress = load_progress(self.output_dir)
+        with open(os.path.join(self.output_dir, SUMMARY_FILE), "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            for cedula in cedulas:
+                writer.writerow(progress.get(cedula, {"cedula": cedula, "status": "pendiente"}))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Genera análisis clínicos para un CSV de cédulas.")
+    parser.add_argument("input_csv", help="CSV con las cédulas en la primera columna.")
+    parser.add_argument("--env", required=True, help="Clave o display_name del entorno en secrets.toml.")
+    parser.add_argument("--secrets", default=DEFAULT_SECRETS_PATH, help="Ruta a secrets.toml.")
+    parser.add_argument("--output-dir", default="reportes", help="Directorio de reportes.")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="Modelo Gemini, o 'auto' para elegirlo según el tamaño del prompt y la latencia observada.")
+    parser.add_argument("--crm-workers", type=int, default=4, help="Pacientes consultados al CRM en paralelo.")
+    parser.add_argument("--llm-workers", type=int, default=2, help="Análisis generados con Gemini en paralelo.")
+    parser.add_argument("--token-budget", type=int, default=PROMPT_TOKEN_BUDGET_DEFAULT, help="Tokens de prompt a partir de los cuales se analiza por lotes.")
+    parser.add_argument("--full-rebuild", action="store_true", help="No usa el análisis incremental: reconstruye cada análisis desde todos los registros.")
+    parser.add_argument("--sectioned", action="store_true", help="Genera las secciones del informe en llamadas paralelas a Gemini.")
+    parser.add_argument("--templated-sections", action="store_true", help="Arma las secciones A y C en Python a partir de los registros; Gemini genera solo las interpretativas.")
+    parser.add_argument("--user", default=os.environ.get("SUGOS_API_USER"), help="Usuario API (o SUGOS_API_USER).")
+    parser.add_argument("--password", default=os.environ.get("SUGOS_API_PASSWORD"), help="Contraseña API (o SUGOS_API_PASSWORD).")
+    parser.add_argument("--force", action="store_true", help="Regenera también los reportes ya existentes, sin usar la caché de análisis ni el análisis incremental.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    secrets = load_secrets(args.secrets)
+    config = find_environment(secrets, args.env)
+    if config is None:
+        parser.error(f"No se encontró el entorno '{args.env}' con api_base_url en {args.secrets}.")
+    api_credentials = secrets.get("api_credentials", {})
+    api_username = args.user or api_credentials.get("username")
+    api_password = args.password or api_credentials.get("password")
+    if not api_username or not api_password:
+        parser.error("Faltan credenciales API (--user/--password o [api_credentials] en secrets.toml).")
+    gemini_api_key = os.environ.get("GOOGLE_API_KEY") or secrets.get("GOOGLE_API_KEY")
+    if not gemini_api_key:
+        parser.error("Falta GOOGLE_API_KEY (variable de entorno o secrets.toml).")
+
+    runner = BatchRunner(
+        config, api_username, api_password, gemini_api_key, args.model, args.output_dir,
+        crm_workers=args.crm_workers, llm_workers=args.llm_workers, token_budget=args.token_budget,
+        incremental=not args.full_rebuild, sectioned=args.sectioned, templated_sections=args.templated_sections
+    )
+    try:
+        results = runner.run(read_cedulas(args.input_csv), force=args.force)
+    except KeyboardInterrupt:
+        return 130
+    failed = [entry for entry in results if not entry or entry.get("status") != "ok"]
+    logger.info("Reportes generados: %d, con problemas: %d. Resumen en %s.",
+                len(results) - len(failed), len(failed), os.path.join(args.output_dir, SUMMARY_FILE))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
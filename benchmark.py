@@ -0,0 +1,464 @@
+"""Benchmark local: mide la consulta y el análisis completos sin el CRM real ni cuota de Gemini.
+
+Uso:
+    python benchmark.py --tiers 10,100,1000 --repeat 3 --crm-latency 0.2 --json resultados.json
+
+Levanta un CRM simulado (login y endpoint KPI con registros sintéticos del
+tamaño y la latencia indicados) y reemplaza el modelo de Gemini por uno falso
+con un rendimiento de tokens configurable. Para cada nivel (cantidad de
+registros por fuente) ejecuta las mismas etapas que streamlit_app.py y reporta
+la latencia total y por etapa y la memoria. Guardar el --json de cada versión
+permite detectar regresiones antes de desplegar.
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import google.generativeai as genai
+
+import clinical_llm
+from analysis_cache import analysis_cache
+from model_router import model_latency_stats
+from patient_store import patient_store
+from clinical_llm import (
+    generate_clinical_analysis_with_llm,
+    PROMPT_INSTRUCTIONS_TEMPLATE,
+    PROMPT_TOKEN_BUDGET_DEFAULT,
+    build_llm_payload,
+    compact_llm_payload,
+    last_analysis_stats,
+)
+from crm_api import get_api_token, last_token_source, fetch_patient_data
+from lab_table import build_lab_results_table
+from metrics import RequestMetrics
+from ui_messages import call_collecting_messages
+
+BENCHMARK_MODEL = "benchmark-fake-model"
+REPORT_SECTION_PATTERN = re.compile(r"^([A-E])\. [A-ZÁÉÍÓÚÑ]", re.M)  # Títulos de sección de la plantilla del prompt
+STAGES = ["login", "kpi_data", "exam_data", "lab_data", "lab_table", "prompt", "llm"]
+
+# --- Datos sintéticos ---
+def synthetic_records(kpi_name, count, html_kb=4, labs_per_record=15, seed=0):
+    """Registros con la forma de las respuestas KPI del CRM (medicalrecords, exams o labresults)."""
+    rng = random.Random(f"{kpi_name}-{count}-{seed}")
+    patient = {"Name": "PACIENTE SINTÉTICO", "CountryID": str(count), "Gender": "F", "BirthDate": "1980-05-17"}
+    records = []
+    for index in range(count):
+        record = {
+            "ID": 100000 + index,
+            "Date": f"{2015 + index // 365:04d}-{index % 12 + 1:02d}-{index % 28 + 1:02d} {8 + index % 10:02d}:30:00",
+            "Patient": patient,
+        }
+        if kpi_name == "medicalrecords":
+            record.update({
+                "Doctor": {"Name": f"Dr. {rng.choice(['Pérez', 'Gómez', 'Rivas', 'Mora'])}", "Specialty": rng.choice(["Medicina General", "Medicina Interna", "Cardiología"])},
+                "Reason": rng.choice(["Control", "Dolor abdominal", "Cefalea", "Fiebre", "Evaluación preempleo"]),
+                "Sickness": rng.choice(["", "Gastritis", "Hipertensión arterial", "Infección respiratoria"]),
+                "VitalSigns": {"TAS": rng.randint(100, 150), "TAD": rng.randint(60, 95), "FC": rng.randint(55, 100), "Weight": rng.randint(50, 110), "Size": round(rng.uniform(1.5, 1.9), 2)},
+                "PhysicalExam": {"Type": "General", "Description": "Paciente en buenas condiciones generales. " * rng.randint(1, 4)},
+                "Diagnostics": [{"ID": f"K{rng.randint(10, 99)}", "Name": "Diagnóstico sintético"} for _ in range(rng.randint(0, 3))],
+                "Exams": [{"ID": rng.randint(1, 500), "Name": "Hematología completa"} for _ in range(rng.randint(0, 2))],
+                "Medicines": [{"Name": "Medicamento", "Generic": "Genérico", "Code": f"M{rng.randint(1, 999)}", "Presentation": "Tabletas 500 mg", "Indications": "Una cada 8 horas por 5 días", "Laboratory": "Lab"} for _ in range(rng.randint(0, 3))],
+                "Comments": "",
+                "RestDays": rng.choice([0, 0, 1, 3]),
+                "History": {"Description": "Niega alergias. Antecedentes familiares de hipertensión."},
+            })
+        elif kpi_name == "exams":
+            paragraph = "<p>Se evidencia estructura de <b>aspecto normal</b>, sin lesiones.</p>"
+            record.update({
+                "ExamType": {"Type": rng.choice(["ULTRASONIDO", "RAYOS X", "ELECTROCARDIOGRAMA"]), "Code": f"E{rng.randint(1, 99)}", "Unit": "Imagenología"},
+                "ExamResults": "<div>" + paragraph * max(1, html_kb * 1024 // len(paragraph)) + "<p>Conclusión: estudio dentro de límites normales.</p></div>",
+            })
+        else:
+            record["LabResults"] = [
+                {
+                    "ExamType": rng.choice(["HEMATOLOGIA", "QUIMICA", "UROANALISIS"]),
+                    "Exam": rng.choice(["HEMOGRAMA", "PERFIL LIPIDICO", "ORINA"]),
+                    "Section": rng.choice(["", "MACRO", "MICRO"]),
+                    "Item": f"ITEM {item_index}",
+                    "Value": str(round(rng.uniform(0.5, 200), 1)),
+                    "Unit": rng.choice(["g/dl", "mg/dl", "%", ""]),
+                }
+                for item_index in range(labs_per_record)
+            ]
+        records.append(record)
+    return records
+
+# --- CRM simulado ---
+class StubCrmServer:
+    """Servidor HTTP local con custom/apps/api.php?login y el endpoint KPI (afn=admin&cfn=kpis).
+
+    La cédula consultada indica la cantidad de registros por fuente. Las respuestas
+    se generan una sola vez por tamaño para no medir la generación de los datos.
+    Acepta varias cédulas separadas por coma en country-ids (kpi_batch_country_ids).
+    Con capacity atiende a lo sumo esa cantidad de consultas KPI a la vez, como un
+    CRM con pocos workers; las demás esperan en el servidor.
+    """
+
+    def __init__(self, latency=0.2, login_latency=0.05, html_kb=4, labs_per_record=15, capacity=None):
+        self.latency = latency
+        self.login_latency = login_latency
+        self.html_kb = html_kb
+        self.labs_per_record = labs_per_record
+        self.requests = 0
+        self._capacity = threading.BoundedSemaphore(capacity) if capacity else contextlib.nullcontext()
+        self._bodies = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/"
+
+    def prepare(self, count):
+        """Genera por adelantado las tres respuestas de un nivel."""
+        for kpi_name in ("medicalrecords", "exams", "labresults"):
+            self.body(kpi_name, count)
+
+    def body(self, kpi_name, count):
+        key = (kpi_name, count)
+        with self._lock:
+            if key not in self._bodies:
+                records = synthetic_records(kpi_name, count, self.html_kb, self.labs_per_record)
+                response = {"status": "success", "data": {"kpis": {"Records": records}}}
+                self._bodies[key] = json.dumps(response, ensure_ascii=False).encode("utf-8")
+            return self._bodies[key]
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _read_json(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    return json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    return {}
+
+            def _send(self, status, body):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                self._read_json()
+                if "login" not in urlsplit(self.path).query:
+                    self._send(404, b'{"error": "not found"}')
+                    return
+                time.sleep(stub.login_latency)
+                self._send(200, json.dumps({"token": f"bench-{time.time_ns()}", "expires_in": 900}).encode("utf-8"))
+
+            def do_GET(self):
+                query = parse_qs(urlsplit(self.path).query)
+                payload = self._read_json()
+                country_ids = str(payload.get("country-ids", "")).split(",")
+                if query.get("cfn") != ["kpis"] or not all(country_id.isdigit() for country_id in country_ids):
+                    self._send(404, b'{"error": "not found"}')
+                    return
+                with stub._lock:
+                    stub.requests += 1
+                with stub._capacity:
+                    time.sleep(stub.latency)
+                if len(country_ids) == 1:
+                    self._send(200, stub.body(payload.get("kpi-name"), int(country_ids[0])))
+                    return
+                records = []
+                for country_id in country_ids:
+                    records += json.loads(stub.body(payload.get("kpi-name"), int(country_id)))["data"]["kpis"]["Records"]
+                self._send(200, json.dumps({"status": "success", "data": {"kpis": {"Records": records}}}, ensure_ascii=False).encode("utf-8"))
+
+        return Handler
+
+# --- Gemini simulado ---
+class FakeGemini:
+    """Reemplaza genai.GenerativeModel por un modelo falso con latencia y rendimiento de tokens fijos."""
+
+    def __init__(self, tokens_per_second=400, first_token_seconds=0.5, response_tokens=1500, consultation_tokens=120):
+        self.tokens_per_second = tokens_per_second
+        self.first_token_seconds = first_token_seconds
+        self.response_tokens = response_tokens
+        self.consultation_tokens = consultation_tokens
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def install(self):
+        genai.configure = lambda **kwargs: None
+        genai.GenerativeModel = self._model
+
+    def _report(self, prompt):
+        """(texto, tokens) de la respuesta: response_tokens repartidos entre las secciones A-E que pide el prompt.
+
+        Un prompt que pide solo algunas secciones (generación por secciones) recibe la parte proporcional.
+        La sección C, que repite cada consulta, suma consultation_tokens por consulta del JSON del prompt.
+        """
+        letters = sorted(set(REPORT_SECTION_PATTERN.findall(prompt))) or list("ABCDE")
+        section_tokens = {letter: max(1, self.response_tokens // 5) for letter in letters}
+        if "C" in section_tokens:
+            section_tokens["C"] += self.consultation_tokens * prompt.count('"Doctor":')
+        return "".join(f"## {letter}. SECCIÓN\n" + "dato " * tokens + "\n\n" for letter, tokens in section_tokens.items()), sum(section_tokens.values())
+
+    def _model(self, model_name, **kwargs):
+        fake = self
+
+        class Response:
+            def __init__(self, text, tokens, stream):
+                self._text = text
+                self._stream = stream
+                self.usage_metadata = types.SimpleNamespace(candidates_token_count=tokens)
+
+            @property
+            def text(self):
+                return self._text
+
+            def __iter__(self):
+                time.sleep(fake.first_token_seconds)
+                words = self._text.split(" ")
+                step = max(1, int(fake.tokens_per_second // 10))  # ~10 fragmentos por segundo
+                for start in range(0, len(words), step):
+                    time.sleep(step / fake.tokens_per_second)
+                    yield types.SimpleNamespace(text=" ".join(words[start:start + step]) + " ")
+
+        class Model:
+            def count_tokens(self, prompt):
+                return types.SimpleNamespace(total_tokens=len(prompt) // clinical_llm.CHARS_PER_TOKEN_ESTIMATE)
+
+            def generate_content(self, prompt, generation_config=None, request_options=None, stream=False):
+                with fake._lock:
+                    fake.calls += 1
+                text, tokens = fake._report(prompt)
+                if not stream:
+                    time.sleep(fake.first_token_seconds + tokens / fake.tokens_per_second)
+                return Response(text, tokens, stream)
+
+        return Model()
+
+# --- Ejecución ---
+def run_patient(config, count, run_number, token_budget, concurrent=True, stream=False, sectioned=False, model_name=BENCHMARK_MODEL, templated_sections=False):
+    """Ejecuta consulta + análisis de un paciente y devuelve (métricas, datos consultados)."""
+    request_metrics = RequestMetrics("benchmark", config.get("display_name"))
+    with request_metrics.stage("login") as login_stage:
+        # Un usuario distinto por ejecución para medir siempre el login real
+        token, _ = call_collecting_messages(get_api_token, f"bench-user-{run_number}", "bench", config)
+        login_stage["cache"] = "hit" if last_token_source() == "cache" else "miss"
+    if not token:
+        raise RuntimeError("El CRM simulado no entregó token.")
+
+    data = {}
+    for result in fetch_patient_data(token, str(count), config, concurrent=concurrent, refresh=True):
+        data[result.state_key] = result.data
+        request_metrics.add(
+            result.state_key, result.seconds,
+            cache="hit" if result.source in ("cache", "store") else "miss",
+            bytes=result.response_bytes,
+            decode_seconds=result.decode_seconds,
+            records=len(result.data.records) if result.data else 0,
+            wait_seconds=result.wait_seconds
+        )
+
+    with request_metrics.stage("lab_table") as lab_table_stage:
+        lab_table_stage["records"] = len(build_lab_results_table(data.get("lab_data")))
+
+    with request_metrics.stage("prompt") as prompt_stage:
+        payload, _ = call_collecting_messages(build_llm_payload, data.get("kpi_data"), data.get("exam_data"), data.get("lab_data"))
+        payload, _ = compact_llm_payload(payload)
+        prompt_stage["records"] = sum(len(kpis.get("Records") or []) for kpis in payload.values() if isinstance(kpis, dict))
+
+    with request_metrics.stage("llm") as llm_stage:
+        call_collecting_messages(
+            generate_clinical_analysis_with_llm,
+            payload, model_name, PROMPT_INSTRUCTIONS_TEMPLATE, "benchmark-key",
+            token_budget=token_budget,
+            on_chunk=(lambda chunk: None) if stream else None,
+            use_cache=False,
+            incremental=False,
+            sectioned=sectioned,
+            templated_sections=templated_sections
+        )
+        analysis_stats = last_analysis_stats()
+        llm_stage.update(
+            mode=analysis_stats.get("mode"),
+            model=analysis_stats.get("model"),
+            prompt_tokens=analysis_stats.get("prompt_tokens"),
+            response_tokens=analysis_stats.get("response_tokens"),
+            wait_seconds=analysis_stats.get("wait_seconds"),
+        )
+    return request_metrics.to_dict(), data
+
+def measure_memory(config, count, token_budget, concurrent=True):
+    """Pico de memoria de una ejecución completa y memoria retenida por los datos consultados."""
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        _, data = run_patient(config, count, f"mem-{count}", token_budget, concurrent=concurrent)
+        retained, peak = tracemalloc.get_traced_memory()
+        del data
+    finally:
+        tracemalloc.stop()
+    return {"peak_mb": (peak - baseline) / 1024 / 1024, "retained_kb": (retained - baseline) / 1024}
+
+# Módulos que streamlit_app.py importa al arrancar
+APP_MODULES = ("crm_api", "clinical_llm", "lab_table", "analysis_cache", "analysis_jobs", "patient_store", "metrics", "model_router", "concurrency_limits", "prefetch")
+
+def measure_startup(stub, reruns=10):
+    """Costo de arranque y de cada rerun de la app.
+
+    import_seconds: importar los módulos de la app en un proceso nuevo (mediana de 3).
+    rerun_seconds: cada ejecución de streamlit_app.py con AppTest, sin consultas (mediana).
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    code = f"import time; start = time.perf_counter(); import {', '.join(APP_MODULES)}; print(time.perf_counter() - start)"
+    import_seconds = statistics.median(
+        float(subprocess.run([sys.executable, "-c", code], cwd=package_dir, capture_output=True, text=True, check=True).stdout.split()[-1])
+        for _ in range(3)
+    )
+    from streamlit.testing.v1 import AppTest
+    app = AppTest.from_file(os.path.join(package_dir, "streamlit_app.py"), default_timeout=60)
+    app.secrets["benchmark"] = {"display_name": "Benchmark", "api_base_url": stub.base_url}
+    app.secrets["GOOGLE_API_KEY"] = "benchmark-key"
+    app.run()
+    rerun_seconds = []
+    for _ in range(reruns):
+        start_time = time.perf_counter()
+        app.run()
+        rerun_seconds.append(time.perf_counter() - start_time)
+    return {"import_seconds": import_seconds, "rerun_seconds": statistics.median(rerun_seconds)}
+
+def summarize(count, runs, memory):
+    """Resumen de un nivel: latencia total (media, p50, máx.) y media por etapa."""
+    totals = [run["total_seconds"] for run in runs]
+    stage_seconds = {stage: [] for stage in STAGES}
+    response_bytes, prompt_tokens, response_tokens = 0, None, None
+    for run in runs:
+        for stage in run["stages"]:
+            stage_seconds.setdefault(stage["stage"], []).append(stage["seconds"])
+            response_bytes += stage.get("bytes") or 0
+            if stage["stage"] == "llm":
+                prompt_tokens, response_tokens = stage.get("prompt_tokens"), stage.get("response_tokens")
+    return {
+        "records": count,
+        "runs": len(runs),
+        "total_mean": statistics.mean(totals),
+        "total_p50": statistics.median(totals),
+        "total_max": max(totals),
+        "stages": {stage: statistics.mean(values) for stage, values in stage_seconds.items() if values},
+        "response_kb": response_bytes / len(runs) / 1024,
+        "prompt_tokens": prompt_tokens,
+        "response_tokens": response_tokens,
+        "mode": runs[-1]["stages"][-1].get("mode"),
+        **(memory or {}),
+    }
+
+def print_report(summaries):
+    """Tabla por nivel con la latencia total, la media de cada etapa y la memoria."""
+    headers = ["registros", "total s", "p50 s", "máx s"] + STAGES + ["KB resp.", "tokens", "tokens resp.", "modo", "pico MB", "retenido KB"]
+    rows = []
+    for summary in summaries:
+        rows.append(
+            [str(summary["records"]), f"{summary['total_mean']:.2f}", f"{summary['total_p50']:.2f}", f"{summary['total_max']:.2f}"]
+            + [f"{summary['stages'].get(stage, 0):.3f}" for stage in STAGES]
+            + [f"{summary['response_kb']:,.0f}", f"{summary['prompt_tokens'] or 0:,}", f"{summary['response_tokens'] or 0:,}", str(summary["mode"]),
+               f"{summary['peak_mb']:.1f}" if "peak_mb" in summary else "-",
+               f"{summary['retained_kb']:,.0f}" if "retained_kb" in summary else "-"]
+        )
+    widths = [max(len(header), *(len(row[index]) for row in rows)) for index, header in enumerate(headers)]
+    for line in [headers] + rows:
+        print("  ".join(value.rjust(width) for value, width in zip(line, widths)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark local con un CRM simulado y un Gemini falso.")
+    parser.add_argument("--tiers", default="10,100,1000", help="Registros por fuente de cada nivel, separados por coma.")
+    parser.add_argument("--repeat", type=int, default=3, help="Ejecuciones por nivel.")
+    parser.add_argument("--crm-latency", type=float, default=0.2, help="Segundos de latencia de cada consulta KPI.")
+    parser.add_argument("--login-latency", type=float, default=0.05, help="Segundos de latencia del login.")
+    parser.add_argument("--html-kb", type=int, default=4, help="Tamaño aproximado del HTML de cada examen, en KB.")
+    parser.add_argument("--labs-per-record", type=int, default=15, help="Elementos de LabResults por registro.")
+    parser.add_argument("--tokens-per-second", type=float, default=400, help="Rendimiento del Gemini falso.")
+    parser.add_argument("--first-token-latency", type=float, default=0.5, help="Segundos hasta el primer token del Gemini falso.")
+    parser.add_argument("--response-tokens", type=int, default=1500, help="Tokens de cada respuesta del Gemini falso.")
+    parser.add_argument("--token-budget", type=int, default=PROMPT_TOKEN_BUDGET_DEFAULT, help="Tokens de prompt a partir de los cuales se analiza por lotes.")
+    parser.add_argument("--sequential", action="store_true", help="Consulta las tres fuentes KPI una tras otra.")
+    parser.add_argument("--stream", action="store_true", help="Consume la respuesta de Gemini en streaming.")
+    parser.add_argument("--sectioned", action="store_true", help="Genera las secciones del informe en llamadas paralelas.")
+    parser.add_argument("--templated-sections", action="store_true", help="Arma las secciones A y C en Python; el LLM genera solo las interpretativas.")
+    parser.add_argument("--model", default=BENCHMARK_MODEL, help="Modelo pedido al Gemini falso; 'auto' prueba la selección automática.")
+    parser.add_argument("--no-memory", action="store_true", help="No mide la memoria (tracemalloc agrega una ejecución por nivel).")
+    parser.add_argument("--startup", action="store_true", help="Solo mide el arranque (importación de módulos) y el costo de cada rerun de la app.")
+    parser.add_argument("--json", help="Guarda el resumen y todas las ejecuciones en este archivo.")
+    args = parser.parse_args(argv)
+
+    tiers = [int(value) for value in args.tiers.split(",") if value.strip()]
+    stub = StubCrmServer(args.crm_latency, args.login_latency, args.html_kb, args.labs_per_record).start()
+    FakeGemini(args.tokens_per_second, args.first_token_latency, args.response_tokens).install()
+    cache_dir = tempfile.mkdtemp(prefix="sugos-benchmark-")
+    analysis_cache.directory = os.path.join(cache_dir, "analyses")
+    patient_store.path = os.path.join(cache_dir, "patients.sqlite3")
+    model_latency_stats.path = os.path.join(cache_dir, "model_latency.json")
+    config = {"display_name": "Benchmark", "api_base_url": stub.base_url, "kpi_cache_ttl": 0}
+
+    if args.startup:
+        try:
+            startup = measure_startup(stub)
+        finally:
+            stub.stop()
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        print(f"Importación de los módulos de la app: {startup['import_seconds']:.3f} s · rerun de streamlit_app.py: {startup['rerun_seconds'] * 1000:.1f} ms")
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({"args": vars(args), "startup": startup}, f, ensure_ascii=False, indent=2)
+        return 0
+
+    summaries, all_runs = [], {}
+    try:
+        for count in tiers:
+            stub.prepare(count)
+            runs = [
+                run_patient(
+                    config, count, f"{count}-{run_number}", args.token_budget,
+                    concurrent=not args.sequential, stream=args.stream, sectioned=args.sectioned, model_name=args.model,
+                    templated_sections=args.templated_sections
+                )[0]
+                for run_number in range(args.repeat)
+            ]
+            memory = None if args.no_memory else measure_memory(config, count, args.token_budget, concurrent=not args.sequential)
+            summaries.append(summarize(count, runs, memory))
+            all_runs[count] = runs
+    finally:
+        stub.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    print_report(summaries)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "summaries": summaries, "runs": all_runs}, f, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
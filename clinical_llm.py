@@ -0,0 +1,803 @@
+"""Generación del análisis clínico con Gemini a partir de los datos KPI del paciente."""
+import json
+import hashlib
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+
+from app_resources import genai, gemini_model
+from analysis_cache import analysis_cache, prompt_template_version
+from concurrency_limits import add_wait_seconds, bind_session, last_wait_seconds, model_limiter
+from patient_store import patient_store
+from report_templates import TEMPLATED_SECTIONS, ReportMerger, merge_report, render_templated_sections, strip_sections
+from model_router import (
+    AUTO_MODEL, FLASH_MODEL, PRO_MODEL, AUTO_LATENCY_BUDGET_SECONDS, GENERATION_TIMEOUT_SECONDS,
+    route_models, is_timeout_error, model_latency_stats,
+)
+from ui_messages import bind_messages, show_message
+
+# --- FUNCIÓN PARA GEMINI ---
+PROMPT_TOKEN_BUDGET_DEFAULT = 200_000  # Tokens de prompt por encima de los cuales se analiza por lotes (map-reduce)
+MAP_CHUNK_TOKENS = 40_000              # Tamaño máximo (tokens estimados) de cada lote de registros
+MAP_REDUCE_WORKERS = 4                 # Lotes resumidos en paralelo
+
+@lru_cache(maxsize=1)
+def _generation_config():
+    return genai().GenerationConfig(
+        temperature=0.2,
+        max_output_tokens=131072 # Aumentado para permitir respuestas más largas si es necesario. Verifica límites de modelo.
+                               # Gemini 1.5 Pro tiene 1M tokens, Flash 1M, pero la respuesta puede ser menor.
+                               # `max_output_tokens` en `GenerationConfig` suele referirse a la *respuesta*.
+                               # La longitud total (prompt + respuesta) es manejada por `model.count_tokens`.
+    )
+
+def count_prompt_tokens(model, prompt):
+    """Cuenta los tokens del prompt con el contador del modelo (o los estima si la llamada falla)."""
+    try:
+        return model.count_tokens(prompt).total_tokens
+    except Exception:
+        return len(prompt) // CHARS_PER_TOKEN_ESTIMATE
+
+# Cómo se resolvió el último análisis del hilo actual (para las métricas de la UI y del batch)
+_analysis_state = threading.local()
+
+def last_analysis_stats():
+    """Modo ('cache', 'reuse', 'delta', 'full', 'map_reduce' o 'sectioned'), modelo usado, tokens y tiempos del último análisis del hilo actual."""
+    return dict(getattr(_analysis_state, "stats", {}))
+
+def _response_tokens(response):
+    """Tokens de la respuesta según usage_metadata, o None si Gemini no los informa."""
+    try:
+        return response.usage_metadata.candidates_token_count
+    except AttributeError:
+        return None
+
+def generate_clinical_analysis_with_llm(combined_json_data_for_llm, model_name, prompt_instructions_template, gemini_api_key, token_budget=PROMPT_TOKEN_BUDGET_DEFAULT, on_chunk=None, use_cache=True, report_key=None, incremental=True, sectioned=False, on_section=None, templated_sections=False):
+    """Genera análisis clínico usando Gemini.
+
+    Si el prompt supera token_budget, los registros se resumen por lotes en
+    paralelo y el informe final se arma a partir de esos resúmenes.
+    Si se pasa on_chunk, la respuesta se consume en streaming y on_chunk recibe
+    cada fragmento de texto a medida que llega; se devuelve igualmente el texto completo.
+    Los análisis se guardan en analysis_cache; use_cache=False fuerza a regenerar.
+    Con report_key=(api_base_url, cédula) se guarda el último análisis del paciente
+    y, si incremental=True, solo se envían los registros nuevos junto con ese análisis.
+    Con sectioned=True las secciones del informe se generan en llamadas paralelas,
+    cada una con solo los datos que necesita, y se unen en orden; on_section(índice,
+    total, texto) se llama (en el hilo que invoca) a medida que cada sección termina.
+    Con model_name="auto" el modelo se elige por tamaño del prompt y latencia
+    observada (model_router); si el primer intento supera el presupuesto de
+    latencia se reintenta con el otro modelo.
+    Con templated_sections=True las secciones de extracción de campos (A y C) se
+    arman en Python (report_templates) y el LLM genera solo las interpretativas;
+    el resultado se une con el mismo formato.
+    """
+    stats = _analysis_state.stats = {"mode": None, "model": None, "prompt_tokens": None, "response_tokens": None}
+    auto_model = model_name == AUTO_MODEL
+    # En modo automático sirve un análisis guardado de cualquiera de los dos modelos
+    accepted_models = (FLASH_MODEL, PRO_MODEL) if auto_model else (model_name,)
+    try:
+        json_string_for_prompt = serialize_llm_payload(combined_json_data_for_llm)
+        rendered_sections = None
+        if templated_sections:
+            llm_template = _llm_only_template(prompt_instructions_template)
+            if llm_template is None:
+                show_message("warning", "La plantilla del prompt no tiene las secciones A a E: el LLM genera el informe completo.")
+            else:
+                # La plantilla reducida también separa la caché y la versión de los análisis guardados
+                prompt_instructions_template = llm_template
+                rendered_sections = render_templated_sections(combined_json_data_for_llm)
+        if use_cache:
+            for candidate_model in accepted_models:
+                cached_text = analysis_cache.get(analysis_cache.key(json_string_for_prompt, candidate_model, prompt_instructions_template))
+                if cached_text is not None:
+                    stats.update(mode="cache", model=candidate_model)
+                    show_message("caption", "Análisis servido desde la caché (mismos datos, modelo y prompt).")
+                    if on_chunk is not None:
+                        on_chunk(cached_text)
+                    return cached_text
+
+        # En modo automático flash cuenta los tokens y resume los lotes de map-reduce
+        model = gemini_model(gemini_api_key, FLASH_MODEL if auto_model else model_name)
+        prompt_start_time = time.perf_counter()
+
+        full_prompt = prompt_instructions_template.replace("{json_data_placeholder}", json_string_for_prompt)
+
+        # st.subheader("Prompt enviado al LLM (para depuración):")
+        # st.text_area("Prompt:", full_prompt, height=300)
+
+        delta_prompt = None
+        if report_key and incremental:
+            previous_report = patient_store.get_report(report_key)
+            # Como en la caché, el análisis anterior solo se reutiliza o amplía con el mismo modelo y prompt
+            if (previous_report and previous_report.get("model") in accepted_models
+                    and previous_report.get("prompt_version") == prompt_template_version(prompt_instructions_template)):
+                delta_payload, new_records = split_new_records(combined_json_data_for_llm, previous_report.get("covered") or {})
+                if delta_payload is not None and new_records == 0:
+                    stats.update(mode="reuse", model=previous_report.get("model"))
+                    show_message("caption", f"Sin registros nuevos desde el análisis del {previous_report['created_at']}: se reutiliza.")
+                    if on_chunk is not None:
+                        on_chunk(previous_report["text"])
+                    return previous_report["text"]
+                if delta_payload is not None:
+                    if rendered_sections:
+                        # Las secciones armadas se vuelven a armar con todos los registros
+                        previous_report = dict(previous_report, text=strip_sections(previous_report["text"], rendered_sections))
+                    delta_prompt = _delta_prompt(combined_json_data_for_llm, delta_payload, previous_report, prompt_instructions_template)
+                    delta_tokens = count_prompt_tokens(model, delta_prompt)
+                    if delta_tokens <= token_budget:
+                        show_message("caption", f"Análisis incremental: {new_records} registros nuevos desde el análisis del {previous_report['created_at']} ({delta_tokens:,} tokens de prompt).")
+                    else:
+                        delta_prompt = None
+
+        prompt_tokens = None if delta_prompt else count_prompt_tokens(model, full_prompt)
+        if delta_prompt:
+            full_prompt = delta_prompt
+            stats.update(mode="delta", prompt_tokens=delta_tokens)
+        elif prompt_tokens > token_budget:
+            stats.update(mode="map_reduce", prompt_tokens=prompt_tokens)
+            show_message("info", f"El prompt tiene {prompt_tokens:,} tokens (presupuesto: {token_budget:,}). Se analizará el historial por lotes.")
+            full_prompt = _map_reduce_prompt(model, FLASH_MODEL if auto_model else model_name, combined_json_data_for_llm, prompt_instructions_template, token_budget)
+            if full_prompt is None:
+                return None
+        else:
+            stats.update(mode="full", prompt_tokens=prompt_tokens)
+            show_message("caption", f"Tokens del prompt: {prompt_tokens:,} (presupuesto: {token_budget:,}).")
+        stats["prompt_seconds"] = time.perf_counter() - prompt_start_time
+
+        routed_tokens = stats["prompt_tokens"] if stats["mode"] != "map_reduce" else len(full_prompt) // CHARS_PER_TOKEN_ESTIMATE
+        if auto_model:
+            models, reason = route_models(routed_tokens, _payload_record_count(combined_json_data_for_llm))
+            show_message("caption", f"Modelo elegido automáticamente: {models[0]} ({reason}, ~{routed_tokens:,} tokens de prompt).")
+        else:
+            models = [model_name]
+        if rendered_sections:
+            stats["templated_sections"] = ", ".join(sorted(rendered_sections))
+            show_message("caption", f"Secciones {stats['templated_sections']} armadas a partir de los registros, sin LLM.")
+
+        section_prompts = _section_prompts(combined_json_data_for_llm, prompt_instructions_template) if sectioned and stats["mode"] == "full" else None
+        if section_prompts:
+            stats["mode"] = "sectioned"
+            if rendered_sections and on_section is not None:
+                on_section = _interleave_sections(section_prompts, rendered_sections, on_section)
+            generate_start_time = time.perf_counter()
+            analysis_text, stats["response_tokens"], used_models, stats["wait_seconds"] = _generate_sections(gemini_api_key, models, [section_prompt for _, section_prompt in section_prompts], on_section)
+            stats["generate_seconds"] = time.perf_counter() - generate_start_time
+            stats["model"] = ", ".join(sorted(used_models))
+            if rendered_sections:
+                analysis_text = merge_report(rendered_sections, analysis_text)
+            # Se guarda con el modelo pedido (el elegido, en modo automático), que es el que buscan la caché y
+            # la reutilización; si alguna sección cayó en el modelo de respaldo, eso queda solo en las métricas
+            _store_analysis(analysis_text, json_string_for_prompt, models[0], report_key, prompt_instructions_template, combined_json_data_for_llm)
+            return analysis_text
+
+        merger = ReportMerger(rendered_sections) if rendered_sections and on_chunk is not None else None
+        generate_start_time = time.perf_counter()
+        wait_start = last_wait_seconds()
+        analysis_text, response, stats["model"] = _generate_with_fallback(
+            gemini_api_key, models, full_prompt, routed_tokens,
+            on_chunk if merger is None else lambda chunk_text: _forward_chunk(on_chunk, merger.feed(chunk_text))
+        )
+        if merger is not None:
+            _forward_chunk(on_chunk, merger.close())
+        stats["generate_seconds"] = time.perf_counter() - generate_start_time
+        stats["wait_seconds"] = last_wait_seconds() - wait_start
+        stats["response_tokens"] = _response_tokens(response)
+        if rendered_sections:
+            analysis_text = merge_report(rendered_sections, analysis_text)
+
+        _store_analysis(analysis_text, json_string_for_prompt, stats["model"], report_key, prompt_instructions_template, combined_json_data_for_llm)
+        return analysis_text
+
+    except Exception as e:
+        if isinstance(e, genai().types.generation_types.BlockedPromptException):
+            show_message("error", "Error: La solicitud al LLM fue bloqueada por políticas de seguridad.")
+            try:
+                feedback = getattr(e, 'response', {}).get('prompt_feedback', None)
+                if feedback: show_message("warning", f"Razón del bloqueo: {feedback}")
+                # Check if response object exists and has prompt_feedback attribute
+                # This part might be tricky as 'response' might not be fully formed in a BlockedPromptException
+                # For now, rely on the feedback from the exception itself if available.
+            except Exception: pass
+            return None
+        show_message("error", f"Ocurrió un error durante la generación con el LLM: {e}")
+        if hasattr(e, 'message'): show_message("error", f"Detalle: {e.message}")
+        # If the error is about token limits, it might be in the response or exception details
+        if "token limit" in str(e).lower():
+            show_message("warning", "El prompt o la respuesta podrían haber excedido el límite de tokens del modelo.")
+        return None
+
+def _generate_with_fallback(gemini_api_key, models, prompt, prompt_tokens, on_chunk=None):
+    """Genera con models[0] y, si la llamada excede el presupuesto de latencia, con el siguiente modelo.
+
+    En todos los intentos salvo el último, AUTO_LATENCY_BUDGET_SECONDS limita la
+    llamada completa o, en streaming, solo la espera del primer fragmento: un
+    informe largo que ya empezó a llegar puede seguir hasta GENERATION_TIMEOUT_SECONDS.
+    No se reintenta si ya se entregaron fragmentos a on_chunk. Cada llamada espera
+    su turno en el límite de concurrencia del modelo y queda registrada (sin esa
+    espera) en model_latency_stats. Devuelve (texto, respuesta, modelo usado).
+    """
+    for attempt, model_name in enumerate(models):
+        last_attempt = attempt == len(models) - 1
+        budget = None if last_attempt else AUTO_LATENCY_BUDGET_SECONDS
+        timeout = budget if budget is not None and on_chunk is None else GENERATION_TIMEOUT_SECONDS
+        streamed = []
+        timing = {"start": time.perf_counter()}  # _generate lo mueve al momento en que se ocupa el lugar del límite
+        try:
+            analysis_text, response = _generate(gemini_api_key, model_name, prompt, timeout, on_chunk, streamed, timing, first_chunk_timeout=budget)
+        except Exception as e:
+            if not is_timeout_error(e):
+                raise
+            model_latency_stats.record(model_name, prompt_tokens, time.perf_counter() - timing["start"], timed_out=True)
+            if last_attempt or streamed:
+                raise
+            show_message("warning", f"{model_name} no respondió en {budget} s; se reintenta con {models[attempt + 1]}.")
+            continue
+        model_latency_stats.record(model_name, prompt_tokens, time.perf_counter() - timing["start"])
+        return analysis_text, response, model_name
+
+def _generate(gemini_api_key, model_name, prompt, timeout, on_chunk, streamed, timing, first_chunk_timeout=None):
+    """Una llamada a generate_content; en streaming agrega cada fragmento a streamed y lo pasa a on_chunk.
+
+    En streaming la respuesta se lee en un hilo aparte para poder abandonarla con
+    TimeoutError si el primer fragmento no llega en first_chunk_timeout segundos;
+    desde el primer fragmento solo rige el timeout de la llamada. Ese hilo ocupa
+    el lugar en el límite del modelo hasta terminar: una respuesta abandonada se
+    corta al recibir su próximo fragmento y sigue contando en el límite mientras tanto.
+    """
+    def request():
+        return gemini_model(gemini_api_key, model_name).generate_content(
+            prompt,
+            generation_config=_generation_config(),
+            request_options={'timeout': timeout},
+            stream=on_chunk is not None
+        )
+
+    if on_chunk is None:
+        with model_limiter(model_name).slot():
+            timing["start"] = time.perf_counter()
+            response = request()
+        return response.text, response
+
+    pending = queue.Queue()
+    abandoned = threading.Event()
+
+    def read_stream():
+        try:
+            with model_limiter(model_name).slot() as waited:
+                pending.put(("started", waited))
+                response = request()
+                for chunk in response:
+                    if abandoned.is_set():
+                        _cancel_stream(response)
+                        return
+                    pending.put(("chunk", chunk))
+            pending.put(("done", response))
+        except Exception as e:
+            pending.put(("error", e))
+
+    threading.Thread(target=bind_session(read_stream), name=f"stream-{model_name}", daemon=True).start()
+    wait = None  # Sin límite mientras se espera el lugar en el límite del modelo
+    try:
+        while True:
+            try:
+                kind, value = pending.get(timeout=wait)
+            except queue.Empty:
+                raise TimeoutError(f"{model_name} no envió el primer fragmento en {first_chunk_timeout} s") from None
+            if kind == "started":
+                add_wait_seconds(value)
+                timing["start"] = time.perf_counter()
+                wait = first_chunk_timeout
+                continue
+            if kind == "error":
+                raise value
+            if kind == "done":
+                return "".join(streamed), value
+            wait = None
+            try:
+                chunk_text = value.text
+            except ValueError: # Fragmento sin texto (ej. solo metadatos de finalización)
+                continue
+            if chunk_text:
+                streamed.append(chunk_text)
+                on_chunk(chunk_text)
+    except BaseException:
+        abandoned.set()
+        raise
+
+def _cancel_stream(response):
+    """Corta una respuesta en streaming abandonada para que deje de generar (y de consumir cuota)."""
+    stream = getattr(response, "_iterator", response)
+    for method_name in ("cancel", "close"):
+        method = getattr(stream, method_name, None)
+        if callable(method):
+            try:
+                method()
+            except Exception:
+                pass
+            return
+
+def _forward_chunk(on_chunk, text):
+    if text:
+        on_chunk(text)
+
+def _store_analysis(analysis_text, json_string_for_prompt, model_name, report_key, prompt_instructions_template, combined_json_data_for_llm):
+    """Guarda el análisis en la caché y, si hay report_key, como último análisis del paciente."""
+    if not analysis_text:
+        return
+    analysis_cache.put(analysis_cache.key(json_string_for_prompt, model_name, prompt_instructions_template), analysis_text, model_name)
+    if report_key:
+        patient_store.put_report(
+            report_key, analysis_text, model_name,
+            prompt_template_version(prompt_instructions_template),
+            covered_record_ids(combined_json_data_for_llm)
+        )
+
+# --- Prompt para Gemini (Instrucciones para el Análisis Clínico) ---
+PROMPT_INSTRUCTIONS_TEMPLATE = """
+Instrucciones Detalladas para la Generación del Análisis Clínico:
+
+Interpretación del JSON:
+Aquí está el JSON con los datos del paciente:
+{json_data_placeholder}
+
+Este JSON contiene tres claves principales: "medical_history", "exam_results" y "lab_results".
+Los campos nulos o vacíos fueron omitidos del JSON: trátalos como "No disponible". Dentro de cada `Records`, el objeto `Patient` solo aparece en el primer registro cuando es igual en todos.
+- Para "medical_history": Analiza el JSON para extraer todos los registros médicos del paciente de `medical_history.Records`. Procesa todos los objetos dentro de ese array.
+- Para "exam_results": Analiza el JSON para extraer los resultados de los exámenes del paciente de `exam_results.Records`.
+- Para "lab_results": Analiza el JSON para extraer los resultados de los laboratorios del paciente de `lab_results.Records`.
+
+Analiza el JSON proporcionado para extraer toda la información relevante.
+Consolidación del Historial Médico y Exámenes:
+
+Reúne toda la información relevante de cada registro para construir un informe completo y cronológico.
+Generación del Análisis Clínico (siguiendo un esquema de referencia tipo PDF):
+El informe final debe estructurarse de la siguiente manera. Si alguna información no está disponible en el JSON para un campo específico del esquema de referencia, indícalo claramente (ej. "No disponible en JSON" o "Dato no suministrado").
+
+A. IDENTIFICACIÓN DEL PACIENTE (Extraer de la sección "medical_history")
+
+Nombre: (Extraer de `medical_history.Records[0].Patient.Name` si `medical_history.Records` existe y no está vacío, o el primer `Patient.Name` que encuentres en `medical_history`. Si no hay datos en `medical_history` pero sí en `exam_results`, usa `exam_results.Records[0].Patient.Name`.)
+Cédula (referencial): (Extraer de `medical_history.Records[0].Patient.CountryID` de forma similar. Si no, de `exam_results`.)
+Número de Atenciones (Consultas Médicas): (Contar el número de registros en `medical_history.Records`. Si `medical_history` o `medical_history.Records` es nulo o vacío, indicar 0 o "No disponible".)
+Fechas de Atenciones (Consultas Médicas): (Listar todas las `Date` de los registros en `medical_history.Records`, formateadas dd/mm/aaaa HH:MM AM/PM. Si es nulo o vacío, indicar "No disponible".)
+Número de Exámenes Registrados: (Contar el número de registros en `exam_results.Records`. Si `exam_results` o `exam_results.Records` es nulo o vacío, indicar 0 o "No disponible".)
+
+B. ANTECEDENTES (Consolidar de todos los registros en `medical_history.Records`, principalmente de `History.Description`. Buscar patrones o información recurrente.)
+
+Personales: (Condiciones médicas preexistentes, alergias, hábitos, etc., de `History.Description` y `Sickness` si es relevante para el historial general).
+Familiares: (Condiciones médicas en la familia del paciente, si se menciona en `History.Description`).
+Quirúrgicos: (Intervenciones quirúrgicas previas, si se mencionan en `History.Description`).
+Ginecológicos: (Si se mencionan en `History.Description`).
+Epidemiológicos/Otros: (Inmunizaciones, exposición a enfermedades, viajes, hábitos específicos como tabaquismo (Tabáquicos), alcohol (OH), ocupación, etc., desde `History.Description`).
+(Si no hay datos en `medical_history.Records` para antecedentes, indicar "No hay información de antecedentes disponible en las historias médicas".)
+
+C. ORGANIZACIÓN CRONOLÓGICA DE DATOS POR EVENTO DE ATENCIÓN (CONSULTA MÉDICA)
+(Para cada registro en `medical_history.Records` dentro del JSON proporcionado):
+
+Consulta [ID del Registro] (Usar el `ID` principal del registro, ej. "Consulta 2750")
+Doctor: (Usar Doctor.Name)
+Especialidad: (Usar Doctor.Specialty)
+Fecha de consulta: (Usar `Date`)
+Motivo de Consulta: (Usar `Reason`)
+Enfermedad Actual / Padecimiento: (Usar `Sickness`. Describir la condición que llevó a la consulta).
+Signos Vitales: (TAS: `VitalSigns.TAS` mmHg, TAD: `VitalSigns.TAD` mmHg, FC: `VitalSigns.FC` x', Peso: `VitalSigns.Weight` Kg, Talla: `VitalSigns.Size` Mts. Indicar "0", "No registrado" o "No aplica" si el valor es 0, null o no es pertinente para la consulta).
+Examen Físico: (Usar `PhysicalExam.Description`. Indicar si está vacío o no aplica. Notar `PhysicalExam.Type`).
+Diagnósticos: (Listar cada diagnóstico de `Diagnostics`: [ID] - [Name]. Si `Diagnostics` es null, vacío, o no aplica, indicar "Sin diagnósticos registrados para este evento" o similar).
+Exámenes Indicados/Realizados (durante la consulta): (Listar cada examen de `Exams`: [ID] - [Name]. Si `Exams` es null, vacío, o no aplica, indicar "Sin exámenes indicados/realizados para este evento").
+Tratamiento(s), Plan de Acción y Comentarios:
+Medicamentos: (Listar cada medicamento de `Medicines`: [Name] ([Generic], [Code]) - Dosis/Presentación: [Presentation] - Indicaciones: [Indications] - Laboratorio: [Laboratory]. Si `Medicines` es null o no aplica, indicar "Sin medicamentos recetados para este evento").
+Indicaciones Generales/Comentarios: (Usar `Comments`. Ejemplo: "Reposo por RestDays días", "Uso de epicondilera 15 días").
+Días de Reposo: (Usar `RestDays` si es > 0).
+(Si no hay datos en `medical_history.Records`, esta sección debe indicar "No hay eventos de atención médica registrados".)
+
+D. GENERACIÓN DE RESUMEN Y ANÁLISIS LONGITUDINAL (Basado en `medical_history.Records`)
+
+Resumen Conciso de la Atención por Evento: (Para cada fecha de atención en `medical_history.Records`, resumir brevemente: ej. "dd/mm/aaaa: Consulta por [Motivo principal]. Diagnóstico(s) principal(es): [Diagnósticos]. Tratamiento principal: [Medicamento/Indicación].")
+Análisis Longitudinal de Hallazgos Positivos y Negativos:
+Condiciones Clínicas Persistentes/Recurrentes: (Identificar condiciones que aparecen en múltiples registros o que se mencionan como crónicas en los antecedentes).
+Evolución de Diagnósticos: (Cómo han cambiado, se han resuelto o se han añadido diagnósticos con el tiempo).
+Tendencias en Signos Vitales: (Si hay suficientes datos, comentar tendencias en peso, TAS/TAD, etc.).
+Respuesta a Tratamientos (si se puede inferir): (Mencionar si se observa mejoría, recurrencia a pesar del tratamiento, o efectos secundarios, basado en `Comments` o consultas subsecuentes).
+Patrones Notables: (Cualquier otro patrón observado: tipos de medicamentos frecuentemente recetados, necesidad de múltiples consultas para un mismo problema, adherencia (si se infiere), etc.).
+Alertas y Recomendaciones (basadas en el análisis de `medical_history`): (Conclusión general sobre el estado de salud del paciente según las consultas, posibles riesgos identificados, y si se desprenden recomendaciones generales del análisis consolidado de las consultas).
+(Si no hay datos en `medical_history.Records`, esta sección debe indicar "No es posible realizar análisis longitudinal sin historial de consultas médicas".)
+
+E. RESULTADOS DE EXÁMENES COMPLEMENTARIOS (Estudios y Laboratorios)
+(Basado en `exam_results.Records`. Si `exam_results` o `exam_results.Records` es nulo o vacío, indicar "No hay resultados de exámenes disponibles".)
+(Basado en `lab_results.Records`. Si `lab_results` o `lab_results.Records` es nulo o vacío, indicar "No hay resultados de laboratorios disponibles".)
+
+Para cada tipo de examen (agrupado por `ExamType.Type`) presente en `exam_results.Records`:
+Presenta la información agrupada por el `ExamType.Type`. Para cada examen dentro de ese tipo:
+
+[NOMBRE DEL TIPO DE EXAMEN - Ej: ULTRASONIDO PARTES BLANDAS]
+  - Fecha del Examen: (Extraer de `Date`, formateada dd/mm/aaaa)
+  - ID del Examen (referencial): (Extraer de `ID`)
+  - Código del Examen (referencial): (Extraer de `ExamType.Code`)
+  - Unidad (referencial): (Extraer de `ExamType.Unit`)
+  - Hallazgos Principales: (Analizar el contenido de `ExamResults`. Este campo contiene el texto del informe (el HTML original ya fue convertido a texto). Resume los hallazgos clave y la conclusión si está presente. Si el contenido es muy extenso, enfócate en la sección de conclusión o hallazgos principales. Sé conciso y claro.)
+
+Ejemplo de cómo debería verse esta sección E: para el caso de Examenes
+
+E. RESULTADOS DE EXÁMENES COMPLEMENTARIOS (Estudios y Laboratorios)
+
+ULTRASONIDO PARTES BLANDAS
+  - Fecha del Examen: 19/01/2024
+  - ID del Examen: 6681
+  - Código del Examen: ULT0516JS
+  - Unidad: Ultrasonido
+  - Hallazgos Principales: Exploración región base del pene. Visualización de capas en piel, musculares y tejido adiposo sin alteraciones. Se evidencia L.O.E., redondeada, mixta, a predominio líquido, con grumos, de 4 x 6 mm, en plano superficial. No se observa neoformación vascular. Conclusión: Signos ecográficos sugerentes de absceso en recidiva.
+
+Ejemplo de cómo debería verse esta sección E: para el caso de Laboratorio
+  - Fecha del Examen: 19/01/2025
+  - ID del Laboratorio: 6681
+  - UROANALISIS 
+        . EX. ORINA COMPLETA 
+            -> EX. MACROSCOPICO 
+                    [COLOR] : Amarillo (Unidad si se tiene)
+                    [CANTIDAD] : Escasas (Unidad si se tiene)
+
+No incluyas una tabla de los laboratorios a través del tiempo: la aplicación la genera por separado a partir de los mismos datos.
+
+Formato de Salida:
+El resultado debe ser un texto bien estructurado claro y profesional, emulando la formalidad y detalle de un resumen clínico. No incluyas esta sección de "Instrucciones" en la salida final, solo el análisis clínico.
+
+Nota Importante:
+La información del paciente es sensible. El análisis debe centrarse en los datos clínicos y evitar juicios o información no pertinente. Asegúrate de manejar correctamente los casos donde los datos (`medical_history`, `exam_results` o sus `Records`) puedan ser nulos o vacíos, indicando "No disponible" o una frase similar en lugar de generar un error.
+"""
+
+def build_llm_payload(kpi_data, exam_data, lab_data):
+    """Arma el JSON combinado para el LLM a partir de los KpiRecordSet de cada fuente.
+
+    Devuelve None si ninguna de las tres fuentes trae 'data.kpis'.
+    """
+    sources = (
+        ("medical_history", kpi_data, "La estructura del JSON de HMs no contiene 'data.kpis'. Las HMs no se incluirán en el análisis si la estructura es incorrecta."),
+        ("exam_results", exam_data, "La estructura del JSON de Exámenes no contiene 'data.kpis'. Los exámenes no se incluirán en el análisis si la estructura es incorrecta."),
+        ("lab_results", lab_data, "La estructura del JSON de Laboratorios no contiene 'data.kpis'. Los Laboratorios no se incluirán en el análisis si la estructura es incorrecta."),
+    )
+    combined_data_for_llm = {}
+    for payload_key, raw_data, missing_warning in sources:
+        kpis = None
+        if raw_data:
+            kpis = raw_data.kpis()
+            if not kpis:
+                show_message("warning", missing_warning)
+        combined_data_for_llm[payload_key] = kpis # Puede ser None
+
+    if not any(combined_data_for_llm.values()):
+        return None
+    return combined_data_for_llm
+
+# --- Compactación del payload para el LLM ---
+CHARS_PER_TOKEN_ESTIMATE = 4   # Aproximación (caracteres o bytes por token) para reportar ahorro sin llamar a count_tokens
+
+def serialize_llm_payload(combined_json_data_for_llm):
+    """Serializa el payload para el prompt sin espacios de indentación."""
+    return json.dumps(combined_json_data_for_llm, separators=(",", ":"), ensure_ascii=False)
+
+def compact_llm_payload(combined_json_data_for_llm, response_bytes=None):
+    """Prepara el JSON combinado para el prompt y mide lo que ahorra frente a las respuestas crudas.
+
+    Los registros ya llegan compactados desde kpi_records (HTML a texto, sin
+    vacíos ni duplicados) y no se vuelven a limpiar: el texto que salió de un
+    HTML (ej. "&lt;normal 12-16&gt;") se volvería a leer como HTML y se perdería.
+    response_bytes es el tamaño de las respuestas KPI crudas de las que salieron
+    los datos (ver raw_response_bytes). Devuelve (payload, estadísticas): bytes
+    crudos y enviados y, si se conocen los crudos, el ahorro y los tokens estimados.
+    """
+    compacted = {
+        payload_key: kpis or None
+        for payload_key, kpis in combined_json_data_for_llm.items()
+    }
+    compact_bytes = len(serialize_llm_payload(compacted).encode("utf-8"))
+    stats = {
+        "original_bytes": response_bytes,
+        "compact_bytes": compact_bytes,
+        "estimated_tokens_saved": None,
+        "saved_ratio": None,
+    }
+    if response_bytes:
+        stats["estimated_tokens_saved"] = max(0, response_bytes - compact_bytes) // CHARS_PER_TOKEN_ESTIMATE
+        stats["saved_ratio"] = 1 - compact_bytes / response_bytes
+    return compacted, stats
+
+def raw_response_bytes(*record_sets):
+    """Bytes de las respuestas crudas de los KpiRecordSet dados (se omiten los None); None si falta alguno."""
+    sizes = [record_set.response_bytes for record_set in record_sets if record_set is not None]
+    if not sizes or any(size is None for size in sizes):
+        return None
+    return sum(sizes)
+
+# --- Análisis por lotes (map-reduce) para historiales extensos ---
+PAYLOAD_SECTION_NAMES = {
+    "medical_history": "Historias Médicas (medical_history)",
+    "exam_results": "Resultados de Exámenes (exam_results)",
+    "lab_results": "Resultados de Laboratorio (lab_results)",
+}
+
+MAP_FIELDS_BY_SECTION = {
+    "medical_history": "ID, Date, Doctor.Name, Doctor.Specialty, Reason, Sickness, VitalSigns (TAS, TAD, FC, Weight, Size), PhysicalExam, Diagnostics (ID - Name), Exams (ID - Name), Medicines (Name, Generic, Code, Presentation, Indications, Laboratory), Comments, RestDays y los antecedentes de History.Description",
+    "exam_results": "ID, Date, ExamType.Type, ExamType.Code, ExamType.Unit y los hallazgos principales y la conclusión de ExamResults",
+    "lab_results": "ID, Date y, sin resumir, cada resultado de LabResults con ExamType, Exam, Section, Item, Value y Unit",
+}
+
+MAP_PROMPT_TEMPLATE = """
+Eres un asistente clínico. A continuación tienes el lote {batch_number} de {batch_count} de los registros de {section_name} de un paciente, en JSON.
+Para cada registro, en orden cronológico, extrae de forma concisa: {fields}.
+No omitas registros ni inventes datos; si un campo no está, no lo menciones. Responde solo con el resumen, sin introducción.
+
+{json_data_placeholder}
+"""
+
+def _chunk_records(records, chunk_tokens):
+    """Divide una lista de registros en lotes de tamaño estimado <= chunk_tokens."""
+    chunks, current, current_chars = [], [], 0
+    chunk_chars = chunk_tokens * CHARS_PER_TOKEN_ESTIMATE
+    for record in records:
+        record_chars = len(serialize_llm_payload(record))
+        if current and current_chars + record_chars > chunk_chars:
+            chunks.append(current)
+            current, current_chars = [], 0
+        current.append(record)
+        current_chars += record_chars
+    if current:
+        chunks.append(current)
+    return chunks
+
+def _payload_record_count(combined_json_data_for_llm):
+    """Cantidad total de registros del payload (para elegir el modelo)."""
+    return sum(
+        len((combined_json_data_for_llm.get(payload_key) or {}).get("Records") or [])
+        for payload_key in PAYLOAD_SECTION_NAMES
+    )
+
+def _payload_overview(combined_json_data_for_llm):
+    """Conteos y fechas calculados en Python para la sección A del informe."""
+    lines = []
+    for payload_key, section_name in PAYLOAD_SECTION_NAMES.items():
+        records = (combined_json_data_for_llm.get(payload_key) or {}).get("Records") or []
+        lines.append(f"- {section_name}: {len(records)} registros.")
+        if payload_key == "medical_history" and records:
+            dates = ", ".join(str(record.get("Date", "")) for record in records if isinstance(record, dict))
+            lines.append(f"  Fechas de atención: {dates}")
+        if records and isinstance(records[0], dict) and records[0].get("Patient"):
+            lines.append(f"  Paciente: {serialize_llm_payload(records[0]['Patient'])}")
+    return "\n".join(lines)
+
+def _map_reduce_prompt(model, model_name, combined_json_data_for_llm, prompt_instructions_template, token_budget):
+    """Resume los registros por lotes en paralelo y devuelve el prompt final con los resúmenes.
+
+    Devuelve None si algún lote falla, para no generar un informe incompleto.
+    """
+    chunk_tokens = min(MAP_CHUNK_TOKENS, token_budget)
+    map_prompts = []
+    for payload_key, section_name in PAYLOAD_SECTION_NAMES.items():
+        records = (combined_json_data_for_llm.get(payload_key) or {}).get("Records") or []
+        chunks = _chunk_records(records, chunk_tokens)
+        for batch_number, chunk in enumerate(chunks, start=1):
+            map_prompts.append((section_name, batch_number, len(chunks), MAP_PROMPT_TEMPLATE.format(
+                batch_number=batch_number,
+                batch_count=len(chunks),
+                section_name=section_name,
+                fields=MAP_FIELDS_BY_SECTION[payload_key],
+                json_data_placeholder=serialize_llm_payload(chunk),
+            )))
+
+    def summarise(map_prompt):
+        with model_limiter(model_name).slot():
+            response = model.generate_content(
+                map_prompt,
+                generation_config=_generation_config(),
+                request_options={'timeout': 600}
+            )
+        return response.text
+
+    show_message("caption", f"Resumiendo {len(map_prompts)} lotes de registros en paralelo...")
+    executor = ThreadPoolExecutor(max_workers=MAP_REDUCE_WORKERS)
+    try:
+        futures = [executor.submit(bind_messages(bind_session(summarise)), map_prompt) for _, _, _, map_prompt in map_prompts]
+        summaries = []
+        for (section_name, batch_number, batch_count, _), future in zip(map_prompts, futures):
+            try:
+                summaries.append(f"### {section_name} — lote {batch_number} de {batch_count}\n{future.result()}")
+            except Exception as e:
+                show_message("error", f"Falló el resumen del lote {batch_number} de {section_name}: {e}")
+                # Los lotes aún no iniciados se cancelan; no se espera a los que están en curso
+                executor.shutdown(wait=False, cancel_futures=True)
+                return None
+    finally:
+        executor.shutdown(wait=False)
+
+    reduced_data = (
+        "(El historial del paciente es extenso: sus registros se resumieron por lotes. "
+        "Usa estos resúmenes como fuente de datos en lugar del JSON; los conteos y fechas de abajo son exactos.)\n\n"
+        f"{_payload_overview(combined_json_data_for_llm)}\n\n" + "\n\n".join(summaries)
+    )
+    return prompt_instructions_template.replace("{json_data_placeholder}", reduced_data)
+
+# --- Generación por secciones en paralelo ---
+# (secciones del informe, claves del payload que necesitan); A también recibe los conteos y fechas de _payload_overview
+REPORT_SECTIONS = (
+    (("A", "B"), ("medical_history",)),
+    (("C",), ("medical_history",)),
+    (("D",), ("medical_history",)),
+    (("E",), ("exam_results", "lab_results")),
+)
+
+SECTION_PROMPT_TEMPLATE = """{introduction}
+El JSON de arriba incluye solo los datos que necesitan las secciones pedidas.
+{overview}
+Genera ÚNICAMENTE las siguientes secciones del informe, con sus títulos tal como aparecen; las demás secciones se generan por separado, así que no agregues introducción, otras secciones ni conclusión general:
+
+{sections}
+{closing}"""
+
+@lru_cache(maxsize=8)
+def _split_prompt_template(prompt_instructions_template):
+    """Divide la plantilla en (introducción, {letra: instrucciones de la sección}, cierre).
+
+    Devuelve None si la plantilla no tiene secciones A-E o el bloque "Formato de Salida:".
+    """
+    closing_start = prompt_instructions_template.find("Formato de Salida:")
+    starts = {}
+    for match in re.finditer(r"^([A-E])\. [A-ZÁÉÍÓÚÑ]", prompt_instructions_template, re.M):
+        starts.setdefault(match.group(1), match.start())
+    if closing_start < 0 or not starts:
+        return None
+    boundaries = sorted(starts.values()) + [closing_start]
+    sections = {
+        letter: prompt_instructions_template[start:boundaries[boundaries.index(start) + 1]].strip()
+        for letter, start in starts.items()
+    }
+    introduction = prompt_instructions_template[:boundaries[0]]
+    return introduction, sections, prompt_instructions_template[closing_start:]
+
+def _section_prompts(combined_json_data_for_llm, prompt_instructions_template):
+    """[(secciones, prompt)] de REPORT_SECTIONS presentes en la plantilla, cada uno con su parte del payload.
+
+    None si la plantilla no se puede dividir.
+    """
+    template_parts = _split_prompt_template(prompt_instructions_template)
+    if template_parts is None:
+        return None
+    introduction, sections, closing = template_parts
+    prompts = []
+    for letters, payload_keys in REPORT_SECTIONS:
+        letters = tuple(letter for letter in letters if letter in sections)
+        if not letters:
+            continue
+        section_payload = {payload_key: combined_json_data_for_llm.get(payload_key) for payload_key in payload_keys}
+        prompts.append((letters, SECTION_PROMPT_TEMPLATE.format(
+            introduction=introduction.replace("{json_data_placeholder}", serialize_llm_payload(section_payload)),
+            overview=f"Conteos y fechas calculados a partir de todos los datos del paciente (son exactos):\n{_payload_overview(combined_json_data_for_llm)}\n" if "A" in letters else "",
+            sections="\n\n".join(sections[letter] for letter in letters),
+            closing=closing,
+        )))
+    return prompts
+
+# --- Secciones armadas sin LLM (report_templates) ---
+TEMPLATED_SECTIONS_NOTE = """Las secciones {letters} del informe se arman aparte a partir de los mismos datos: no las generes. Genera solo las secciones de abajo y escribe cada título en una línea propia, como "### B. ANTECEDENTES".
+
+"""
+
+@lru_cache(maxsize=8)
+def _llm_only_template(prompt_instructions_template):
+    """La plantilla sin las instrucciones de TEMPLATED_SECTIONS; None si no tiene las secciones A a E."""
+    template_parts = _split_prompt_template(prompt_instructions_template)
+    if template_parts is None or sorted(template_parts[1]) != list("ABCDE"):
+        return None
+    introduction, sections, closing = template_parts
+    return (
+        introduction
+        + TEMPLATED_SECTIONS_NOTE.format(letters=" y ".join(sorted(TEMPLATED_SECTIONS)))
+        + "\n\n".join(text for letter, text in sorted(sections.items()) if letter not in TEMPLATED_SECTIONS)
+        + "\n\n" + closing
+    )
+
+def _interleave_sections(section_prompts, rendered_sections, on_section):
+    """on_section para la generación por secciones con secciones armadas.
+
+    Entrega enseguida las armadas y ubica las del LLM en el orden del informe.
+    """
+    layout = sorted([(letters[0], index) for index, (letters, _) in enumerate(section_prompts)] + [(letter, letter) for letter in rendered_sections])
+    positions = {key: position for position, (_, key) in enumerate(layout)}
+    for letter, text in rendered_sections.items():
+        on_section(positions[letter], len(layout), text)
+    return lambda index, _, text: on_section(positions[index], len(layout), text)
+
+def _generate_sections(gemini_api_key, models, section_prompts, on_section=None):
+    """Genera las secciones en paralelo y las une en orden.
+
+    Devuelve (texto, tokens de respuesta, modelos usados, mayor espera en el límite del modelo).
+    """
+    def generate(section_prompt):
+        wait_start = last_wait_seconds()
+        text, response, used_model = _generate_with_fallback(gemini_api_key, models, section_prompt, len(section_prompt) // CHARS_PER_TOKEN_ESTIMATE)
+        return text.strip(), _response_tokens(response), used_model, last_wait_seconds() - wait_start
+
+    texts = [None] * len(section_prompts)
+    response_tokens = 0
+    used_models = set()
+    wait_seconds = 0.0
+    executor = ThreadPoolExecutor(max_workers=len(section_prompts))
+    try:
+        futures = {executor.submit(bind_messages(bind_session(generate)), section_prompt): index for index, section_prompt in enumerate(section_prompts)}
+        for future in as_completed(futures):
+            index = futures[future]
+            texts[index], section_tokens, used_model, section_wait = future.result()
+            used_models.add(used_model)
+            wait_seconds = max(wait_seconds, section_wait)
+            response_tokens = None if response_tokens is None or section_tokens is None else response_tokens + section_tokens
+            if on_section is not None:
+                on_section(index, len(section_prompts), texts[index])
+    except BaseException:
+        # Una sección fallida o un on_section que corta (trabajo cancelado) no espera a las demás
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+    return "\n\n".join(texts), response_tokens, used_models, wait_seconds
+
+# --- Análisis incremental (solo registros nuevos) ---
+DELTA_DATA_TEMPLATE = """(Análisis incremental: ya existe un informe previo del paciente, generado el {previous_date}. Abajo están ese informe y SOLO los registros nuevos que no cubría.
+Genera el informe completo y actualizado con la misma estructura: conserva el contenido del informe previo, incorpora los registros nuevos en cada sección (en orden cronológico) y actualiza los análisis, tendencias y conclusiones. Los conteos y fechas de abajo son los totales exactos del paciente.)
+
+{overview}
+
+INFORME PREVIO:
+{previous_report}
+
+REGISTROS NUEVOS (JSON):
+{new_records_json}"""
+
+def _record_key(record):
+    """Clave de un registro: su ID (si lo trae) y un hash del contenido, para que un registro editado no pase por cubierto."""
+    content_hash = hashlib.sha256(serialize_llm_payload(record).encode("utf-8")).hexdigest()[:16]
+    if isinstance(record, dict) and record.get("ID") not in (None, ""):
+        return f"{record['ID']}:{content_hash}"
+    return content_hash
+
+def covered_record_ids(combined_json_data_for_llm):
+    """Claves (ID y hash del contenido) de los registros por sección del payload: {sección: [claves]}."""
+    return {
+        payload_key: [_record_key(record) for record in (kpis.get("Records") or [])]
+        for payload_key, kpis in combined_json_data_for_llm.items()
+        if isinstance(kpis, dict)
+    }
+
+def split_new_records(combined_json_data_for_llm, covered):
+    """Devuelve (payload solo con registros nuevos, cantidad de registros nuevos).
+
+    Si algún registro cubierto por el informe previo ya no está en los datos o
+    cambió su contenido, el informe previo dejó de ser válido y se devuelve
+    (None, 0) para reconstruirlo. Los informes guardados con solo los IDs (sin
+    hash) tampoco coinciden y se reconstruyen una vez.
+    """
+    delta_payload, new_records = {}, 0
+    for payload_key, kpis in combined_json_data_for_llm.items():
+        covered_keys = set(covered.get(payload_key) or [])
+        if not isinstance(kpis, dict):
+            if covered_keys:
+                return None, 0
+            delta_payload[payload_key] = kpis
+            continue
+        records = kpis.get("Records") or []
+        record_keys = [_record_key(record) for record in records]
+        if not covered_keys <= set(record_keys):
+            return None, 0
+        new_section_records = [record for record, record_key in zip(records, record_keys) if record_key not in covered_keys]
+        new_records += len(new_section_records)
+        delta_payload[payload_key] = dict(kpis, Records=new_section_records)
+    return delta_payload, new_records
+
+def _delta_prompt(combined_json_data_for_llm, delta_payload, previous_report, prompt_instructions_template):
+    """Prompt de actualización: informe previo + registros nuevos, con las instrucciones originales."""
+    delta_data = DELTA_DATA_TEMPLATE.format(
+        previous_date=previous_report["created_at"],
+        overview=_payload_overview(combined_json_data_for_llm),
+        previous_report=previous_report["text"],
+        new_records_json=serialize_llm_payload(delta_payload),
+    )
+    return prompt_instructions_template.replace("{json_data_placeholder}", delta_data)
@@ -0,0 +1,180 @@
+"""Límites de concurrencia y de ritmo por entorno CRM y por modelo Gemini, con cola justa entre sesiones.
+
+Los límites son del proceso: todas las sesiones de Streamlit comparten los de
+cada entorno y cada modelo. Los turnos se reparten por rondas entre sesiones,
+así que un operador con muchas llamadas en cola no bloquea a los demás.
+"""
+import collections
+import contextlib
+import os
+import threading
+import time
+
+CRM_MAX_CONCURRENT_DEFAULT = 8     # Peticiones simultáneas a un CRM (configurable por entorno con max_concurrent_requests)
+CRM_MAX_PER_MINUTE_DEFAULT = 0     # Peticiones por minuto a un CRM; 0 = sin límite (max_requests_per_minute)
+GEMINI_MAX_CONCURRENT_DEFAULT = int(os.environ.get("SUGOS_GEMINI_MAX_CONCURRENT", "4"))  # Llamadas simultáneas por modelo
+WAIT_HISTORY = 200                 # Esperas recientes usadas para el promedio de cada límite
+
+def _parse_model_limits(value):
+    """"modelo=concurrentes[:por minuto],..." -> {modelo: (concurrentes, por minuto)}."""
+    limits = {}
+    for item in (value or "").split(","):
+        model_name, _, limit = item.strip().partition("=")
+        if not model_name or not limit:
+            continue
+        max_concurrent, _, per_minute = limit.partition(":")
+        try:
+            limits[model_name] = (int(max_concurrent), float(per_minute or 0))
+        except ValueError:
+            continue
+    return limits
+
+# Límites por modelo, ej. SUGOS_GEMINI_LIMITS="gemini-2.5-pro=2:30,gemini-2.5-flash-lite-preview-06-17=6"
+MODEL_LIMITS = _parse_model_limits(os.environ.get("SUGOS_GEMINI_LIMITS"))
+
+# Sesión (operador) del hilo actual, para repartir los turnos
+_session_state = threading.local()
+
+def current_session():
+    return getattr(_session_state, "session", None)
+
+def set_session(session):
+    """Asocia las llamadas siguientes del hilo actual a session (ej. el id de la sesión de Streamlit)."""
+    _session_state.session = session
+
+def bind_session(func):
+    """func ejecutada con la sesión del hilo actual, para pasarla a hilos de trabajo."""
+    session = current_session()
+
+    def bound(*args, **kwargs):
+        previous = current_session()
+        set_session(session)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            set_session(previous)
+    return bound
+
+def last_wait_seconds():
+    """Espera acumulada en los límites por el hilo actual (para medir la de un bloque por diferencia)."""
+    return getattr(_session_state, "wait_seconds", 0.0)
+
+def add_wait_seconds(seconds):
+    """Suma a last_wait_seconds una espera hecha por otro hilo en nombre del actual."""
+    _session_state.wait_seconds = last_wait_seconds() + seconds
+
+class FairLimiter:
+    """A lo sumo max_concurrent llamadas a la vez y, si per_minute > 0, a lo sumo per_minute por minuto.
+
+    Las llamadas en espera se atienden por rondas entre sesiones y en orden de
+    llegada dentro de cada sesión. Es reentrante: un bloque anidado en el mismo
+    hilo no ocupa otro lugar ni espera al que ya ocupa.
+    """
+
+    def __init__(self, name, max_concurrent, per_minute=0):
+        self.name = name
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.per_minute = float(per_minute or 0)
+        self._queues = collections.OrderedDict()  # sesión -> deque de turnos; la primera es la siguiente en la ronda
+        self._active = 0
+        self._next_start = 0.0
+        self._calls = 0
+        self._waits = collections.deque(maxlen=WAIT_HISTORY)
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self, session=None):
+        """Bloque que ocupa un lugar del límite; entrega los segundos que se esperó."""
+        held = getattr(_session_state, "held", None)
+        if held is None:
+            held = _session_state.held = set()  # Límites que el hilo actual ya ocupa
+        if self in held:
+            yield 0.0
+            return
+        waited = self._acquire(current_session() if session is None else session)
+        _session_state.wait_seconds = last_wait_seconds() + waited
+        held.add(self)
+        try:
+            yield waited
+        finally:
+            held.discard(self)
+            with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    def stats(self):
+        """{"name", "active", "queued", "max_concurrent", "per_minute", "calls", "mean_wait_seconds", "max_wait_seconds"}."""
+        with self._condition:
+            waits = list(self._waits)
+            return {
+                "name": self.name,
+                "active": self._active,
+                "queued": sum(len(queue) for queue in self._queues.values()),
+                "max_concurrent": self.max_concurrent,
+                "per_minute": self.per_minute,
+                "calls": self._calls,
+                "mean_wait_seconds": sum(waits) / len(waits) if waits else None,
+                "max_wait_seconds": max(waits) if waits else None,
+            }
+
+    def _acquire(self, session):
+        turn = object()
+        start_time = time.monotonic()
+        with self._condition:
+            self._queues.setdefault(session, collections.deque()).append(turn)
+            while True:
+                if self._active < self.max_concurrent and next(iter(self._queues.values()))[0] is turn:
+                    delay = self._next_start - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                else:
+                    self._condition.wait()
+            # La sesión atendida pasa al final de la ronda si le quedan turnos
+            queue = self._queues.pop(session)
+            queue.popleft()
+            if queue:
+                self._queues[session] = queue
+            self._active += 1
+            self._calls += 1
+            if self.per_minute > 0:
+                self._next_start = max(time.monotonic(), self._next_start) + 60 / self.per_minute
+            waited = time.monotonic() - start_time
+            self._waits.append(waited)
+            self._condition.notify_all()
+        return waited
+
+_limiters = {}  # (tipo, clave) -> FairLimiter
+_limiters_lock = threading.Lock()
+
+def _limiter(key, name, max_concurrent, per_minute):
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = FairLimiter(name, max_concurrent, per_minute)
+        else:
+            # Cambios en secrets.toml o en MODEL_LIMITS se aplican a las llamadas siguientes
+            with limiter._condition:
+                limiter.max_concurrent, limiter.per_minute = max(1, int(max_concurrent)), float(per_minute or 0)
+                limiter._condition.notify_all()
+        return limiter
+
+def environment_limiter(config):
+    """Límite de las peticiones (login y KPI) al CRM del entorno."""
+    return _limiter(
+        ("crm", config.get('api_base_url')),
+        f"CRM {config.get('display_name') or config.get('api_base_url')}",
+        config.get("max_concurrent_requests", CRM_MAX_CONCURRENT_DEFAULT),
+        config.get("max_requests_per_minute", CRM_MAX_PER_MINUTE_DEFAULT),
+    )
+
+def model_limiter(model_name):
+    """Límite de las llamadas de generación a model_name."""
+    max_concurrent, per_minute = MODEL_LIMITS.get(model_name, (GEMINI_MAX_CONCURRENT_DEFAULT, 0))
+    return _limiter(("gemini", model_name), f"Gemini {model_name}", max_concurrent, per_minute)
+
+def limiter_stats():
+    """stats() de cada límite creado hasta ahora."""
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return [limiter.stats() for limiter in limiters]
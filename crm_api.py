@@ -0,0 +1,574 @@
+"""Cliente de la API del CRM SUGOS (autenticación y consultas KPI)."""
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urljoin, urlencode
+import json
+import time
+import base64
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from concurrency_limits import bind_session, environment_limiter
+from kpi_records import KpiResponseDecoder
+from patient_store import patient_store
+from ui_messages import show_message, call_collecting_messages
+
+# --- Sesiones HTTP compartidas por entorno ---
+# Valores por defecto; cada entorno de secrets.toml puede sobrescribirlos
+# con las mismas claves en minúsculas (ej. http_pool_maxsize = 20).
+HTTP_DEFAULTS = {
+    "http_pool_maxsize": 10,        # Conexiones keep-alive máximas por host
+    "http_connect_timeout": 10,     # Segundos para establecer la conexión
+    "http_login_read_timeout": 30,  # Segundos de lectura para el login
+    "http_kpi_read_timeout": 60,    # Segundos de lectura para las consultas KPI
+    "http_retry_total": 3,          # Reintentos de las consultas KPI (GET idempotentes)
+    "http_retry_backoff": 0.5,      # Backoff exponencial: 0.5s, 1s, 2s...
+    "http_kpi_max_response_bytes": 50 * 1024 * 1024,  # Tamaño máximo de una respuesta KPI; se corta la descarga al superarlo
+}
+HTTP_RETRY_STATUS = (429, 502, 503, 504)
+
+# Una sesión por api_base_url, compartida entre reruns y sesiones de Streamlit
+# porque este módulo se importa una sola vez por proceso.
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+def _http_setting(config, name):
+    """Lee un parámetro HTTP del entorno o su valor por defecto."""
+    value = config.get(name)
+    return HTTP_DEFAULTS[name] if value is None else value
+
+def _http_timeout(config, read_setting):
+    """Devuelve la tupla (connect, read) de timeouts para requests."""
+    return (_http_setting(config, "http_connect_timeout"), _http_setting(config, read_setting))
+
+def get_http_session(config):
+    """Devuelve la sesión HTTP keep-alive del entorno, creándola la primera vez."""
+    api_base_url = config.get('api_base_url')
+    with _http_sessions_lock:
+        session = _http_sessions.get(api_base_url)
+        if session is None:
+            pool_maxsize = int(_http_setting(config, "http_pool_maxsize"))
+            # Solo se reintentan métodos idempotentes (GET de KPIs); el login (POST)
+            # solo se reintenta ante fallos de conexión, antes de enviar la petición.
+            retry = Retry(
+                total=int(_http_setting(config, "http_retry_total")),
+                backoff_factor=float(_http_setting(config, "http_retry_backoff")),
+                status_forcelist=HTTP_RETRY_STATUS,
+                allowed_methods=frozenset({"GET"}),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, pool_block=True, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            # La sesión la comparten todos los operadores: no se guardan cookies entre peticiones.
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            _http_sessions[api_base_url] = session
+        return session
+
+# --- Caché de tokens de autenticación ---
+TOKEN_TTL_DEFAULT = 900        # Segundos de vida si el login no informa la expiración (configurable con token_ttl)
+TOKEN_EXPIRY_MARGIN = 30       # Se renueva el token un poco antes de que expire
+
+# (api_base_url, usuario, hash de la contraseña) -> {"token", "expires_at"}; la contraseña no se guarda
+_token_cache = {}
+_token_cache_lock = threading.Lock()
+_token_key_locks = {}
+
+class ApiToken(str):
+    """Token de la API que sabe re-autenticarse ante un 401.
+
+    Guarda la clave de la caché (con el hash de la contraseña) y relogin, una
+    función sin argumentos que repite el login; la contraseña no queda en ningún
+    atributo del token ni de la caché.
+    """
+
+    def __new__(cls, token, cache_key, relogin):
+        api_token = super().__new__(cls, token)
+        api_token.cache_key = cache_key
+        api_token.relogin = relogin
+        return api_token
+
+def _relogin(api_username, api_password, config):
+    """Función sin argumentos que autentica con estas credenciales; devuelve (token, expiración) como _login."""
+    def relogin():
+        return _login(api_username, api_password, config)
+    return relogin
+
+def _token_cache_key(api_username, api_password, config):
+    """Clave del token: entorno, usuario y hash de la contraseña (una contraseña errónea no reutiliza tokens)."""
+    password_hash = hashlib.sha256(str(api_password).encode("utf-8")).hexdigest()
+    return (config.get('api_base_url'), api_username, password_hash)
+
+def _token_key_lock(key):
+    """Lock por clave para que logins concurrentes del mismo usuario se hagan una sola vez."""
+    with _token_cache_lock:
+        return _token_key_locks.setdefault(key, threading.Lock())
+
+def _jwt_expiry(token):
+    """Devuelve el claim 'exp' si el token es un JWT, o None."""
+    parts = str(token).split(".")
+    if len(parts) != 3:
+        return None
+    try:
+        claims = json.loads(base64.urlsafe_b64decode(parts[1] + "=" * (-len(parts[1]) % 4)))
+        return float(claims["exp"])
+    except Exception:
+        return None
+
+def _token_expiry(login_data, token, config):
+    """Calcula el instante (epoch) de expiración del token a partir de la respuesta de login."""
+    now = time.time()
+    nested = login_data.get("data") if isinstance(login_data.get("data"), dict) else {}
+    for source in (login_data, nested):
+        try:
+            if source.get("expires_in"):
+                return now + float(source["expires_in"])
+            for key in ("expires_at", "exp"):
+                if source.get(key):
+                    return float(source[key])
+        except (TypeError, ValueError):
+            pass
+    jwt_exp = _jwt_expiry(token)
+    if jwt_exp:
+        return jwt_exp
+    ttl = config.get("token_ttl")
+    return now + float(TOKEN_TTL_DEFAULT if ttl is None else ttl)
+
+# Origen ('cache' o 'api') del último token entregado en el hilo actual
+_token_fetch_state = threading.local()
+
+def last_token_source():
+    """Origen ('cache' o 'api') del último token obtenido con get_api_token en el hilo actual."""
+    return getattr(_token_fetch_state, "source", None)
+
+def _valid_token(key):
+    """Token vigente de la caché para la clave, o None."""
+    with _token_cache_lock:
+        entry = _token_cache.get(key)
+    if entry and entry["expires_at"] - TOKEN_EXPIRY_MARGIN > time.time():
+        return entry["token"]
+    return None
+
+def get_api_token(api_username, api_password, config):
+    """Devuelve un ApiToken de la API, reutilizando el de caché mientras no haya expirado."""
+    key = _token_cache_key(api_username, api_password, config)
+    relogin = _relogin(api_username, api_password, config)
+    with _token_key_lock(key):
+        token = _valid_token(key)
+        if token:
+            _token_fetch_state.source = "cache"
+            return ApiToken(token, key, relogin)
+        _token_fetch_state.source = "api"
+        return _login_and_cache(key, relogin)
+
+def refresh_api_token(expired_token, config):
+    """Renueva un token rechazado (401) con el relogin del ApiToken.
+
+    Si otro hilo ya lo renovó, devuelve el token nuevo sin volver a autenticar.
+    Devuelve None si el token no es un ApiToken (no sabe re-autenticarse).
+    """
+    key, relogin = getattr(expired_token, "cache_key", None), getattr(expired_token, "relogin", None)
+    if key is None or relogin is None:
+        return None
+    with _token_key_lock(key):
+        token = _valid_token(key)
+        if token and token != expired_token:
+            return ApiToken(token, key, relogin)
+        return _login_and_cache(key, relogin)
+
+def _login_and_cache(key, relogin):
+    """Autentica y guarda el token en caché (o descarta la entrada si el login falla); desaloja los vencidos."""
+    token, expires_at = relogin()
+    with _token_cache_lock:
+        now = time.time()
+        for expired_key in [cache_key for cache_key, entry in _token_cache.items() if entry["expires_at"] <= now]:
+            del _token_cache[expired_key]
+            lock = _token_key_locks.get(expired_key)
+            if lock is not None and not lock.locked():
+                del _token_key_locks[expired_key]
+        if token:
+            _token_cache[key] = {"token": token, "expires_at": expires_at}
+        else:
+            _token_cache.pop(key, None)
+    return ApiToken(token, key, relogin) if token else None
+
+def _login(api_username, api_password, config):
+    """Autentica contra la API. Devuelve (token, expiración epoch) o (None, None)."""
+    api_base_url = config.get('api_base_url')
+    if not api_base_url:
+        show_message("error", "Error: 'api_base_url' no definida en la configuración del entorno.")
+        return None, None
+
+    login_url = urljoin(api_base_url, "custom/apps/api.php?login")
+    payload = {"username": api_username, "password": api_password}
+    headers = {'Content-Type': 'application/json'}
+
+    try:
+        session = get_http_session(config)
+        with environment_limiter(config).slot():
+            response = session.post(login_url, json=payload, headers=headers, timeout=_http_timeout(config, "http_login_read_timeout"))
+        response.raise_for_status()
+        data = response.json()
+        token = data.get("token") or data.get("access_token") or data.get("data", {}).get("token")
+
+        if not token:
+            show_message("error", f"Login fallido: No se pudo encontrar token en la respuesta. Respuesta: {data}")
+            return None, None
+        return token, _token_expiry(data, token, config)
+    except requests.exceptions.HTTPError as e:
+        show_message("error", f"Error HTTP {e.response.status_code} durante la autenticación en {login_url}.")
+        if e.response.status_code == 401:
+            show_message("error", "Credenciales inválidas o no autorizadas.")
+        else:
+            try:
+                show_message("error", f"Respuesta del servidor: {e.response.text}")
+            except Exception:
+                show_message("error", "No se pudo obtener el detalle de la respuesta del servidor.")
+        return None, None
+    except requests.exceptions.RequestException as e:
+        show_message("error", f"Error de conexión durante la autenticación a {login_url}: {e}")
+        return None, None
+    except Exception as e:
+        show_message("error", f"Error inesperado procesando el login: {e}")
+        return None, None
+
+# --- Caché de respuestas KPI ---
+KPI_CACHE_TTL_DEFAULT = 600             # Segundos de vigencia (configurable por entorno con kpi_cache_ttl)
+KPI_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Tamaño total (bytes de respuesta) antes de desalojar por LRU
+
+class KpiResponseCache:
+    """Caché LRU de respuestas KPI con TTL, acotada por el tamaño total de las respuestas."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # clave -> (datos, bytes, guardado_en)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, ttl):
+        """Devuelve (datos, bytes) vigentes de la clave (y la marca como reciente) o None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[2] > ttl:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0], entry[1]
+
+    def put(self, key, data, size, stored_at=None):
+        """Guarda una respuesta, desalojando las menos recientes si se supera el límite.
+
+        stored_at (por defecto ahora) es el momento desde el que corre el TTL.
+        """
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (data, size, time.time() if stored_at is None else stored_at)
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, api_base_url, country_id):
+        """Elimina todas las respuestas cacheadas de un paciente en un entorno."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == api_base_url and k[1] == str(country_id)]:
+                self._remove(key)
+
+    def stats(self):
+        """Devuelve (número de entradas, bytes ocupados)."""
+        with self._lock:
+            return len(self._entries), self._total_bytes
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._total_bytes -= size
+
+kpi_response_cache = KpiResponseCache(KPI_CACHE_MAX_BYTES)
+
+KPI_STREAM_CHUNK_BYTES = 64 * 1024  # Bloques en que se lee y decodifica el cuerpo de las respuestas KPI
+
+class KpiResponseTooLarge(Exception):
+    """La respuesta KPI supera http_kpi_max_response_bytes."""
+
+# Origen, tamaño y tiempo de decodificación de la última consulta KPI del hilo actual
+_kpi_fetch_state = threading.local()
+
+def last_kpi_source():
+    """Origen ('cache', 'store' o 'api') de la última consulta KPI hecha en el hilo actual."""
+    return getattr(_kpi_fetch_state, "source", None)
+
+def last_kpi_response_bytes():
+    """Tamaño en bytes de la respuesta de la última consulta KPI hecha en el hilo actual."""
+    return getattr(_kpi_fetch_state, "response_bytes", 0)
+
+def last_kpi_decode_seconds():
+    """Segundos de decodificación JSON de la última consulta KPI hecha en el hilo actual."""
+    return getattr(_kpi_fetch_state, "decode_seconds", 0.0)
+
+def last_kpi_wait_seconds():
+    """Segundos de espera en el límite de concurrencia del entorno de la última consulta KPI del hilo actual."""
+    return getattr(_kpi_fetch_state, "wait_seconds", 0.0)
+
+def _kpi_cache_ttl(config):
+    ttl = config.get("kpi_cache_ttl")
+    return KPI_CACHE_TTL_DEFAULT if ttl is None else float(ttl)
+
+def _kpi_store_ttl(config):
+    """Vigencia de los datos del almacén local (kpi_store_ttl; por defecto la de la caché en memoria)."""
+    ttl = config.get("kpi_store_ttl")
+    return _kpi_cache_ttl(config) if ttl is None else float(ttl)
+
+def _kpi_cache_key(config, country_id, kpi_name):
+    return (config.get('api_base_url'), str(country_id), kpi_name)
+
+def _cached_kpi(config, country_id, kpi_name):
+    """(datos, bytes, 'cache' o 'store') vigentes en la caché en memoria o en el almacén local, o None."""
+    ttl = _kpi_cache_ttl(config)
+    cached = kpi_response_cache.get(_kpi_cache_key(config, country_id, kpi_name), ttl) if ttl > 0 else None
+    if cached is not None:
+        cached[0].response_bytes = cached[1]
+        return cached[0], cached[1], "cache"
+    store_ttl = _kpi_store_ttl(config)
+    stored = patient_store.get_kpi(config.get('api_base_url'), country_id, kpi_name, store_ttl)
+    if stored is None:
+        return None
+    data, response_bytes, checked_at = stored
+    data.response_bytes = response_bytes
+    if ttl > 0:
+        # Las siguientes consultas se sirven de memoria sin reconstruir los registros; el TTL
+        # corre desde la última confirmación contra la API y no supera ninguna de las dos vigencias.
+        kpi_response_cache.put(_kpi_cache_key(config, country_id, kpi_name), data, response_bytes, checked_at - max(0.0, ttl - store_ttl))
+    return data, response_bytes, "store"
+
+def _remember_kpi(config, country_id, kpi_name, data, response_bytes):
+    """Guarda una respuesta recibida de la API en la caché en memoria y en el almacén local."""
+    if _kpi_cache_ttl(config) > 0:
+        kpi_response_cache.put(_kpi_cache_key(config, country_id, kpi_name), data, response_bytes)
+    if _kpi_store_ttl(config) > 0:
+        patient_store.put_kpi(config.get('api_base_url'), country_id, kpi_name, data, response_bytes)
+
+def _kpi_get(token, kpi_url, payload, config):
+    """GET al endpoint KPI y lectura de la respuesta; ante un 401 re-autentica una sola vez de forma transparente.
+
+    El lugar en el límite del entorno se ocupa solo durante cada petición y su
+    lectura: el re-login se hace fuera de él, porque _login espera su propio lugar
+    (con el lock de las credenciales tomado) y otro hilo puede estar esperando ese lock.
+    """
+    session = get_http_session(config)
+    timeout = _http_timeout(config, "http_kpi_read_timeout")
+    headers = {
+        'Authorization': f'Bearer {token}',
+        'Content-Type': 'application/json'
+    }
+    for attempt in range(2):
+        with environment_limiter(config).slot() as waited:
+            _kpi_fetch_state.wait_seconds += waited
+            # GET con payload en JSON; el cuerpo se lee por bloques en _read_kpi_response
+            response = session.get(kpi_url, headers=headers, json=payload, timeout=timeout, stream=True)
+            if response.status_code != 401 or attempt:
+                response.raise_for_status()
+                return _read_kpi_response(response, config)
+        new_token = refresh_api_token(token, config)
+        if not new_token:
+            response.raise_for_status()
+        response.close()
+        headers['Authorization'] = f'Bearer {new_token}'
+
+def _read_kpi_response(response, config):
+    """Lee el cuerpo por bloques y lo decodifica de forma incremental a registros compactos.
+
+    Corta la descarga con KpiResponseTooLarge si se supera el tamaño máximo del entorno.
+    """
+    max_bytes = int(_http_setting(config, "http_kpi_max_response_bytes"))
+    decoder = KpiResponseDecoder()
+    received_bytes = 0
+    decode_seconds = 0.0
+    with response:
+        content_length = response.headers.get("Content-Length")
+        if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+            raise KpiResponseTooLarge(f"{int(content_length):,} bytes anunciados (máximo {max_bytes:,})")
+        for chunk in response.iter_content(chunk_size=KPI_STREAM_CHUNK_BYTES):
+            received_bytes += len(chunk)
+            _kpi_fetch_state.response_bytes = received_bytes
+            if received_bytes > max_bytes:
+                raise KpiResponseTooLarge(f"más de {max_bytes:,} bytes recibidos")
+            start_time = time.perf_counter()
+            decoder.feed(chunk)
+            decode_seconds += time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        try:
+            return decoder.close()
+        finally:
+            _kpi_fetch_state.decode_seconds = decode_seconds + time.perf_counter() - start_time
+
+# --- Cliente KPI genérico ---
+KPI_ENDPOINT_PATH = "custom/apps/api.php"
+KPI_ACTION_PARAMS = {"afn": "admin", "cfn": "kpis"}
+KPI_BATCH_SIZE_DEFAULT = 50  # Cédulas por petición si el entorno acepta varias en country-ids (configurable con kpi_batch_size)
+KPI_FETCH_WORKERS = 4        # Consultas individuales en paralelo en fetch_kpis
+
+# kpi-name -> (nombre en los mensajes de error, nombre corto para la respuesta del servidor)
+KPI_LABELS = {
+    "medicalrecords": ("Historias Médicas", "HM"),
+    "exams": ("Exámenes", "Exámenes"),
+    "labresults": ("Laboratorios", "Laboratorios"),
+}
+
+def get_kpi(token, kpi_name, country_id, config, refresh=False):
+    """Obtiene una KPI (medicalrecords, exams, labresults...) de una cédula como KpiRecordSet.
+
+    Sirve la respuesta desde kpi_response_cache o, tras un reinicio, desde el
+    almacén local (patient_store) si hay una vigente; refresh=True las ignora.
+    """
+    if not refresh:
+        cached = _cached_kpi(config, country_id, kpi_name)
+        if cached is not None:
+            _kpi_fetch_state.source = cached[2]
+            _kpi_fetch_state.response_bytes = cached[1]
+            _kpi_fetch_state.decode_seconds = 0.0
+            _kpi_fetch_state.wait_seconds = 0.0
+            return cached[0]
+    data = _request_kpi(token, kpi_name, country_id, config)
+    if data is not None:
+        data.response_bytes = _kpi_fetch_state.response_bytes
+        _remember_kpi(config, country_id, kpi_name, data, _kpi_fetch_state.response_bytes)
+    return data
+
+def _request_kpi(token, kpi_name, country_ids, config):
+    """Consulta el endpoint KPI; country_ids es una cédula o varias separadas por coma."""
+    _kpi_fetch_state.source = "api"
+    _kpi_fetch_state.response_bytes = 0
+    _kpi_fetch_state.decode_seconds = 0.0
+    _kpi_fetch_state.wait_seconds = 0.0
+    label, short_label = KPI_LABELS.get(kpi_name, (kpi_name, kpi_name))
+    api_base_url = config.get('api_base_url')
+    if not api_base_url:
+        show_message("error", "Error: 'api_base_url' no definida en la configuración del entorno.")
+        return None
+
+    kpi_url = f"{urljoin(api_base_url, KPI_ENDPOINT_PATH)}?{urlencode(KPI_ACTION_PARAMS)}"
+
+    payload = {
+        "page-id": "kpis",
+        "section-id": "kpis",
+        "kpi-name": kpi_name,
+        "country-ids": country_ids
+    }
+
+    try:
+        return _kpi_get(token, kpi_url, payload, config)
+    except requests.exceptions.HTTPError as e:
+        show_message("error", f"Error HTTP {e.response.status_code} al obtener datos de {label} desde {kpi_url}.")
+        try:
+            show_message("error", f"Respuesta del servidor ({short_label}): {e.response.text}")
+        except Exception:
+            show_message("error", f"No se pudo obtener el detalle de la respuesta del servidor ({short_label}).")
+        return None
+    except requests.exceptions.RequestException as e:
+        show_message("error", f"Error de conexión al obtener datos de {label} desde {kpi_url}: {e}")
+        return None
+    except KpiResponseTooLarge as e:
+        show_message("error", f"La respuesta de {label} desde {kpi_url} es demasiado grande: {e}.")
+        return None
+    except json.JSONDecodeError as e:
+        show_message("error", f"Error decodificando JSON de la respuesta de {label} ({kpi_url}). Respuesta recibida:")
+        show_message("code", e.doc)
+        return None
+    except Exception as e:
+        show_message("error", f"Error inesperado al obtener datos de {label}: {e}")
+        return None
+
+def fetch_kpis(token, kpi_names, country_ids, config, refresh=False):
+    """Consulta varias KPIs de varias cédulas. Devuelve {(cédula, kpi-name): KpiRecordSet o None}.
+
+    Si el entorno tiene kpi_batch_country_ids = true, se envían hasta kpi_batch_size
+    cédulas por petición y la respuesta se reparte por Patient.CountryID. Las
+    cédulas de un lote que falla o que no se puede repartir, y todas si el entorno
+    no acepta lotes, se consultan una por una en paralelo. Las respuestas por
+    cédula quedan en kpi_response_cache y en el almacén local.
+    """
+    country_ids = list(dict.fromkeys(str(country_id).strip() for country_id in country_ids))
+    batch_size = int(config.get("kpi_batch_size") or KPI_BATCH_SIZE_DEFAULT)
+    results, single_requests = {}, []
+    for kpi_name in kpi_names:
+        missing = []
+        for country_id in country_ids:
+            cached = None if refresh else _cached_kpi(config, country_id, kpi_name)
+            if cached is not None:
+                results[(country_id, kpi_name)] = cached[0]
+            else:
+                missing.append(country_id)
+        if not config.get("kpi_batch_country_ids") or len(missing) < 2:
+            single_requests += [(country_id, kpi_name) for country_id in missing]
+            continue
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            record_set = _request_kpi(token, kpi_name, ",".join(batch), config)
+            by_patient = record_set.split_by_country_id(batch) if record_set else None
+            if by_patient is None:
+                show_message("warning", f"La consulta por lotes de {kpi_name} no se pudo repartir por cédula; se consultan una por una.")
+                single_requests += [(country_id, kpi_name) for country_id in batch]
+                continue
+            response_bytes = _kpi_fetch_state.response_bytes // len(batch)
+            for country_id, patient_set in by_patient.items():
+                patient_set.response_bytes = response_bytes
+                results[(country_id, kpi_name)] = patient_set
+                _remember_kpi(config, country_id, kpi_name, patient_set, response_bytes)
+
+    with ThreadPoolExecutor(max_workers=KPI_FETCH_WORKERS) as executor:
+        futures = {
+            executor.submit(bind_session(call_collecting_messages), get_kpi, token, kpi_name, country_id, config, True): (country_id, kpi_name)
+            for country_id, kpi_name in single_requests
+        }
+        for future in as_completed(futures):
+            data, messages = future.result()
+            for level, text in messages:
+                show_message(level, text)
+            results[futures[future]] = data
+    return results
+
+# Fuentes de datos del paciente: (clave en session_state, kpi-name, nombre, nombre corto)
+PATIENT_DATA_SOURCES = (
+    ("kpi_data", "medicalrecords", "Historias Médicas (HMs)", "HMs"),
+    ("exam_data", "exams", "Resultados de Exámenes", "Exámenes"),
+    ("lab_data", "labresults", "Resultados de Laboratorio", "Laboratorio"),
+)
+
+# Resultado de cada consulta de fetch_patient_data; source es 'cache', 'store' (almacén local) o 'api'
+# ('prefetch' si lo entrega prefetch.PatientPrefetcher.take)
+# wait_seconds es la espera en el límite de concurrencia del entorno
+PatientDataResult = namedtuple("PatientDataResult", ["state_key", "data", "messages", "seconds", "source", "response_bytes", "decode_seconds", "wait_seconds"])
+
+def fetch_patient_data(token, country_id, config, concurrent=True, refresh=False):
+    """Consulta las tres fuentes de datos del paciente.
+
+    Genera un PatientDataResult a medida que cada consulta termina. En modo
+    concurrente las tres llamadas KPI se lanzan en paralelo y el fallo de una
+    no cancela las demás. Con refresh=True se ignoran la caché de respuestas y el almacén local.
+    """
+    def timed_fetch(state_key, kpi_name):
+        start_time = time.time()
+        data, messages = call_collecting_messages(get_kpi, token, kpi_name, country_id, config, refresh)
+        return PatientDataResult(state_key, data, messages, time.time() - start_time, last_kpi_source(), last_kpi_response_bytes(), last_kpi_decode_seconds(), last_kpi_wait_seconds())
+
+    if not concurrent:
+        for state_key, kpi_name, _, _ in PATIENT_DATA_SOURCES:
+            yield timed_fetch(state_key, kpi_name)
+        return
+
+    with ThreadPoolExecutor(max_workers=len(PATIENT_DATA_SOURCES)) as executor:
+        futures = [
+            executor.submit(bind_session(timed_fetch), state_key, kpi_name)
+            for state_key, kpi_name, _, _ in PATIENT_DATA_SOURCES
+        ]
+        for future in as_completed(futures):
+            yield future.result()
@@ -0,0 +1,423 @@
+"""Representación compacta de los registros KPI y decodificación incremental de las respuestas."""
+import codecs
+import json
+import re
+import sys
+from datetime import datetime
+
+
+HTML_FIELDS = {"ExamResults"}  # Campos que llegan como HTML desde el CRM
+RECORDS_PATH = ("data", "kpis", "Records")  # Ubicación de la lista de registros en la respuesta KPI
+_RECORDS_PLACEHOLDER = "\0Records"  # Ocupa el lugar de la lista mientras se decodifica aparte
+# Escaneo de los registros en streaming: separadores entre registros y caracteres que cambian el estado
+_RECORD_GAP = re.compile(r"[\s,]*")
+_RECORD_STRUCTURE = re.compile(r'["{}\[\],]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+
+def _fingerprint(value):
+    return json.dumps(value, sort_keys=True, ensure_ascii=False)
+
+def _is_empty(value):
+    return value is None or value == "" or value == [] or value == {}
+
+def _html_to_text(html):
+    """Convierte el HTML de un informe a texto plano conservando los saltos de línea."""
+    from bs4 import BeautifulSoup # Import diferido: solo se necesita si hay campos HTML
+    text = BeautifulSoup(html, "html.parser").get_text("\n", strip=True)
+    return re.sub(r"[ \t\u00a0]+", " ", text)
+
+def compact_value(value, key=None):
+    """Limpia recursivamente: HTML a texto, sin campos vacíos ni elementos repetidos."""
+    if isinstance(value, dict):
+        compacted = {}
+        for field, field_value in value.items():
+            field_value = compact_value(field_value, field)
+            if not _is_empty(field_value):
+                compacted[field] = field_value
+        return compacted
+    if isinstance(value, list):
+        items = _unique_items(compact_value(item) for item in value)
+        if key == "Records":
+            _drop_repeated_patient(items)
+        return items
+    if isinstance(value, str):
+        text = value.strip()
+        if key in HTML_FIELDS and "<" in text:
+            text = _html_to_text(text)
+        return text
+    return value
+
+def _unique_items(items):
+    """Elementos no vacíos y sin repetir, en su orden original."""
+    unique, seen = [], set()
+    for item in items:
+        if _is_empty(item):
+            continue
+        fingerprint = _fingerprint(item)
+        if fingerprint not in seen:
+            seen.add(fingerprint)
+            unique.append(item)
+    return unique
+
+def _drop_repeated_patient(records):
+    """Deja el objeto Patient solo en el primer registro si es el mismo en todos."""
+    dicts = [record for record in records if isinstance(record, dict)]
+    if len(dicts) < 2 or "Patient" not in dicts[0]:
+        return
+    first_patient = dicts[0]["Patient"]
+    if all(record.get("Patient") == first_patient for record in dicts[1:]):
+        for record in dicts[1:]:
+            del record["Patient"]
+
+def compact_kpi_response(raw_data):
+    """Versión compacta de una respuesta KPI (misma estructura) para guardar en sesión."""
+    return compact_value(raw_data) if raw_data else raw_data
+
+def _intern(value):
+    """Comparte una sola copia de los textos cortos que se repiten en todos los registros."""
+    return sys.intern(value) if isinstance(value, str) and len(value) <= 64 else value
+
+def exam_type_name(value):
+    """Nombre del tipo de examen, venga como texto o como objeto (ej. ExamType.Type); lo usan los índices y la tabla de laboratorios."""
+    if isinstance(value, dict):
+        value = value.get("Type") or next(iter(value.values()), None)
+    return value if isinstance(value, str) and value else None
+
+def parse_record_date(value):
+    """Convierte la fecha de un registro a datetime; None si no se reconoce."""
+    if not isinstance(value, str) or not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).replace(tzinfo=None)
+    except ValueError:
+        pass
+    for date_format in ("%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    return None
+
+class LabResult:
+    """Un elemento de LabResults."""
+    __slots__ = ("exam_type", "exam", "section", "item", "date", "value", "unit", "extra")
+    FIELDS = (("ExamType", "exam_type"), ("Exam", "exam"), ("Section", "section"), ("Item", "item"),
+              ("Date", "date"), ("Value", "value"), ("Unit", "unit"))
+
+    def __init__(self, item):
+        for field, attribute in self.FIELDS:
+            setattr(self, attribute, _intern(item.get(field)))
+        known = {field for field, _ in self.FIELDS}
+        self.extra = {field: value for field, value in item.items() if field not in known} or None
+
+    def to_dict(self):
+        item = {field: getattr(self, attribute) for field, attribute in self.FIELDS}
+        item = {field: value for field, value in item.items() if value is not None}
+        if self.extra:
+            item.update(self.extra)
+        return item
+
+class KpiRecord:
+    """Un registro de Records (historia médica, examen o laboratorio), ya compactado."""
+    __slots__ = ("id", "date", "timestamp", "patient", "exam_types", "lab_results", "fields")
+
+    def __init__(self, record, patients):
+        """patients es el diccionario {huella: Patient} compartido por todos los registros de la respuesta."""
+        record = dict(record)
+        self.id = record.pop("ID", None)
+        self.date = record.pop("Date", None)
+        self.timestamp = parse_record_date(self.date)
+        patient = record.pop("Patient", None)
+        self.patient = patients.setdefault(_fingerprint(patient), patient) if patient is not None else None
+        lab_results = record.pop("LabResults", None)
+        if isinstance(lab_results, dict):
+            lab_results = [lab_results]
+        if isinstance(lab_results, list):
+            self.lab_results = tuple(LabResult(item) for item in lab_results if isinstance(item, dict))
+            exam_types = [exam_type_name(result.exam_type) for result in self.lab_results]
+        else:
+            self.lab_results = None
+            exam_types = [exam_type_name(record.get("ExamType"))]
+            if lab_results is not None:
+                record["LabResults"] = lab_results
+        self.exam_types = tuple(dict.fromkeys(_intern(name) for name in exam_types if name))
+        self.fields = record
+
+    def to_dict(self, include_patient=True):
+        """Registro en la forma compacta de la respuesta KPI."""
+        record = {}
+        if self.id is not None:
+            record["ID"] = self.id
+        if self.date is not None:
+            record["Date"] = self.date
+        if include_patient and self.patient is not None:
+            record["Patient"] = self.patient
+        record.update(self.fields)
+        if self.lab_results is not None:
+            record["LabResults"] = [result.to_dict() for result in self.lab_results]
+        return record
+
+class KpiRecordSet:
+    """Respuesta KPI de una fuente, construida una sola vez por consulta.
+
+    Guarda los registros como KpiRecord (con el Patient compartido) y los índices
+    por fecha y por tipo de examen; kpis() devuelve la forma JSON compacta que
+    usan el prompt y el visor. response_bytes es el tamaño de la respuesta cruda
+    de la API de la que salió (None si no se conoce), para medir la compactación.
+    """
+    __slots__ = ("envelope", "records", "by_exam_type", "_by_date", "response_bytes")
+
+    def __init__(self, envelope, records):
+        """envelope es la respuesta compacta con _RECORDS_PLACEHOLDER en lugar de Records."""
+        self.envelope = envelope
+        self.records = tuple(records)
+        self.response_bytes = None
+        by_exam_type = {}
+        for record in self.records:
+            for exam_type in record.exam_types:
+                by_exam_type.setdefault(exam_type, []).append(record)
+        self.by_exam_type = {exam_type: tuple(records) for exam_type, records in by_exam_type.items()}
+        self._by_date = tuple(sorted(
+            (record for record in self.records if record.timestamp),
+            key=lambda record: record.timestamp
+        ))
+
+    @classmethod
+    def from_response(cls, raw_data):
+        """Construye el conjunto a partir de una respuesta KPI ya decodificada."""
+        builder = KpiRecordSetBuilder()
+        data = compact_kpi_response(raw_data)
+        kpis = data.get("data", {}).get("kpis") if isinstance(data, dict) and isinstance(data.get("data"), dict) else None
+        if not isinstance(kpis, dict) or not isinstance(kpis.get("Records"), list):
+            return builder.build(data)
+        for record in kpis["Records"]:
+            builder.add(record)
+        kpis["Records"] = _RECORDS_PLACEHOLDER
+        return builder.build(data)
+
+    def split_by_country_id(self, country_ids):
+        """Reparte los registros de una consulta de varias cédulas según Patient.CountryID.
+
+        Devuelve {cédula: KpiRecordSet} o None si algún registro no indica una de esas cédulas.
+        """
+        by_patient = {str(country_id).strip(): [] for country_id in country_ids}
+        for record in self.records:
+            country_id = str((record.patient or {}).get("CountryID", "")).strip()
+            if country_id not in by_patient:
+                return None
+            by_patient[country_id].append(record)
+        return {country_id: KpiRecordSet(self.envelope, records) for country_id, records in by_patient.items()}
+
+    def by_date(self):
+        """Registros con fecha reconocida, del más antiguo al más reciente."""
+        return self._by_date
+
+    def record_dicts(self, records=None):
+        """Registros en forma compacta; Patient solo en el primero si es el mismo en todos."""
+        records = self.records if records is None else records
+        shared_patient = len(records) > 1 and records[0].patient is not None and all(
+            record.patient is records[0].patient for record in records
+        )
+        return [
+            record.to_dict(include_patient=not shared_patient or index == 0)
+            for index, record in enumerate(records)
+        ]
+
+    def kpis(self):
+        """Contenido compacto de data.kpis (con Records), o None si la respuesta no lo trae."""
+        kpis = (self.envelope.get("data") or {}).get("kpis") if isinstance(self.envelope, dict) else None
+        if not kpis:
+            return None
+        if not isinstance(kpis, dict) or kpis.get("Records") != _RECORDS_PLACEHOLDER:
+            return kpis
+        records = self.record_dicts()
+        return {
+            field: records if field == "Records" else value
+            for field, value in kpis.items()
+            if field != "Records" or records
+        } or None
+
+    def to_response(self):
+        """Respuesta KPI completa en su forma compacta."""
+        if not isinstance(self.envelope, dict) or not isinstance(self.envelope.get("data"), dict):
+            return self.envelope
+        response = dict(self.envelope, data=dict(self.envelope["data"]))
+        kpis = self.kpis()
+        if not kpis:
+            # Sin registros: se eliminan los contenedores vacíos como en compact_kpi_response
+            response["data"].pop("kpis", None)
+            return compact_value(response)
+        response["data"]["kpis"] = kpis
+        return response
+
+class KpiRecordSetBuilder:
+    """Acumula registros compactados, sin duplicados, y arma el KpiRecordSet."""
+
+    def __init__(self):
+        self._records = []
+        self._seen = set()
+        self._patients = {}
+
+    def add(self, record):
+        if _is_empty(record):
+            return
+        fingerprint = _fingerprint(record)
+        if fingerprint in self._seen:
+            return
+        self._seen.add(fingerprint)
+        if isinstance(record, dict):
+            self._records.append(KpiRecord(record, self._patients))
+
+    def build(self, envelope):
+        return KpiRecordSet(envelope, self._records)
+
+class KpiResponseDecoder:
+    """Decodifica una respuesta KPI a medida que llegan los bytes.
+
+    Solo el encabezado y el cierre del JSON se guardan como texto; cada
+    elemento de data.kpis.Records se decodifica en cuanto está completo, se
+    compacta, se convierte en KpiRecord y su texto se descarta. close()
+    devuelve el mismo KpiRecordSet que KpiRecordSet.from_response(json.loads(cuerpo)).
+
+    Los bloques de un registro incompleto se acumulan en una lista y de cada
+    bloque nuevo solo se escanean sus caracteres (profundidad y strings) hasta el
+    cierre del registro, que se decodifica una sola vez: un registro de varios MB
+    (ej. el HTML de ExamResults) cuesta lo mismo llegue en un bloque o en muchos.
+    """
+
+    def __init__(self):
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._phase = "prefix"  # prefix -> records -> suffix
+        self._buffer = ""
+        self._prefix = ""
+        self._builder = KpiRecordSetBuilder()
+        # Estado del escaneo del encabezado
+        self._scan_pos = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string = None
+        self._containers = []  # [tipo, clave actual] por cada objeto/arreglo abierto
+        # Estado del escaneo del registro en curso
+        self._record_parts = None  # Texto ya recibido del registro incompleto; None entre registros
+        self._record_start = 0     # Inicio del registro en el bloque que se está escaneando
+        self._depth = 0
+        self._record_in_string = False
+        self._record_escape = False
+
+    def feed(self, chunk):
+        """Agrega bytes recibidos y decodifica los registros que ya estén completos."""
+        self._feed_text(self._text_decoder.decode(chunk))
+
+    def close(self):
+        """Termina la decodificación y devuelve el KpiRecordSet de la respuesta."""
+        self._feed_text(self._text_decoder.decode(b"", final=True))
+        if self._phase == "records":
+            raise json.JSONDecodeError("Lista de registros incompleta", "".join(self._record_parts or ()), 0)
+        if self._phase == "prefix":
+            return KpiRecordSet.from_response(json.loads(self._buffer))
+        return self._builder.build(compact_kpi_response(json.loads(self._prefix + self._buffer)))
+
+    def _path(self):
+        if any(kind != "{" for kind, _ in self._containers):
+            return None
+        return tuple(key for _, key in self._containers)
+
+    def _scan_prefix(self):
+        """Recorre el encabezado hasta encontrar el inicio de data.kpis.Records."""
+        buffer = self._buffer
+        for position in range(self._scan_pos, len(buffer)):
+            char = buffer[position]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    self._last_string = buffer[self._string_start:position]
+                continue
+            if char == '"':
+                self._in_string = True
+                self._string_start = position + 1
+            elif char == ":" and self._containers and self._containers[-1][0] == "{":
+                self._containers[-1][1] = self._last_string
+            elif char == "," and self._containers and self._containers[-1][0] == "{":
+                self._containers[-1][1] = None
+            elif char == "[" and self._path() == RECORDS_PATH:
+                self._prefix = buffer[:position] + json.dumps(_RECORDS_PLACEHOLDER)
+                self._buffer = buffer[position + 1:]
+                self._phase = "records"
+                return
+            elif char in "{[":
+                self._containers.append([char, None])
+            elif char in "}]" and self._containers:
+                self._containers.pop()
+        self._scan_pos = len(buffer)
+
+    def _feed_text(self, text):
+        if self._phase == "records":
+            self._decode_records(text)
+            return
+        self._buffer += text
+        if self._phase == "prefix":
+            self._scan_prefix()
+            if self._phase == "records":
+                text, self._buffer = self._buffer, ""
+                self._decode_records(text)
+
+    def _decode_records(self, text):
+        """Decodifica los registros que se completan en text y guarda el resto del registro en curso."""
+        position = 0
+        while position < len(text):
+            if self._record_parts is None:
+                position = _RECORD_GAP.match(text, position).end()
+                if position == len(text):
+                    return
+                if text[position] == "]":
+                    self._phase = "suffix"
+                    self._buffer = text[position + 1:]
+                    return
+                self._record_parts, self._record_start = [], position
+            end = self._scan_record(text, position)
+            if end is None:
+                self._record_parts.append(text[self._record_start:])
+                self._record_start = 0  # El registro sigue desde el inicio del próximo bloque
+                return
+            record = json.loads("".join(self._record_parts) + text[self._record_start:end])
+            self._builder.add(compact_value(record))
+            self._record_parts, position = None, end
+
+    def _scan_record(self, text, position):
+        """Fin (exclusivo) del registro en text o None si sigue en el próximo bloque."""
+        if self._record_escape:  # La barra invertida quedó al final del bloque anterior
+            self._record_escape = False
+            position += 1
+        while position < len(text):
+            if self._record_in_string:
+                match = _STRING_SPECIAL.search(text, position)
+                if match is None:
+                    return None
+                position = match.end()
+                if match.group() == '"':
+                    self._record_in_string = False
+                elif position == len(text):
+                    self._record_escape = True
+                else:
+                    position += 1
+                continue
+            match = _RECORD_STRUCTURE.search(text, position)
+            if match is None:
+                return None
+            char, position = match.group(), match.end()
+            if char == '"':
+                self._record_in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif self._depth == 0:
+                return match.start()  # "," o "]" después de un registro que no es objeto ni lista
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    return position
+        return None
@@ -0,0 +1,75 @@
+"""Tabla de resultados de laboratorio a través del tiempo, calculada con pandas.
+
+pandas se importa dentro de cada función: tarda casi medio segundo y solo hace
+falta cuando hay laboratorios que mostrar.
+"""
+from kpi_records import exam_type_name, parse_record_date
+
+# Campo de LabResults -> columna de la tabla (en el orden de las filas de build_lab_results_table)
+LAB_TABLE_COLUMNS = {
+    "ExamType": "Tipo de Examen",
+    "Exam": "Examen",
+    "Section": "Sección",
+    "Item": "Elemento",
+    "Date": "Fecha",
+    "Value": "Resultado",
+    "Unit": "Unidad",
+}
+LAB_GROUP_COLUMNS = ["Tipo de Examen", "Examen", "Sección", "Elemento", "Unidad"]
+# Formatos de las columnas de la vista de evolución: se agrega la hora solo si hay dos fechas el mismo día
+PIVOT_DATE_FORMATS = ("%d/%m/%Y", "%d/%m/%Y %H:%M", "%d/%m/%Y %H:%M:%S")
+
+def _cell(value):
+    """Valor de una celda; los objetos anidados (ej. ExamType.Type) aportan su primer valor."""
+    if isinstance(value, dict):
+        value = next((item for item in value.values() if item not in (None, "")), None)
+    return value
+
+def build_lab_results_table(lab_data):
+    """Construye la tabla larga (una fila por elemento y fecha) desde el KpiRecordSet de laboratorios."""
+    rows = [
+        # La fecha del elemento, si existe, tiene prioridad sobre la del registro.
+        # El tipo de examen usa el mismo nombre que KpiRecordSet.by_exam_type (filtro de la app)
+        [exam_type_name(result.exam_type), _cell(result.exam), _cell(result.section), _cell(result.item),
+         _cell(result.date) or record.date, _cell(result.value), _cell(result.unit)]
+        for record in (lab_data.records if lab_data else ())
+        for result in record.lab_results or ()
+    ]
+    import pandas as pd
+    table = pd.DataFrame(rows, columns=list(LAB_TABLE_COLUMNS.values()))
+    if table.empty:
+        return table
+    # Misma regla que el resto de la app: ISO 8601 o dd/mm/aaaa
+    table["Fecha"] = pd.to_datetime(table["Fecha"].map(parse_record_date), errors="coerce")
+    table[LAB_GROUP_COLUMNS] = table[LAB_GROUP_COLUMNS].fillna("").astype(str)
+    return table.sort_values(LAB_GROUP_COLUMNS + ["Fecha"], kind="stable").reset_index(drop=True)
+
+def _date_labels(dates):
+    """Etiqueta de cada columna: dd/mm/aaaa, con la hora si otra columna cae el mismo día."""
+    labels = []
+    for date in dates:
+        for date_format in PIVOT_DATE_FORMATS:
+            label = date.strftime(date_format)
+            if sum(other.strftime(date_format) == label for other in dates) == 1:
+                break
+        labels.append(label)
+    return labels
+
+def pivot_lab_results(table):
+    """Vista de evolución: una fila por elemento y una columna por fecha (dd/mm/aaaa, con la hora si hace falta)."""
+    if table.empty:
+        import pandas as pd
+        return pd.DataFrame()
+    dated = table.dropna(subset=["Fecha"])
+    pivot = dated.pivot_table(
+        index=LAB_GROUP_COLUMNS,
+        columns="Fecha",
+        values="Resultado",
+        aggfunc="last",
+    )
+    pivot.columns = _date_labels(list(pivot.columns))
+    return pivot.fillna("").reset_index()
+
+def lab_results_csv(table):
+    """Exporta la tabla larga a CSV (UTF-8 con BOM, para abrirla en Excel)."""
+    return table.to_csv(index=False, date_format="%Y-%m-%d %H:%M").encode("utf-8-sig")
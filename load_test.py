@@ -0,0 +1,169 @@
+"""Prueba de carga local: varios operadores a la vez contra el CRM simulado y el Gemini falso de benchmark.py.
+
+Uso:
+    python load_test.py --sessions 1,2,4,8,16 --patients 3 --crm-capacity 4 --gemini-limit 4 --json carga.json
+
+Cada sesión simulada es un hilo con su propio id en concurrency_limits (como una
+sesión de Streamlit) que consulta y analiza pacientes uno tras otro. Para cada
+nivel de concurrencia reporta el rendimiento (pacientes por segundo), la latencia
+por paciente (p50, p95), la espera media en los límites del CRM y de Gemini y la
+dispersión entre sesiones (mayor latencia media / menor; cerca de 1 = reparto
+justo). El techo es el primer nivel en que el rendimiento deja de crecer.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import concurrency_limits
+from analysis_cache import analysis_cache
+from benchmark import BENCHMARK_MODEL, FakeGemini, StubCrmServer, run_patient
+from clinical_llm import PROMPT_TOKEN_BUDGET_DEFAULT
+from concurrency_limits import CRM_MAX_CONCURRENT_DEFAULT, GEMINI_MAX_CONCURRENT_DEFAULT, set_session
+from model_router import model_latency_stats
+from patient_store import patient_store
+
+CEILING_GAIN = 1.1  # Un nivel que no mejora el rendimiento en al menos 10 % respecto del anterior marca el techo
+KPI_STAGES = ("kpi_data", "exam_data", "lab_data")
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def run_level(config, sessions, patients, records, run_kwargs):
+    """sessions operadores en paralelo, cada uno con patients pacientes; devuelve (segundos, ejecuciones por sesión, errores)."""
+    runs = [[] for _ in range(sessions)]
+    errors = []
+
+    def operator(index):
+        set_session(f"operador-{index}")
+        for patient_number in range(patients):
+            try:
+                runs[index].append(run_patient(config, records, f"{sessions}-{index}-{patient_number}", **run_kwargs)[0])
+            except Exception as e:
+                errors.append(f"operador-{index}: {e}")
+
+    threads = [threading.Thread(target=operator, args=(index,), name=f"operador-{index}") for index in range(sessions)]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start_time, runs, errors
+
+def summarize(sessions, seconds, runs, errors):
+    """Rendimiento, latencias y esperas de un nivel."""
+    all_runs = [run for session_runs in runs for run in session_runs]
+    totals = [run["total_seconds"] for run in all_runs]
+    crm_waits, gemini_waits = [], []
+    for run in all_runs:
+        for stage in run["stages"]:
+            if stage["stage"] in KPI_STAGES:
+                crm_waits.append(stage.get("wait_seconds") or 0.0)
+            elif stage["stage"] == "llm":
+                gemini_waits.append(stage.get("wait_seconds") or 0.0)
+    session_means = [statistics.mean(run["total_seconds"] for run in session_runs) for session_runs in runs if session_runs]
+    return {
+        "sessions": sessions,
+        "patients": len(all_runs),
+        "errors": len(errors),
+        "seconds": seconds,
+        "throughput": len(all_runs) / seconds if seconds else 0.0,
+        "latency_p50": statistics.median(totals) if totals else None,
+        "latency_p95": _percentile(totals, 0.95) if totals else None,
+        "latency_max": max(totals) if totals else None,
+        "crm_wait_mean": statistics.mean(crm_waits) if crm_waits else 0.0,
+        "gemini_wait_mean": statistics.mean(gemini_waits) if gemini_waits else 0.0,
+        "session_spread": max(session_means) / min(session_means) if session_means and min(session_means) > 0 else None,
+    }
+
+def mark_ceiling(summaries):
+    """Marca ceiling=True en el primer nivel cuyo rendimiento no supera CEILING_GAIN veces el del anterior."""
+    for previous, summary in zip(summaries, summaries[1:]):
+        if summary["throughput"] < previous["throughput"] * CEILING_GAIN:
+            summary["ceiling"] = True
+            return summary
+    return None
+
+def print_report(summaries):
+    headers = ["sesiones", "pacientes", "errores", "pac/s", "p50 s", "p95 s", "máx s", "espera CRM s", "espera Gemini s", "dispersión", ""]
+    rows = [
+        [
+            str(summary["sessions"]), str(summary["patients"]), str(summary["errors"]), f"{summary['throughput']:.2f}",
+            f"{summary['latency_p50']:.2f}" if summary["latency_p50"] is not None else "-",
+            f"{summary['latency_p95']:.2f}" if summary["latency_p95"] is not None else "-",
+            f"{summary['latency_max']:.2f}" if summary["latency_max"] is not None else "-",
+            f"{summary['crm_wait_mean']:.3f}", f"{summary['gemini_wait_mean']:.3f}",
+            f"{summary['session_spread']:.2f}" if summary["session_spread"] is not None else "-",
+            "<- techo" if summary.get("ceiling") else "",
+        ]
+        for summary in summaries
+    ]
+    widths = [max(len(header), *(len(row[index]) for row in rows)) for index, header in enumerate(headers)]
+    for line in [headers] + rows:
+        print("  ".join(value.rjust(width) for value, width in zip(line, widths)).rstrip())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prueba de carga con varias sesiones de operador contra un CRM simulado y un Gemini falso.")
+    parser.add_argument("--sessions", default="1,2,4,8,16", help="Sesiones simultáneas de cada nivel, separadas por coma.")
+    parser.add_argument("--patients", type=int, default=3, help="Pacientes que consulta y analiza cada sesión.")
+    parser.add_argument("--records", type=int, default=20, help="Registros por fuente de cada paciente.")
+    parser.add_argument("--crm-latency", type=float, default=0.2, help="Segundos de latencia de cada consulta KPI.")
+    parser.add_argument("--login-latency", type=float, default=0.05, help="Segundos de latencia del login.")
+    parser.add_argument("--crm-capacity", type=int, default=0, help="Consultas KPI que el CRM simulado atiende a la vez; 0 = sin límite.")
+    parser.add_argument("--crm-limit", type=int, default=CRM_MAX_CONCURRENT_DEFAULT, help="max_concurrent_requests del entorno.")
+    parser.add_argument("--crm-per-minute", type=float, default=0, help="max_requests_per_minute del entorno; 0 = sin límite.")
+    parser.add_argument("--gemini-limit", type=int, default=GEMINI_MAX_CONCURRENT_DEFAULT, help="Llamadas simultáneas al modelo.")
+    parser.add_argument("--gemini-per-minute", type=float, default=0, help="Llamadas por minuto al modelo; 0 = sin límite.")
+    parser.add_argument("--tokens-per-second", type=float, default=400, help="Rendimiento del Gemini falso.")
+    parser.add_argument("--first-token-latency", type=float, default=0.5, help="Segundos hasta el primer token del Gemini falso.")
+    parser.add_argument("--response-tokens", type=int, default=1500, help="Tokens de cada respuesta del Gemini falso.")
+    parser.add_argument("--stream", action="store_true", help="Consume la respuesta de Gemini en streaming.")
+    parser.add_argument("--templated-sections", action="store_true", help="Arma las secciones A y C en Python; el LLM genera solo las interpretativas.")
+    parser.add_argument("--json", help="Guarda el resumen de cada nivel en este archivo.")
+    args = parser.parse_args(argv)
+
+    levels = [int(value) for value in args.sessions.split(",") if value.strip()]
+    stub = StubCrmServer(args.crm_latency, args.login_latency, capacity=args.crm_capacity or None).start()
+    FakeGemini(args.tokens_per_second, args.first_token_latency, args.response_tokens).install()
+    concurrency_limits.MODEL_LIMITS[BENCHMARK_MODEL] = (args.gemini_limit, args.gemini_per_minute)
+    cache_dir = tempfile.mkdtemp(prefix="sugos-load-test-")
+    analysis_cache.directory = os.path.join(cache_dir, "analyses")
+    patient_store.path = os.path.join(cache_dir, "patients.sqlite3")
+    model_latency_stats.path = os.path.join(cache_dir, "model_latency.json")
+    config = {
+        "display_name": "Prueba de carga", "api_base_url": stub.base_url, "kpi_cache_ttl": 0,
+        "max_concurrent_requests": args.crm_limit, "max_requests_per_minute": args.crm_per_minute,
+    }
+    run_kwargs = {"token_budget": PROMPT_TOKEN_BUDGET_DEFAULT, "stream": args.stream, "templated_sections": args.templated_sections}
+
+    summaries = []
+    try:
+        stub.prepare(args.records)
+        for sessions in levels:
+            seconds, runs, errors = run_level(config, sessions, args.patients, args.records, run_kwargs)
+            for error in errors[:3]:
+                print(f"Error con {sessions} sesiones: {error}", file=sys.stderr)
+            summaries.append(summarize(sessions, seconds, runs, errors))
+    finally:
+        stub.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    ceiling = mark_ceiling(summaries)
+    print_report(summaries)
+    if ceiling is not None:
+        print(f"Techo: el rendimiento deja de crecer con {ceiling['sessions']} sesiones ({ceiling['throughput']:.2f} pacientes/s).")
+    else:
+        print("El rendimiento siguió creciendo en todos los niveles; pruebe con más sesiones.")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "summaries": summaries}, f, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
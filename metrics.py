@@ -0,0 +1,113 @@
+"""Métricas por etapa de cada consulta: tiempos, bytes, registros, tokens y aciertos de caché."""
+import contextlib
+import json
+import os
+import threading
+import time
+
+METRICS_LOG_PATH = os.environ.get(
+    "SUGOS_METRICS_LOG",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "metrics.jsonl")
+)
+# Archivo .prom para el textfile collector de node_exporter; vacío lo desactiva
+METRICS_TEXTFILE_PATH = os.environ.get("SUGOS_METRICS_TEXTFILE", "")
+
+# Campo numérico de una etapa -> métrica acumulada en el textfile de Prometheus
+PROMETHEUS_COUNTERS = {
+    "seconds": ("sugos_stage_seconds_total", "Segundos acumulados por etapa."),
+    "decode_seconds": ("sugos_stage_decode_seconds_total", "Segundos de decodificación JSON por etapa."),
+    "bytes": ("sugos_stage_bytes_total", "Bytes recibidos por etapa."),
+    "records": ("sugos_stage_records_total", "Registros procesados por etapa."),
+    "prompt_tokens": ("sugos_stage_prompt_tokens_total", "Tokens de prompt enviados por etapa."),
+    "response_tokens": ("sugos_stage_response_tokens_total", "Tokens de respuesta recibidos por etapa."),
+    "wait_seconds": ("sugos_stage_limit_wait_seconds_total", "Segundos de espera en los límites de concurrencia por etapa."),
+}
+
+class RequestMetrics:
+    """Etapas de una consulta (ej. login, kpi_data, prompt, llm), en el orden en que terminaron."""
+
+    def __init__(self, kind, environment):
+        self.kind = kind
+        self.environment = environment
+        self.started_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.stages = []
+        self._start_time = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name, **values):
+        """Mide la duración del bloque; el diccionario entregado acepta más valores (bytes, cache...)."""
+        entry = {"stage": name, **values}
+        start_time = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry["seconds"] = time.perf_counter() - start_time
+            self.stages.append(entry)
+
+    def add(self, name, seconds, **values):
+        """Registra una etapa medida en otro lugar (ej. en un hilo de trabajo)."""
+        self.stages.append({"stage": name, "seconds": seconds, **values})
+
+    def to_dict(self):
+        return {
+            "kind": self.kind,
+            "environment": self.environment,
+            "started_at": self.started_at,
+            "total_seconds": time.perf_counter() - self._start_time,
+            "stages": self.stages,
+        }
+
+class MetricsRecorder:
+    """Guarda cada consulta como una línea JSON y mantiene los contadores del proceso para Prometheus."""
+
+    def __init__(self, log_path, textfile_path):
+        self.log_path = log_path
+        self.textfile_path = textfile_path
+        self._counters = {}  # (métrica, kind, etapa, cache) -> valor acumulado
+        self._lock = threading.Lock()
+
+    def record(self, request_metrics):
+        """Agrega la consulta al log y actualiza el textfile; devuelve el diccionario registrado."""
+        entry = request_metrics.to_dict()
+        with self._lock:
+            try:
+                if self.log_path:
+                    os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+                    with open(self.log_path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                if self.textfile_path:
+                    self._update_counters(entry)
+                    self._write_textfile()
+            except OSError:
+                pass  # Las métricas nunca deben interrumpir la consulta
+        return entry
+
+    def _update_counters(self, entry):
+        for stage in entry["stages"]:
+            labels = (entry["kind"], stage["stage"], stage.get("cache") or "")
+            runs_key = ("sugos_stage_runs_total",) + labels
+            self._counters[runs_key] = self._counters.get(runs_key, 0) + 1
+            for field, (metric, _) in PROMETHEUS_COUNTERS.items():
+                if isinstance(stage.get(field), (int, float)):
+                    key = (metric,) + labels
+                    self._counters[key] = self._counters.get(key, 0) + stage[field]
+
+    def _write_textfile(self):
+        helps = {"sugos_stage_runs_total": "Ejecuciones por etapa."}
+        helps.update(PROMETHEUS_COUNTERS.values())
+        lines = []
+        for metric, help_text in helps.items():
+            samples = sorted((key[1:], value) for key, value in self._counters.items() if key[0] == metric)
+            if not samples:
+                continue
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for (kind, stage, cache), value in samples:
+                lines.append(f'{metric}{{kind="{kind}",stage="{stage}",cache="{cache}"}} {value}')
+        os.makedirs(os.path.dirname(self.textfile_path) or ".", exist_ok=True)
+        tmp_path = f"{self.textfile_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.textfile_path)
+
+metrics_recorder = MetricsRecorder(METRICS_LOG_PATH, METRICS_TEXTFILE_PATH)
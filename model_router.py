@@ -0,0 +1,129 @@
+"""Selección automática del modelo Gemini según el tamaño del prompt y la latencia observada de cada modelo."""
+import collections
+import json
+import os
+import threading
+import time
+
+FLASH_MODEL = "gemini-2.5-flash-lite-preview-06-17"
+PRO_MODEL = "gemini-2.5-pro"
+AUTO_MODEL = "auto"  # Opción del selector que delega la elección en route_models
+
+AUTO_FLASH_MAX_PROMPT_TOKENS = 50_000    # Hasta este tamaño de prompt se prefiere flash
+AUTO_FLASH_MAX_RECORDS = 200             # ...y hasta esta cantidad de registros
+AUTO_LATENCY_BUDGET_SECONDS = 180        # Timeout del primer intento; si se supera se reintenta con el otro modelo
+GENERATION_TIMEOUT_SECONDS = 600         # Timeout de una llamada sin reintento posterior
+LATENCY_HISTORY = 50                     # Observaciones guardadas por modelo
+LATENCY_MIN_OBSERVATIONS = 3             # Observaciones necesarias para estimar la latencia de un modelo
+LATENCY_TIMEOUT_WINDOW_SECONDS = 1800    # Un timeout deja de excluir al modelo pasada esta ventana
+
+MODEL_LATENCY_PATH = os.environ.get(
+    "SUGOS_MODEL_LATENCY_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "model_latency.json")
+)
+
+class ModelLatencyStats:
+    """Últimas llamadas de cada modelo (tokens de prompt, segundos, si hubo timeout, cuándo), persistidas en JSON."""
+
+    def __init__(self, path, history=LATENCY_HISTORY):
+        self.path = path
+        self.history = history
+        self._observations = None  # modelo -> deque de [tokens, segundos, timeout, epoch]; se carga al primer uso
+        self._lock = threading.Lock()
+
+    def record(self, model_name, prompt_tokens, seconds, timed_out=False):
+        """Agrega una llamada y guarda el archivo (los errores de disco se ignoran)."""
+        with self._lock:
+            observations = self._load().setdefault(model_name, collections.deque(maxlen=self.history))
+            observations.append([int(prompt_tokens or 0), round(seconds, 3), bool(timed_out), round(time.time())])
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({name: list(values) for name, values in self._observations.items()}, f)
+                os.replace(tmp_path, self.path)
+            except OSError:
+                pass
+
+    def predict_seconds(self, model_name, prompt_tokens):
+        """Latencia esperada para prompt_tokens o None si no hay suficientes observaciones.
+
+        Devuelve infinito si el modelo tuvo un timeout en los últimos
+        LATENCY_TIMEOUT_WINDOW_SECONDS con un prompt de ese tamaño o menor; los
+        timeouts más viejos se ignoran para que el modelo vuelva a probarse.
+        """
+        with self._lock:
+            observations = list(self._load().get(model_name, ()))
+        window_start = time.time() - LATENCY_TIMEOUT_WINDOW_SECONDS
+        # Las observaciones de versiones anteriores no tienen fecha y cuentan como viejas
+        if any(value[2] and value[0] <= prompt_tokens and (value[3:] or [0])[0] >= window_start for value in observations):
+            return float("inf")
+        completed = [(value[0], value[1]) for value in observations if not value[2]]
+        if len(completed) < LATENCY_MIN_OBSERVATIONS:
+            return None
+        # Recta segundos = base + pendiente * tokens por mínimos cuadrados
+        mean_tokens = sum(tokens for tokens, _ in completed) / len(completed)
+        mean_seconds = sum(seconds for _, seconds in completed) / len(completed)
+        variance = sum((tokens - mean_tokens) ** 2 for tokens, _ in completed)
+        slope = 0.0
+        if variance:
+            slope = max(0.0, sum((tokens - mean_tokens) * (seconds - mean_seconds) for tokens, seconds in completed) / variance)
+        base = max(0.0, mean_seconds - slope * mean_tokens)
+        return base + slope * prompt_tokens
+
+    def summary(self):
+        """{modelo: {"calls", "timeouts", "median_seconds"}} de las observaciones guardadas."""
+        with self._lock:
+            observations = {name: list(values) for name, values in self._load().items()}
+        result = {}
+        for model_name, values in observations.items():
+            seconds = sorted(value[1] for value in values if not value[2])
+            result[model_name] = {
+                "calls": len(values),
+                "timeouts": sum(1 for value in values if value[2]),
+                "median_seconds": seconds[len(seconds) // 2] if seconds else None,
+            }
+        return result
+
+    def _load(self):
+        if self._observations is None:
+            self._observations = {}
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    stored = json.load(f)
+                for model_name, values in stored.items():
+                    self._observations[model_name] = collections.deque(values, maxlen=self.history)
+            except (OSError, ValueError, AttributeError):
+                pass
+        return self._observations
+
+model_latency_stats = ModelLatencyStats(MODEL_LATENCY_PATH)
+
+def route_models(prompt_tokens, record_count, latency_budget=AUTO_LATENCY_BUDGET_SECONDS):
+    """Devuelve ([modelo principal, modelo de respaldo], motivo) para el modo automático.
+
+    Prompts pequeños van a flash y grandes a pro; si la latencia observada del
+    elegido supera latency_budget y el otro modelo se espera más rápido, se invierten.
+    """
+    if prompt_tokens <= AUTO_FLASH_MAX_PROMPT_TOKENS and record_count <= AUTO_FLASH_MAX_RECORDS:
+        primary, fallback, reason = FLASH_MODEL, PRO_MODEL, "prompt pequeño"
+    else:
+        primary, fallback, reason = PRO_MODEL, FLASH_MODEL, "prompt grande"
+    primary_seconds = model_latency_stats.predict_seconds(primary, prompt_tokens)
+    fallback_seconds = model_latency_stats.predict_seconds(fallback, prompt_tokens)
+    if primary_seconds is not None and primary_seconds > latency_budget and (fallback_seconds is None or fallback_seconds < primary_seconds):
+        primary, fallback, reason = fallback, primary, "latencia observada"
+    return [primary, fallback], reason
+
+def is_timeout_error(error):
+    """True si el error corresponde a un timeout de la llamada a Gemini."""
+    if isinstance(error, TimeoutError):
+        return True
+    try:
+        from google.api_core import exceptions as google_exceptions
+        if isinstance(error, google_exceptions.DeadlineExceeded):
+            return True
+    except ImportError:
+        pass
+    message = str(error).lower()
+    return "deadline" in message or "timed out" in message or "timeout" in message
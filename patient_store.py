@@ -0,0 +1,255 @@
+"""Almacén local (SQLite) de los datos KPI consultados y del último análisis de cada paciente.
+
+Sobrevive a recargas del navegador y reinicios del servidor: una consulta
+repetida se sirve desde aquí mientras los datos sigan vigentes.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from kpi_records import KpiRecordSetBuilder
+
+PATIENT_STORE_PATH = os.environ.get(
+    "SUGOS_PATIENT_STORE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "patients.sqlite3")
+)
+PATIENT_STORE_RETENTION_DAYS = float(os.environ.get("SUGOS_PATIENT_STORE_RETENTION_DAYS", "30"))
+PURGE_INTERVAL_SECONDS = 3600  # Cada cuánto se eliminan, como mucho, los datos vencidos
+STATS_TTL_SECONDS = 30  # Vigencia de stats() si no hubo escrituras; la barra lateral lo pide en cada rerun
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kpi_sets (
+    environment TEXT NOT NULL,
+    country_id TEXT NOT NULL,
+    kpi_name TEXT NOT NULL,
+    envelope TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    response_bytes INTEGER NOT NULL,
+    fetched_at REAL NOT NULL,   -- Última vez que cambiaron los datos
+    checked_at REAL NOT NULL,   -- Última vez que se confirmaron contra la API
+    PRIMARY KEY (environment, country_id, kpi_name)
+);
+CREATE INDEX IF NOT EXISTS kpi_sets_by_checked_at ON kpi_sets (checked_at);
+CREATE TABLE IF NOT EXISTS kpi_records (
+    environment TEXT NOT NULL,
+    country_id TEXT NOT NULL,
+    kpi_name TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    record_id TEXT,
+    record_date TEXT,           -- ISO 8601, para consultas por rango de fechas
+    record TEXT NOT NULL,
+    PRIMARY KEY (environment, country_id, kpi_name, position)
+);
+CREATE INDEX IF NOT EXISTS kpi_records_by_date ON kpi_records (environment, country_id, record_date, kpi_name);
+CREATE TABLE IF NOT EXISTS patient_reports (
+    environment TEXT NOT NULL,
+    country_id TEXT NOT NULL,
+    text TEXT NOT NULL,
+    model TEXT,
+    prompt_version TEXT,
+    covered TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    stored_at REAL NOT NULL,
+    PRIMARY KEY (environment, country_id)
+);
+CREATE INDEX IF NOT EXISTS patient_reports_by_stored_at ON patient_reports (stored_at);
+"""
+
+def _fingerprint(envelope, records):
+    """Huella de la respuesta a partir del JSON ya serializado para guardarla (sin volver a armar la respuesta completa)."""
+    digest = hashlib.sha256(envelope.encode("utf-8"))
+    for record in records:
+        digest.update(b"\0")
+        digest.update(record.encode("utf-8"))
+    return digest.hexdigest()
+
+class PatientStore:
+    """Datos KPI normalizados (un registro por fila) y último análisis por (entorno, cédula).
+
+    Usa una conexión por hilo y el modo WAL, así que las lecturas no esperan a las escrituras.
+    """
+
+    def __init__(self, path, retention_days=PATIENT_STORE_RETENTION_DAYS):
+        self.path = path
+        self.retention_days = retention_days
+        self._local = threading.local()
+        self._last_purge = 0.0
+        self._initialized_path = None  # Ruta cuyo esquema y modo WAL ya se configuraron
+        self._stats = (None, 0.0, None)  # (ruta, momento, resultado) del último stats()
+        self._lock = threading.Lock()
+
+    def get_kpi(self, environment, country_id, kpi_name, max_age):
+        """(KpiRecordSet, bytes de la respuesta original, checked_at) si se confirmó contra la API hace menos de max_age segundos; si no, None."""
+        connection = self._connection()
+        if connection is None or max_age <= 0:
+            return None
+        key = (environment, str(country_id), kpi_name)
+        try:
+            row = connection.execute(
+                "SELECT envelope, response_bytes, checked_at FROM kpi_sets WHERE environment = ? AND country_id = ? AND kpi_name = ? AND checked_at >= ?",
+                key + (time.time() - max_age,)
+            ).fetchone()
+            if row is None:
+                return None
+            records = connection.execute(
+                "SELECT record FROM kpi_records WHERE environment = ? AND country_id = ? AND kpi_name = ? ORDER BY position", key
+            ).fetchall()
+        except sqlite3.Error:
+            return None
+        builder = KpiRecordSetBuilder()
+        for (record,) in records:
+            builder.add(json.loads(record))
+        return builder.build(json.loads(row[0])), row[1], row[2]
+
+    def put_kpi(self, environment, country_id, kpi_name, record_set, response_bytes):
+        """Guarda la respuesta; si no cambió respecto de la guardada solo renueva checked_at.
+
+        Devuelve True si los datos cambiaron (o eran nuevos).
+        """
+        connection = self._connection()
+        if connection is None:
+            return False
+        key = (environment, str(country_id), kpi_name)
+        envelope = json.dumps(record_set.envelope, ensure_ascii=False, default=str)
+        records = [json.dumps(record.to_dict(), ensure_ascii=False, default=str) for record in record_set.records]
+        fingerprint = _fingerprint(envelope, records)
+        now = time.time()
+        try:
+            with connection:
+                updated = connection.execute(
+                    "UPDATE kpi_sets SET checked_at = ? WHERE environment = ? AND country_id = ? AND kpi_name = ? AND fingerprint = ?",
+                    (now,) + key + (fingerprint,)
+                ).rowcount
+                if updated:
+                    return False
+                connection.execute("DELETE FROM kpi_records WHERE environment = ? AND country_id = ? AND kpi_name = ?", key)
+                connection.execute(
+                    "INSERT OR REPLACE INTO kpi_sets VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    key + (envelope, fingerprint, int(response_bytes or 0), now, now)
+                )
+                connection.executemany(
+                    "INSERT INTO kpi_records VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        key + (
+                            position,
+                            None if record.id is None else str(record.id),
+                            record.timestamp.isoformat() if record.timestamp else None,
+                            serialized,
+                        )
+                        for position, (record, serialized) in enumerate(zip(record_set.records, records))
+                    ]
+                )
+        except sqlite3.Error:
+            return False
+        self._stats = (None, 0.0, None)
+        self._purge_if_due()
+        return True
+
+    def get_report(self, report_key):
+        """Último análisis del paciente: {"text", "model", "prompt_version", "covered", "created_at"} o None.
+
+        report_key = (api_base_url, cédula).
+        """
+        connection = self._connection()
+        if connection is None:
+            return None
+        try:
+            row = connection.execute(
+                "SELECT text, model, prompt_version, covered, created_at FROM patient_reports WHERE environment = ? AND country_id = ?",
+                (str(report_key[0]), str(report_key[1]))
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        return {"text": row[0], "model": row[1], "prompt_version": row[2], "covered": json.loads(row[3]), "created_at": row[4]}
+
+    def put_report(self, report_key, text, model_name, prompt_version, covered, created_at=None):
+        """Guarda el análisis del paciente; covered es {sección: [claves de registros]} (clinical_llm.covered_record_ids)."""
+        connection = self._connection()
+        if connection is None:
+            return
+        try:
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO patient_reports VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (str(report_key[0]), str(report_key[1]), text, model_name, prompt_version,
+                     json.dumps(covered, ensure_ascii=False), created_at or time.strftime("%Y-%m-%dT%H:%M:%S"), time.time())
+                )
+        except sqlite3.Error:
+            pass
+        self._stats = (None, 0.0, None)
+        self._purge_if_due()
+
+    def purge(self):
+        """Elimina los datos y análisis no confirmados en los últimos retention_days días."""
+        connection = self._connection()
+        if connection is None:
+            return
+        cutoff = time.time() - self.retention_days * 86400
+        try:
+            with connection:
+                connection.execute("DELETE FROM kpi_sets WHERE checked_at < ?", (cutoff,))
+                connection.execute(
+                    "DELETE FROM kpi_records WHERE NOT EXISTS (SELECT 1 FROM kpi_sets WHERE kpi_sets.environment = kpi_records.environment "
+                    "AND kpi_sets.country_id = kpi_records.country_id AND kpi_sets.kpi_name = kpi_records.kpi_name)"
+                )
+                connection.execute("DELETE FROM patient_reports WHERE stored_at < ?", (cutoff,))
+        except sqlite3.Error:
+            pass
+        self._stats = (None, 0.0, None)
+
+    def stats(self):
+        """Devuelve (pacientes con datos, análisis guardados, bytes en disco); se recalcula cada STATS_TTL_SECONDS."""
+        path, computed_at, cached = self._stats
+        if path == self.path and time.time() - computed_at < STATS_TTL_SECONDS:
+            return cached
+        connection = self._connection()
+        if connection is None:
+            return 0, 0, 0
+        try:
+            patients = connection.execute("SELECT COUNT(*) FROM (SELECT DISTINCT environment, country_id FROM kpi_sets)").fetchone()[0]
+            reports = connection.execute("SELECT COUNT(*) FROM patient_reports").fetchone()[0]
+        except sqlite3.Error:
+            return 0, 0, 0
+        size = sum(os.path.getsize(path) for path in (self.path, f"{self.path}-wal") if os.path.exists(path))
+        self._stats = (self.path, time.time(), (patients, reports, size))
+        return patients, reports, size
+
+    def _connection(self):
+        """Conexión del hilo actual (o None si el almacén está desactivado o no se puede abrir).
+
+        Cada rerun de Streamlit corre en un hilo nuevo: el esquema y el modo WAL
+        (que queda guardado en el archivo) se configuran una sola vez por ruta.
+        """
+        if not self.path:
+            return None
+        connection = getattr(self._local, "connection", None)
+        if connection is not None and self._local.path == self.path:
+            return connection
+        try:
+            if self._initialized_path != self.path:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            if self._initialized_path != self.path:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.executescript(SCHEMA)
+                self._initialized_path = self.path
+        except (OSError, sqlite3.Error):
+            return None
+        self._local.connection, self._local.path = connection, self.path
+        self._purge_if_due()
+        return connection
+
+    def _purge_if_due(self):
+        with self._lock:
+            if time.time() - self._last_purge < PURGE_INTERVAL_SECONDS:
+                return
+            self._last_purge = time.time()
+        self.purge()
+
+patient_store = PatientStore(PATIENT_STORE_PATH)
@@ -0,0 +1,154 @@
+"""Precarga especulativa de los datos del paciente en cuanto se ingresa la cédula.
+
+La precarga autentica y consulta las fuentes KPI en segundo plano; el botón
+"1. Obtener..." reclama el resultado con take() en lugar de volver a consultar.
+"""
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from concurrency_limits import bind_session, current_session
+from crm_api import PATIENT_DATA_SOURCES, fetch_patient_data, get_api_token
+from ui_messages import call_collecting_messages
+
+PREFETCH_WORKERS = int(os.environ.get("SUGOS_PREFETCH_WORKERS", "4"))  # Precargas en curso en todo el proceso
+PREFETCH_MAX_PER_SESSION = 2    # Precargas en curso por sesión de Streamlit
+PREFETCH_TTL_SECONDS = 120      # Vigencia de una precarga terminada que nadie reclamó
+PREFETCH_WAIT_SECONDS = 60      # Cuánto espera take() a una precarga que sigue en curso
+COUNTRY_ID_PATTERN = re.compile(r"\d{5,12}")  # Solo se precargan cédulas completas
+
+def is_prefetchable_country_id(country_id):
+    return bool(COUNTRY_ID_PATTERN.fullmatch(country_id or ""))
+
+class Prefetch:
+    """Una precarga: sesión, (entorno, usuario API, cédula), resultados de fetch_patient_data y estado."""
+
+    def __init__(self, session, request):
+        self.session = session
+        self.request = request
+        self.country_id = request[2]
+        self.finished_at = None
+        self.results = []
+        self.cancelled = False
+        self.done = threading.Event()
+        self.future = None
+
+    @property
+    def expired(self):
+        return self.finished_at is not None and time.time() - self.finished_at > PREFETCH_TTL_SECONDS
+
+class PatientPrefetcher:
+    """Precargas compartidas por todas las sesiones del proceso.
+
+    Cada precarga pertenece a la sesión que la inició (el id pasado a
+    concurrency_limits.set_session; por defecto la del hilo actual): todas las
+    sesiones pueden usar las mismas credenciales API, así que solo esa sesión la
+    reclama. Una cédula nueva cancela las precargas anteriores de la sesión y, con
+    max_per_session precargas aún en curso, no se inicia otra.
+    """
+
+    def __init__(self, max_workers, max_per_session=PREFETCH_MAX_PER_SESSION):
+        self.max_per_session = max_per_session
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._prefetches = {}  # (sesión, entorno, usuario API, cédula) -> Prefetch
+        self._counts = {"started": 0, "used": 0, "cancelled": 0, "expired": 0}
+        self._lock = threading.Lock()
+
+    def start(self, api_username, api_password, country_id, config, concurrent=True, session=None):
+        """Inicia la precarga de la cédula; devuelve False si ya existía o se alcanzó el límite de la sesión."""
+        session = current_session() if session is None else session
+        request = (config.get('api_base_url'), api_username, country_id)
+        with self._lock:
+            self._evict()
+            existing = self._prefetches.get((session,) + request)
+            if existing is not None and not existing.cancelled:
+                return False
+            for prefetch in list(self._prefetches.values()):
+                if prefetch.session == session and not prefetch.cancelled:
+                    self._cancel(prefetch)
+            running = sum(1 for prefetch in self._prefetches.values() if prefetch.session == session and not prefetch.done.is_set())
+            if running >= self.max_per_session:
+                return False
+            prefetch = Prefetch(session, request)
+            self._prefetches[(session,) + request] = prefetch
+            self._counts["started"] += 1
+            prefetch.future = self._executor.submit(bind_session(self._run), prefetch, api_username, api_password, config, concurrent)
+        return True
+
+    def take(self, api_username, country_id, config, timeout=PREFETCH_WAIT_SECONDS, session=None):
+        """Resultados de la precarga de la cédula hecha por la sesión (uno por fuente) o None si no hay una utilizable.
+
+        Espera hasta timeout segundos si sigue en curso. Los resultados llevan
+        source='prefetch' y en seconds lo que se esperó aquí.
+        """
+        key = (current_session() if session is None else session, config.get('api_base_url'), api_username, country_id)
+        start_time = time.time()
+        with self._lock:
+            prefetch = self._prefetches.get(key)
+        if prefetch is None or prefetch.cancelled or not prefetch.done.wait(timeout):
+            return None
+        with self._lock:
+            if self._prefetches.get(key) is not prefetch or prefetch.cancelled or prefetch.expired:
+                return None
+            del self._prefetches[key]
+            # Sin todas las fuentes (ej. falló el login) se consulta de nuevo y se informa el error allí
+            if len(prefetch.results) != len(PATIENT_DATA_SOURCES):
+                return None
+            self._counts["used"] += 1
+        waited = time.time() - start_time
+        return [result._replace(source="prefetch", seconds=waited, wait_seconds=0.0) for result in prefetch.results]
+
+    def cancel(self, session=None):
+        """Cancela las precargas de la sesión (ej. al refrescar desde la API)."""
+        session = current_session() if session is None else session
+        with self._lock:
+            for prefetch in list(self._prefetches.values()):
+                if prefetch.session == session and not prefetch.cancelled:
+                    self._cancel(prefetch)
+
+    def stats(self):
+        """{"running", "ready", "started", "used", "cancelled", "expired"} de las precargas."""
+        with self._lock:
+            self._evict()
+            prefetches = list(self._prefetches.values())
+            counts = dict(self._counts)
+        return {
+            "running": sum(1 for prefetch in prefetches if not prefetch.done.is_set()),
+            "ready": sum(1 for prefetch in prefetches if prefetch.done.is_set() and not prefetch.cancelled),
+            **counts,
+        }
+
+    def _run(self, prefetch, api_username, api_password, config, concurrent):
+        try:
+            if prefetch.cancelled:
+                return
+            token, _ = call_collecting_messages(get_api_token, api_username, api_password, config)
+            if not token:
+                return
+            for result in fetch_patient_data(token, prefetch.country_id, config, concurrent=concurrent):
+                prefetch.results.append(result)
+                if prefetch.cancelled:
+                    # Las consultas ya lanzadas terminan; no se inicia ninguna más
+                    break
+        finally:
+            prefetch.finished_at = time.time()
+            prefetch.done.set()
+
+    def _cancel(self, prefetch):
+        prefetch.cancelled = True
+        self._counts["cancelled"] += 1
+        if prefetch.future is not None and prefetch.future.cancel():
+            prefetch.finished_at = time.time()
+            prefetch.done.set()
+
+    def _evict(self):
+        # Se descartan las canceladas ya detenidas y las terminadas que nadie reclamó a tiempo
+        for key, prefetch in list(self._prefetches.items()):
+            if prefetch.done.is_set() and (prefetch.cancelled or prefetch.expired):
+                del self._prefetches[key]
+                if not prefetch.cancelled:
+                    self._counts["expired"] += 1
+
+patient_prefetcher = PatientPrefetcher(PREFETCH_WORKERS)
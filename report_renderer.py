@@ -0,0 +1,83 @@
+"""Renderizado del análisis en streaming: escribe el informe por secciones a medida que llega."""
+import re
+import time
+
+# Un informe se divide en secciones en cada encabezado markdown o "**A. ...".
+REPORT_SECTION_BREAK = re.compile(r"(?m)^(?=#{1,4} |\*\*[A-E]\. )")
+
+class StreamingReportRenderer:
+    """Muestra el análisis por secciones a medida que llegan los fragmentos del LLM.
+
+    Las secciones completas se escriben una sola vez; solo la sección en curso se
+    vuelve a dibujar, como mucho cada min_interval segundos. Para seguir un trabajo
+    de la cola se conserva en la sesión entre ejecuciones del fragmento: attach
+    vuelve a dibujar lo ya recibido y add recibe solo el texto nuevo, así que los
+    tiempos al primer token y al primer contenido se miden una sola vez.
+    """
+
+    def __init__(self, container, start_time, min_interval=0.25, job_id=None):
+        self.container = container
+        self.start_time = start_time
+        self.job_id = job_id
+        self.min_interval = min_interval
+        self.text = ""
+        self.rendered_upto = 0  # Caracteres de self.text ya escritos como secciones completas
+        self.current_placeholder = None
+        self.last_render = 0.0
+        self.first_token_seconds = None
+        self.first_content_seconds = None
+        self.section_placeholders = None  # Un espacio por sección en la generación por secciones en paralelo
+        self.sections = None              # Texto mostrado en cada espacio de section_placeholders
+
+    def attach(self, container):
+        """Dibuja en container lo recibido hasta ahora (cada ejecución del fragmento descarta los elementos anteriores)."""
+        self.container = container
+        self.current_placeholder = None
+        self.last_render = 0.0
+        if self.sections is not None:
+            self.section_placeholders = [container.empty() for _ in self.sections]
+            for placeholder, section_text in zip(self.section_placeholders, self.sections):
+                if section_text is not None:
+                    placeholder.markdown(section_text)
+        elif self.text[:self.rendered_upto].strip():
+            container.markdown(self.text[:self.rendered_upto])
+
+    def add(self, chunk_text):
+        if self.first_token_seconds is None:
+            self.first_token_seconds = time.time() - self.start_time
+        self.text += chunk_text
+        section_starts = [match.start() for match in REPORT_SECTION_BREAK.finditer(self.text, self.rendered_upto)]
+        complete_upto = max([start for start in section_starts if start > self.rendered_upto], default=self.rendered_upto)
+        if complete_upto > self.rendered_upto:
+            self._render_current(self.text[self.rendered_upto:complete_upto])
+            self.current_placeholder = None
+            self.rendered_upto = complete_upto
+        if time.time() - self.last_render >= self.min_interval:
+            self._render_current(self.text[self.rendered_upto:])
+
+    def add_section(self, index, section_count, section_text):
+        """Muestra una sección generada por separado en su lugar, aunque las anteriores no hayan terminado."""
+        if self.section_placeholders is None:
+            self.section_placeholders = [self.container.empty() for _ in range(section_count)]
+            self.sections = [None] * section_count
+        if self.first_token_seconds is None:
+            self.first_token_seconds = time.time() - self.start_time
+        if self.sections[index] == section_text:
+            return
+        self.sections[index] = section_text
+        self.section_placeholders[index].markdown(section_text)
+        if self.first_content_seconds is None:
+            self.first_content_seconds = time.time() - self.start_time
+
+    def finish(self):
+        self._render_current(self.text[self.rendered_upto:])
+
+    def _render_current(self, section_text):
+        if not section_text.strip():
+            return
+        if self.current_placeholder is None:
+            self.current_placeholder = self.container.empty()
+        self.current_placeholder.markdown(section_text)
+        self.last_render = time.time()
+        if self.first_content_seconds is None:
+            self.first_content_seconds = self.last_render - self.start_time
@@ -0,0 +1,216 @@
+"""Secciones del informe que son extracción de campos (A y C), armadas en Python sin pasar por el LLM.
+
+El LLM genera solo las secciones interpretativas; ReportMerger intercala las
+de aquí en su respuesta según los títulos "X. TÍTULO", también en streaming.
+"""
+import re
+
+from kpi_records import parse_record_date
+
+# Título de sección en una línea: "A. IDENTIFICACIÓN...", "### B. ANTECEDENTES", "**D. GENERACIÓN...**".
+# El título empieza con una palabra en mayúsculas, así que "E. Coli..." no es un título.
+HEADING_PATTERN = re.compile(r"[#*_ \t]*([A-E])\.[ \t]+\**[A-ZÁÉÍÓÚÑ]{2}")
+HEADING_MAX_CHARS = 40  # Una línea incompleta más larga que esto ya no puede ser un título
+NOT_AVAILABLE = "No disponible"
+HEART_RATE_UNIT = "x'"  # Latidos por minuto, como en la plantilla del prompt
+
+def _records(combined_json_data_for_llm, payload_key):
+    records = (combined_json_data_for_llm.get(payload_key) or {}).get("Records") or []
+    return [record for record in records if isinstance(record, dict)]
+
+def _chronological(records):
+    """Registros ordenados por fecha; los que no tienen fecha reconocible van al final, en su orden."""
+    return sorted(records, key=lambda record: (parse_record_date(record.get("Date")) is None, parse_record_date(record.get("Date")) or 0))
+
+def _format_date(value):
+    """dd/mm/aaaa HH:MM AM/PM, o el valor tal cual si no se reconoce la fecha."""
+    date = parse_record_date(value)
+    if date is None:
+        return str(value) if value not in (None, "") else NOT_AVAILABLE
+    return date.strftime("%d/%m/%Y %I:%M %p")
+
+def _text(value):
+    """Texto de un campo; None si está vacío. Los objetos anidados aportan sus valores."""
+    if isinstance(value, dict):
+        value = ", ".join(str(item) for item in value.values() if item not in (None, ""))
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    return str(value).strip()
+
+def _items(value):
+    """Lista de objetos de un campo como Diagnostics, Exams o Medicines (que puede llegar como un solo objeto)."""
+    if isinstance(value, dict):
+        return [value]
+    return [item for item in value or () if item not in (None, "", {})]
+
+def _measure(value, unit):
+    # 0 en un signo vital significa que no se tomó
+    if _text(value) is None or value in (0, "0"):
+        return "No registrado"
+    return f"{value} {unit}"
+
+def _patient(combined_json_data_for_llm):
+    for payload_key in ("medical_history", "exam_results"):
+        for record in _records(combined_json_data_for_llm, payload_key):
+            if isinstance(record.get("Patient"), dict):
+                return record["Patient"]
+    return {}
+
+def render_identification(combined_json_data_for_llm):
+    """Sección A: identificación del paciente, conteos y fechas de atención."""
+    patient = _patient(combined_json_data_for_llm)
+    consultations = _chronological(_records(combined_json_data_for_llm, "medical_history"))
+    dates = ", ".join(_format_date(record.get("Date")) for record in consultations) or NOT_AVAILABLE
+    return "\n".join([
+        "### A. IDENTIFICACIÓN DEL PACIENTE",
+        "",
+        f"- **Nombre:** {_text(patient.get('Name')) or NOT_AVAILABLE}",
+        f"- **Cédula (referencial):** {_text(patient.get('CountryID')) or NOT_AVAILABLE}",
+        f"- **Número de Atenciones (Consultas Médicas):** {len(consultations)}",
+        f"- **Fechas de Atenciones (Consultas Médicas):** {dates}",
+        f"- **Número de Exámenes Registrados:** {len(_records(combined_json_data_for_llm, 'exam_results'))}",
+    ])
+
+def _render_consultation(record):
+    doctor = record.get("Doctor") if isinstance(record.get("Doctor"), dict) else {}
+    vital_signs = record.get("VitalSigns") if isinstance(record.get("VitalSigns"), dict) else {}
+    physical_exam = record.get("PhysicalExam")
+    if isinstance(physical_exam, dict):
+        exam_type, description = _text(physical_exam.get("Type")), _text(physical_exam.get("Description"))
+        physical_exam = f"({exam_type}) {description or 'Sin descripción'}" if exam_type else description
+    else:
+        physical_exam = _text(physical_exam)
+    lines = [
+        f"#### Consulta {_text(record.get('ID')) or NOT_AVAILABLE}",
+        "",
+        f"- **Doctor:** {_text(doctor.get('Name')) or NOT_AVAILABLE}",
+        f"- **Especialidad:** {_text(doctor.get('Specialty')) or NOT_AVAILABLE}",
+        f"- **Fecha de consulta:** {_format_date(record.get('Date'))}",
+        f"- **Motivo de Consulta:** {_text(record.get('Reason')) or NOT_AVAILABLE}",
+        f"- **Enfermedad Actual / Padecimiento:** {_text(record.get('Sickness')) or NOT_AVAILABLE}",
+        "- **Signos Vitales:** "
+        f"TAS: {_measure(vital_signs.get('TAS'), 'mmHg')}, TAD: {_measure(vital_signs.get('TAD'), 'mmHg')}, "
+        f"FC: {_measure(vital_signs.get('FC'), HEART_RATE_UNIT)}, Peso: {_measure(vital_signs.get('Weight'), 'Kg')}, "
+        f"Talla: {_measure(vital_signs.get('Size'), 'Mts')}",
+        f"- **Examen Físico:** {physical_exam or 'No registrado'}",
+    ]
+    diagnostics = _items(record.get("Diagnostics"))
+    lines.append("- **Diagnósticos:**" + ("" if diagnostics else " Sin diagnósticos registrados para este evento"))
+    lines += [f"    - {_text(item.get('ID')) or NOT_AVAILABLE} - {_text(item.get('Name')) or NOT_AVAILABLE}" for item in diagnostics if isinstance(item, dict)]
+    exams = _items(record.get("Exams"))
+    lines.append("- **Exámenes Indicados/Realizados:**" + ("" if exams else " Sin exámenes indicados/realizados para este evento"))
+    lines += [f"    - {_text(item.get('ID')) or NOT_AVAILABLE} - {_text(item.get('Name')) or NOT_AVAILABLE}" for item in exams if isinstance(item, dict)]
+    medicines = _items(record.get("Medicines"))
+    lines.append("- **Medicamentos:**" + ("" if medicines else " Sin medicamentos recetados para este evento"))
+    for item in medicines:
+        if not isinstance(item, dict):
+            continue
+        details = ", ".join(part for part in (_text(item.get("Generic")), _text(item.get("Code"))) if part)
+        lines.append(
+            f"    - {_text(item.get('Name')) or NOT_AVAILABLE}" + (f" ({details})" if details else "")
+            + f" - Dosis/Presentación: {_text(item.get('Presentation')) or NOT_AVAILABLE}"
+            + f" - Indicaciones: {_text(item.get('Indications')) or NOT_AVAILABLE}"
+            + f" - Laboratorio: {_text(item.get('Laboratory')) or NOT_AVAILABLE}"
+        )
+    lines.append(f"- **Indicaciones Generales/Comentarios:** {_text(record.get('Comments')) or 'Sin comentarios'}")
+    try:
+        rest_days = float(record.get("RestDays") or 0)
+    except (TypeError, ValueError):
+        rest_days = 0
+    if rest_days > 0:
+        lines.append(f"- **Días de Reposo:** {record['RestDays']}")
+    return "\n".join(lines)
+
+def render_consultations(combined_json_data_for_llm):
+    """Sección C: cada consulta de medical_history, en orden cronológico."""
+    consultations = _chronological(_records(combined_json_data_for_llm, "medical_history"))
+    heading = "### C. ORGANIZACIÓN CRONOLÓGICA DE DATOS POR EVENTO DE ATENCIÓN (CONSULTA MÉDICA)"
+    if not consultations:
+        return f"{heading}\n\nNo hay eventos de atención médica registrados."
+    return "\n\n".join([heading] + [_render_consultation(record) for record in consultations])
+
+# Letra de la sección -> función que la arma desde el payload
+TEMPLATED_SECTIONS = {
+    "A": render_identification,
+    "C": render_consultations,
+}
+
+def render_templated_sections(combined_json_data_for_llm):
+    """{letra: texto} de las secciones de TEMPLATED_SECTIONS."""
+    return {letter: render(combined_json_data_for_llm) for letter, render in TEMPLATED_SECTIONS.items()}
+
+class ReportMerger:
+    """Intercala las secciones armadas ({letra: texto}) en el texto del LLM a medida que llega.
+
+    Cada sección se inserta antes del primer título con una letra posterior; las
+    que no encuentran lugar van al final (close). Solo se retiene la línea en curso
+    mientras todavía puede ser un título. El resultado no depende de cómo llegue
+    partido el texto: merge_report(...) == "".join(feed(...) de cada fragmento) + close().
+    """
+
+    def __init__(self, rendered_sections):
+        self._pending = sorted(rendered_sections.items())
+        self._line = ""
+        self._line_checked = False  # La línea en curso ya se descartó como título
+        self._emitted = False       # Ya se entregó (o se está por entregar en este feed) algún texto
+        self._last_letter = ""      # Letra del último título; uno con una letra anterior o igual no es un título
+
+    def feed(self, text):
+        """Devuelve el texto que ya se puede mostrar."""
+        output = []
+        lines = (self._line + text).split("\n")
+        self._line = lines.pop()
+        for line in lines:
+            self._append(output, (line if self._line_checked else self._check_heading(line)) + "\n")
+            self._line_checked = False
+        if self._line and not self._line_checked and (len(self._line) >= HEADING_MAX_CHARS or HEADING_PATTERN.match(self._line)):
+            self._append(output, self._check_heading(self._line))
+            self._line, self._line_checked = "", True
+        elif self._line_checked:
+            self._append(output, self._line)
+            self._line = ""
+        return "".join(output)
+
+    def close(self):
+        """Resto del texto, con las secciones que no encontraron lugar al final."""
+        output = []
+        self._append(output, self._line if self._line_checked else self._check_heading(self._line))
+        self._line, self._line_checked = "", False
+        for _, text in self._pending:
+            self._append(output, ("\n\n" if self._emitted else "") + text)
+        self._pending = []
+        return "".join(output)
+
+    def _check_heading(self, line):
+        match = HEADING_PATTERN.match(line)
+        if not match or match.group(1) <= self._last_letter:
+            return line
+        self._last_letter = match.group(1)
+        inserted = [text for letter, text in self._pending if letter < match.group(1)]
+        if not inserted:
+            return line
+        self._pending = [(letter, text) for letter, text in self._pending if letter >= match.group(1)]
+        return ("\n" if self._emitted else "") + "".join(text + "\n\n" for text in inserted) + line
+
+    def _append(self, output, text):
+        if text:
+            output.append(text)
+            self._emitted = True
+
+def merge_report(rendered_sections, generated_text):
+    """Informe completo: generated_text con las secciones armadas intercaladas en su lugar."""
+    merger = ReportMerger(rendered_sections)
+    return (merger.feed(generated_text) + merger.close()).strip()
+
+def strip_sections(report_text, letters):
+    """Quita del informe las secciones de letters (de su título al siguiente)."""
+    kept, skipping, last_letter = [], False, ""
+    for line in report_text.split("\n"):
+        match = HEADING_PATTERN.match(line)
+        # Como en ReportMerger, los títulos van en orden: una letra que no avanza es texto
+        if match and match.group(1) > last_letter:
+            last_letter = match.group(1)
+            skipping = match.group(1) in letters
+        if not skipping:
+            kept.append(line)
+    return "\n".join(kept).strip()
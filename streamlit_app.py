@@ -1,356 +1,43 @@
 import streamlit as st
-import requests
 import os
-from urllib.parse import urljoin, urlencode
 import json # Para el pretty print del JSON y para el LLM
 import time # Para spinners y posibles timeouts
-from bs4 import BeautifulSoup # Para limpiar HTML si el LLM tiene problemas
+import functools
+import uuid
 
 # --- IMPORTACIONES PARA GEMINI ---
-import google.generativeai as genai
+# La generación con Gemini y el prompt viven en clinical_llm.py
+from clinical_llm import (
+    generate_clinical_analysis_with_llm,
+    PROMPT_INSTRUCTIONS_TEMPLATE,
+    build_llm_payload,
+    compact_llm_payload,
+    raw_response_bytes,
+    last_analysis_stats,
+    PROMPT_TOKEN_BUDGET_DEFAULT,
+)
 # ----------------------------------
 
 # --- Configuración API ---
-# (Sin cambios respecto al original)
-
-# --- Funciones de Ayuda ---
-
-def get_api_token(api_username, api_password, config):
-    """Autentica contra la API y devuelve un token."""
-    api_base_url = config.get('api_base_url')
-    if not api_base_url:
-        st.error("Error: 'api_base_url' no definida en la configuración del entorno.")
-        return None
-
-    login_url = urljoin(api_base_url, "custom/apps/api.php?login")
-    payload = {"username": api_username, "password": api_password}
-    headers = {'Content-Type': 'application/json'}
-
-    try:
-        response = requests.post(login_url, json=payload, headers=headers, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-        token = data.get("token") or data.get("access_token") or data.get("data", {}).get("token")
-
-        if not token:
-            st.error(f"Login fallido: No se pudo encontrar token en la respuesta. Respuesta: {data}")
-            return None
-        return token
-    except requests.exceptions.HTTPError as e:
-        st.error(f"Error HTTP {e.response.status_code} durante la autenticación en {login_url}.")
-        if e.response.status_code == 401:
-            st.error("Credenciales inválidas o no autorizadas.")
-        else:
-            try:
-                st.error(f"Respuesta del servidor: {e.response.text}")
-            except Exception:
-                st.error("No se pudo obtener el detalle de la respuesta del servidor.")
-        return None
-    except requests.exceptions.RequestException as e:
-        st.error(f"Error de conexión durante la autenticación a {login_url}: {e}")
-        return None
-    except Exception as e:
-        st.error(f"Error inesperado procesando el login: {e}")
-        return None
-
-def get_kpi_data(token, country_id, config):
-    """Obtiene datos del endpoint de KPI para historias médicas."""
-    api_base_url = config.get('api_base_url')
-    if not api_base_url:
-        st.error("Error: 'api_base_url' no definida en la configuración del entorno.")
-        return None
-
-    kpi_action_params = {"afn": "admin", "cfn": "kpis"}
-    kpi_endpoint_path = "custom/apps/api.php"
-    kpi_url = f"{urljoin(api_base_url, kpi_endpoint_path)}?{urlencode(kpi_action_params)}"
-
-    payload = {
-        "page-id": "kpis",
-        "section-id": "kpis",
-        "kpi-name": "medicalrecords",
-        "country-ids": country_id
-    }
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json'
-    }
-
-    try:
-        response = requests.get(kpi_url, headers=headers, json=payload, timeout=60) # GET con payload en JSON
-        response.raise_for_status()
-        data = response.json()
-        return data
-    except requests.exceptions.HTTPError as e:
-        st.error(f"Error HTTP {e.response.status_code} al obtener datos de Historias Médicas desde {kpi_url}.")
-        try:
-            st.error(f"Respuesta del servidor (HM): {e.response.text}")
-        except Exception:
-            st.error("No se pudo obtener el detalle de la respuesta del servidor (HM).")
-        return None
-    except requests.exceptions.RequestException as e:
-        st.error(f"Error de conexión al obtener datos de Historias Médicas desde {kpi_url}: {e}")
-        return None
-    except json.JSONDecodeError:
-        st.error(f"Error decodificando JSON de la respuesta de Historias Médicas ({kpi_url}). Respuesta recibida:")
-        st.code(response.text, language='text')
-        return None
-    except Exception as e:
-        st.error(f"Error inesperado al obtener datos de Historias Médicas: {e}")
-        return None
-
-def get_exam_data(token, country_id, config):
-    """Obtiene datos del endpoint de KPI para resultados de exámenes."""
-    api_base_url = config.get('api_base_url')
-    if not api_base_url:
-        st.error("Error: 'api_base_url' no definida en la configuración del entorno.")
-        return None
-
-    kpi_action_params = {"afn": "admin", "cfn": "kpis"}
-    kpi_endpoint_path = "custom/apps/api.php"
-    kpi_url = f"{urljoin(api_base_url, kpi_endpoint_path)}?{urlencode(kpi_action_params)}"
-
-    payload = {
-        "page-id": "kpis",
-        "section-id": "kpis",
-        "kpi-name": "exams", # Modificado para exámenes
-        "country-ids": country_id
-    }
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json'
-    }
-
-    try:
-        response = requests.get(kpi_url, headers=headers, json=payload, timeout=60) # GET con payload en JSON
-        response.raise_for_status()
-        data = response.json()
-        return data
-    except requests.exceptions.HTTPError as e:
-        st.error(f"Error HTTP {e.response.status_code} al obtener datos de Exámenes desde {kpi_url}.")
-        try:
-            st.error(f"Respuesta del servidor (Exámenes): {e.response.text}")
-        except Exception:
-            st.error("No se pudo obtener el detalle de la respuesta del servidor (Exámenes).")
-        return None
-    except requests.exceptions.RequestException as e:
-        st.error(f"Error de conexión al obtener datos de Exámenes desde {kpi_url}: {e}")
-        return None
-    except json.JSONDecodeError:
-        st.error(f"Error decodificando JSON de la respuesta de Exámenes ({kpi_url}). Respuesta recibida:")
-        st.code(response.text, language='text')
-        return None
-    except Exception as e:
-        st.error(f"Error inesperado al obtener datos de Exámenes: {e}")
-        return None
-
-def get_lab_data(token, country_id, config):
-    """Obtiene datos del endpoint de KPI para resultados de exámenes."""
-    api_base_url = config.get('api_base_url')
-    if not api_base_url:
-        st.error("Error: 'api_base_url' no definida en la configuración del entorno.")
-        return None
-
-    kpi_action_params = {"afn": "admin", "cfn": "kpis"}
-    kpi_endpoint_path = "custom/apps/api.php"
-    kpi_url = f"{urljoin(api_base_url, kpi_endpoint_path)}?{urlencode(kpi_action_params)}"
-
-    payload = {
-        "page-id": "kpis",
-        "section-id": "kpis",
-        "kpi-name": "labresults", # Modificado para exámenes
-        "country-ids": country_id
-    }
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json'
-    }
-
-    try:
-        response = requests.get(kpi_url, headers=headers, json=payload, timeout=60) # GET con payload en JSON
-        response.raise_for_status()
-        data = response.json()
-        return data
-    except requests.exceptions.HTTPError as e:
-        st.error(f"Error HTTP {e.response.status_code} al obtener datos de Exámenes desde {kpi_url}.")
-        try:
-            st.error(f"Respuesta del servidor (Exámenes): {e.response.text}")
-        except Exception:
-            st.error("No se pudo obtener el detalle de la respuesta del servidor (Exámenes).")
-        return None
-    except requests.exceptions.RequestException as e:
-        st.error(f"Error de conexión al obtener datos de Exámenes desde {kpi_url}: {e}")
-        return None
-    except json.JSONDecodeError:
-        st.error(f"Error decodificando JSON de la respuesta de Exámenes ({kpi_url}). Respuesta recibida:")
-        st.code(response.text, language='text')
-        return None
-    except Exception as e:
-        st.error(f"Error inesperado al obtener datos de Exámenes: {e}")
-        return None
-
-
-
-# --- FUNCIÓN PARA GEMINI ---
-def generate_clinical_analysis_with_llm(combined_json_data_for_llm, model_name, prompt_instructions_template, gemini_api_key):
-    """Genera análisis clínico usando Gemini."""
-    try:
-        genai.configure(api_key=gemini_api_key)
-        model = genai.GenerativeModel(model_name)
-
-        json_string_for_prompt = json.dumps(combined_json_data_for_llm, indent=2, ensure_ascii=False)
-        full_prompt = prompt_instructions_template.replace("{json_data_placeholder}", json_string_for_prompt)
-
-        # st.subheader("Prompt enviado al LLM (para depuración):")
-        # st.text_area("Prompt:", full_prompt, height=300)
-
-        generation_config = genai.GenerationConfig(
-            temperature=0.2,
-            max_output_tokens=131072 # Aumentado para permitir respuestas más largas si es necesario. Verifica límites de modelo.
-                                   # Gemini 1.5 Pro tiene 1M tokens, Flash 1M, pero la respuesta puede ser menor.
-                                   # `max_output_tokens` en `GenerationConfig` suele referirse a la *respuesta*.
-                                   # La longitud total (prompt + respuesta) es manejada por `model.count_tokens`.
-        )
-
-        response = model.generate_content(
-            full_prompt,
-            generation_config=generation_config,
-            request_options={'timeout': 600} # 10 minutos de timeout
-        )
-        # Simple HTML cleaner for ExamResults (optional, LLM might handle it)
-        #soup = BeautifulSoup(response.text, "html.parser")
-        #return soup.get_text() # This would strip ALL html, might be too aggressive.
-        # It's better to let the LLM do the smart extraction as instructed in the prompt.
-        return response.text
-
-    except genai.types.generation_types.BlockedPromptException as blocked_error:
-        st.error("Error: La solicitud al LLM fue bloqueada por políticas de seguridad.")
-        try:
-            feedback = getattr(blocked_error, 'response', {}).get('prompt_feedback', None)
-            if feedback: st.warning(f"Razón del bloqueo: {feedback}")
-            # Check if response object exists and has prompt_feedback attribute
-            # This part might be tricky as 'response' might not be fully formed in a BlockedPromptException
-            # For now, rely on the feedback from the exception itself if available.
-        except Exception: pass
-        return None
-    except Exception as e:
-        st.error(f"Ocurrió un error durante la generación con el LLM: {e}")
-        if hasattr(e, 'message'): st.error(f"Detalle: {e.message}")
-        # If the error is about token limits, it might be in the response or exception details
-        if "token limit" in str(e).lower():
-            st.warning("El prompt o la respuesta podrían haber excedido el límite de tokens del modelo.")
-        return None
-
-# --- Prompt para Gemini (Instrucciones para el Análisis Clínico) ---
-PROMPT_INSTRUCTIONS_TEMPLATE = """
-Instrucciones Detalladas para la Generación del Análisis Clínico:
-
-Interpretación del JSON:
-Aquí está el JSON con los datos del paciente:
-{json_data_placeholder}
-
-Este JSON contiene dos claves principales: "medical_history" y "exam_results".
-- Para "medical_history": Analiza el JSON para extraer todos los registros médicos del paciente de `medical_history.Records`. Procesa todos los objetos dentro de ese array.
-- Para "exam_results": Analiza el JSON para extraer los resultados de los exámenes del paciente de `exam_results.Records`.
-- Para "lab_results": Analiza el JSON para extraer los resultados de los laboratorios del paciente de `lab_results.Records`.
-
-Analiza el JSON proporcionado para extraer toda la información relevante.
-Consolidación del Historial Médico y Exámenes:
-
-Reúne toda la información relevante de cada registro para construir un informe completo y cronológico.
-Generación del Análisis Clínico (siguiendo un esquema de referencia tipo PDF):
-El informe final debe estructurarse de la siguiente manera. Si alguna información no está disponible en el JSON para un campo específico del esquema de referencia, indícalo claramente (ej. "No disponible en JSON" o "Dato no suministrado").
-
-A. IDENTIFICACIÓN DEL PACIENTE (Extraer de la sección "medical_history")
-
-Nombre: (Extraer de `medical_history.Records[0].Patient.Name` si `medical_history.Records` existe y no está vacío, o el primer `Patient.Name` que encuentres en `medical_history`. Si no hay datos en `medical_history` pero sí en `exam_results`, usa `exam_results.Records[0].Patient.Name`.)
-Cédula (referencial): (Extraer de `medical_history.Records[0].Patient.CountryID` de forma similar. Si no, de `exam_results`.)
-Número de Atenciones (Consultas Médicas): (Contar el número de registros en `medical_history.Records`. Si `medical_history` o `medical_history.Records` es nulo o vacío, indicar 0 o "No disponible".)
-Fechas de Atenciones (Consultas Médicas): (Listar todas las `Date` de los registros en `medical_history.Records`, formateadas dd/mm/aaaa HH:MM AM/PM. Si es nulo o vacío, indicar "No disponible".)
-Número de Exámenes Registrados: (Contar el número de registros en `exam_results.Records`. Si `exam_results` o `exam_results.Records` es nulo o vacío, indicar 0 o "No disponible".)
-
-B. ANTECEDENTES (Consolidar de todos los registros en `medical_history.Records`, principalmente de `History.Description`. Buscar patrones o información recurrente.)
-
-Personales: (Condiciones médicas preexistentes, alergias, hábitos, etc., de `History.Description` y `Sickness` si es relevante para el historial general).
-Familiares: (Condiciones médicas en la familia del paciente, si se menciona en `History.Description`).
-Quirúrgicos: (Intervenciones quirúrgicas previas, si se mencionan en `History.Description`).
-Ginecológicos: (Si se mencionan en `History.Description`).
-Epidemiológicos/Otros: (Inmunizaciones, exposición a enfermedades, viajes, hábitos específicos como tabaquismo (Tabáquicos), alcohol (OH), ocupación, etc., desde `History.Description`).
-(Si no hay datos en `medical_history.Records` para antecedentes, indicar "No hay información de antecedentes disponible en las historias médicas".)
-
-C. ORGANIZACIÓN CRONOLÓGICA DE DATOS POR EVENTO DE ATENCIÓN (CONSULTA MÉDICA)
-(Para cada registro en `medical_history.Records` dentro del JSON proporcionado):
-
-Consulta [ID del Registro] (Usar el `ID` principal del registro, ej. "Consulta 2750")
-Doctor: (Usar Doctor.Name)
-Especialidad: (Usar Doctor.Specialty)
-Fecha de consulta: (Usar `Date`)
-Motivo de Consulta: (Usar `Reason`)
-Enfermedad Actual / Padecimiento: (Usar `Sickness`. Describir la condición que llevó a la consulta).
-Signos Vitales: (TAS: `VitalSigns.TAS` mmHg, TAD: `VitalSigns.TAD` mmHg, FC: `VitalSigns.FC` x', Peso: `VitalSigns.Weight` Kg, Talla: `VitalSigns.Size` Mts. Indicar "0", "No registrado" o "No aplica" si el valor es 0, null o no es pertinente para la consulta).
-Examen Físico: (Usar `PhysicalExam.Description`. Indicar si está vacío o no aplica. Notar `PhysicalExam.Type`).
-Diagnósticos: (Listar cada diagnóstico de `Diagnostics`: [ID] - [Name]. Si `Diagnostics` es null, vacío, o no aplica, indicar "Sin diagnósticos registrados para este evento" o similar).
-Exámenes Indicados/Realizados (durante la consulta): (Listar cada examen de `Exams`: [ID] - [Name]. Si `Exams` es null, vacío, o no aplica, indicar "Sin exámenes indicados/realizados para este evento").
-Tratamiento(s), Plan de Acción y Comentarios:
-Medicamentos: (Listar cada medicamento de `Medicines`: [Name] ([Generic], [Code]) - Dosis/Presentación: [Presentation] - Indicaciones: [Indications] - Laboratorio: [Laboratory]. Si `Medicines` es null o no aplica, indicar "Sin medicamentos recetados para este evento").
-Indicaciones Generales/Comentarios: (Usar `Comments`. Ejemplo: "Reposo por RestDays días", "Uso de epicondilera 15 días").
-Días de Reposo: (Usar `RestDays` si es > 0).
-(Si no hay datos en `medical_history.Records`, esta sección debe indicar "No hay eventos de atención médica registrados".)
-
-D. GENERACIÓN DE RESUMEN Y ANÁLISIS LONGITUDINAL (Basado en `medical_history.Records`)
-
-Resumen Conciso de la Atención por Evento: (Para cada fecha de atención en `medical_history.Records`, resumir brevemente: ej. "dd/mm/aaaa: Consulta por [Motivo principal]. Diagnóstico(s) principal(es): [Diagnósticos]. Tratamiento principal: [Medicamento/Indicación].")
-Análisis Longitudinal de Hallazgos Positivos y Negativos:
-Condiciones Clínicas Persistentes/Recurrentes: (Identificar condiciones que aparecen en múltiples registros o que se mencionan como crónicas en los antecedentes).
-Evolución de Diagnósticos: (Cómo han cambiado, se han resuelto o se han añadido diagnósticos con el tiempo).
-Tendencias en Signos Vitales: (Si hay suficientes datos, comentar tendencias en peso, TAS/TAD, etc.).
-Respuesta a Tratamientos (si se puede inferir): (Mencionar si se observa mejoría, recurrencia a pesar del tratamiento, o efectos secundarios, basado en `Comments` o consultas subsecuentes).
-Patrones Notables: (Cualquier otro patrón observado: tipos de medicamentos frecuentemente recetados, necesidad de múltiples consultas para un mismo problema, adherencia (si se infiere), etc.).
-Alertas y Recomendaciones (basadas en el análisis de `medical_history`): (Conclusión general sobre el estado de salud del paciente según las consultas, posibles riesgos identificados, y si se desprenden recomendaciones generales del análisis consolidado de las consultas).
-(Si no hay datos en `medical_history.Records`, esta sección debe indicar "No es posible realizar análisis longitudinal sin historial de consultas médicas".)
-
-E. RESULTADOS DE EXÁMENES COMPLEMENTARIOS (Estudios y Laboratorios)
-(Basado en `exam_results.Records`. Si `exam_results` o `exam_results.Records` es nulo o vacío, indicar "No hay resultados de exámenes disponibles".)
-(Basado en `lab_results.Records`. Si `lab_results` o `lab_results.Records` es nulo o vacío, indicar "No hay resultados de laboratorios disponibles".)
-
-Para cada tipo de examen (agrupado por `ExamType.Type`) presente en `exam_results.Records`:
-Presenta la información agrupada por el `ExamType.Type`. Para cada examen dentro de ese tipo:
-
-[NOMBRE DEL TIPO DE EXAMEN - Ej: ULTRASONIDO PARTES BLANDAS]
-  - Fecha del Examen: (Extraer de `Date`, formateada dd/mm/aaaa)
-  - ID del Examen (referencial): (Extraer de `ID`)
-  - Código del Examen (referencial): (Extraer de `ExamType.Code`)
-  - Unidad (referencial): (Extraer de `ExamType.Unit`)
-  - Hallazgos Principales: (Analizar el contenido de `ExamResults`. Este campo contiene HTML. Extrae el texto significativo, elimina las etiquetas HTML y resume los hallazgos clave y la conclusión si está presente. Si el contenido es muy extenso, enfócate en la sección de conclusión o hallazgos principales. Sé conciso y claro.)
-
-Ejemplo de cómo debería verse esta sección E: para el caso de Examenes
-
-E. RESULTADOS DE EXÁMENES COMPLEMENTARIOS (Estudios y Laboratorios)
-
-ULTRASONIDO PARTES BLANDAS
-  - Fecha del Examen: 19/01/2024
-  - ID del Examen: 6681
-  - Código del Examen: ULT0516JS
-  - Unidad: Ultrasonido
-  - Hallazgos Principales: Exploración región base del pene. Visualización de capas en piel, musculares y tejido adiposo sin alteraciones. Se evidencia L.O.E., redondeada, mixta, a predominio líquido, con grumos, de 4 x 6 mm, en plano superficial. No se observa neoformación vascular. Conclusión: Signos ecográficos sugerentes de absceso en recidiva.
-
-Ejemplo de cómo debería verse esta sección E: para el caso de Laboratorio
-  - Fecha del Examen: 19/01/2025
-  - ID del Laboratorio: 6681
-  - UROANALISIS 
-        . EX. ORINA COMPLETA 
-            -> EX. MACROSCOPICO 
-                    [COLOR] : Amarillo (Unidad si se tiene)
-                    [CANTIDAD] : Escasas (Unidad si se tiene)
-
-Incluye una Tabla, para los examenes como un cuadro final del analisis, la idea es agrupar en una tabla los examenes con los diferentes valores obtenidos a través del tiempo
-Columnas: LabResults.ExamType (Tipo de Examen), LabResults.Exam (Examen), LabResults.Section (Seccion), LabResults.Item (Elemento), Date (Fecha) y LabResults.Value (Resultado), LabResults.Unit (Unidad)
-
-Formato de Salida:
-El resultado debe ser un texto bien estructurado claro y profesional, emulando la formalidad y detalle de un resumen clínico. No incluyas esta sección de "Instrucciones" en la salida final, solo el análisis clínico.
-
-Nota Importante:
-La información del paciente es sensible. El análisis debe centrarse en los datos clínicos y evitar juicios o información no pertinente. Asegúrate de manejar correctamente los casos donde los datos (`medical_history`, `exam_results` o sus `Records`) puedan ser nulos o vacíos, indicando "No disponible" o una frase similar en lugar de generar un error.
-"""
+# Autenticación, sesiones HTTP y consultas KPI viven en crm_api.py
+from crm_api import (
+    get_api_token,
+    last_token_source,
+    PATIENT_DATA_SOURCES,
+    fetch_patient_data,
+    kpi_response_cache,
+)
+from analysis_cache import analysis_cache
+from analysis_jobs import analysis_job_queue
+from app_resources import environment_configs
+from concurrency_limits import limiter_stats, set_session
+from patient_store import patient_store
+from prefetch import is_prefetchable_country_id, patient_prefetcher
+from lab_table import build_lab_results_table, pivot_lab_results, lab_results_csv
+from metrics import RequestMetrics, metrics_recorder
+from model_router import AUTO_MODEL, FLASH_MODEL, PRO_MODEL, model_latency_stats
+from report_renderer import StreamingReportRenderer
+from ui_messages import render_message
 
 # --- Interfaz de Streamlit ---
 
@@ -362,6 +49,200 @@ st.markdown("""
 - Luego, podrá generar un **Análisis Clínico Estructurado** utilizando IA Generativa.
 """)
 
+# --- Métricas por etapa ---
+METRICS_HISTORY = 5 # Consultas que se conservan en la sesión para el panel de métricas
+STAGE_LABELS = {
+    "login": "Autenticación",
+    "kpi_data": "HMs",
+    "exam_data": "Exámenes",
+    "lab_data": "Laboratorio",
+    "lab_table": "Tabla de laboratorios",
+    "prompt": "Armado del prompt",
+    "queue": "Espera en cola",
+    "llm": "Gemini",
+}
+
+def record_request_metrics(request_metrics):
+    """Guarda las métricas de la consulta en el log/textfile y en la sesión para el panel."""
+    entry = metrics_recorder.record(request_metrics)
+    st.session_state.request_metrics = ([entry] + st.session_state.request_metrics)[:METRICS_HISTORY]
+
+def render_metrics_panel():
+    """Desglose por etapa de las últimas consultas, en la barra lateral."""
+    with st.sidebar.expander("Métricas por etapa", expanded=False):
+        queue_stats = analysis_job_queue.stats()
+        st.caption(
+            f"Cola de análisis: {queue_stats['queued']} en espera, {queue_stats['running']} en curso "
+            f"({queue_stats['workers']} a la vez)"
+            + (f" · espera media {queue_stats['mean_wait_seconds']:.1f} s" if queue_stats["mean_wait_seconds"] is not None else "")
+            + (f" · espera máx. {queue_stats['max_wait_seconds']:.1f} s" if queue_stats["max_wait_seconds"] is not None else "")
+        )
+        prefetch_stats = patient_prefetcher.stats()
+        if prefetch_stats["started"]:
+            st.caption(
+                f"Precargas: {prefetch_stats['running']} en curso, {prefetch_stats['ready']} listas · "
+                f"{prefetch_stats['used']} usadas, {prefetch_stats['cancelled']} canceladas, "
+                f"{prefetch_stats['expired']} vencidas de {prefetch_stats['started']}"
+            )
+        limits = [values for values in limiter_stats() if values["calls"]]
+        if limits:
+            st.caption("Límites de concurrencia (todas las sesiones):")
+            st.dataframe(
+                [
+                    {
+                        "Límite": values["name"],
+                        "En curso": f"{values['active']}/{values['max_concurrent']}",
+                        "En espera": values["queued"],
+                        "Por minuto": values["per_minute"] or None,
+                        "Llamadas": values["calls"],
+                        "Espera media s": round(values["mean_wait_seconds"], 2) if values["mean_wait_seconds"] is not None else None,
+                        "Espera máx. s": round(values["max_wait_seconds"], 2) if values["max_wait_seconds"] is not None else None,
+                    }
+                    for values in limits
+                ],
+                hide_index=True,
+                use_container_width=True
+            )
+        model_latency = model_latency_stats.summary()
+        if model_latency:
+            st.caption("Latencia observada por modelo (selección automática):")
+            st.dataframe(
+                [
+                    {
+                        "Modelo": model_name,
+                        "Llamadas": values["calls"],
+                        "Timeouts": values["timeouts"],
+                        "Mediana s": round(values["median_seconds"], 1) if values["median_seconds"] is not None else None,
+                    }
+                    for model_name, values in model_latency.items()
+                ],
+                hide_index=True,
+                use_container_width=True
+            )
+        if not st.session_state.request_metrics:
+            st.caption("Aún no hay consultas en esta sesión.")
+            return
+        for entry in st.session_state.request_metrics:
+            st.caption(f"**{entry['kind'].capitalize()}** · {entry['started_at']} · total {entry['total_seconds']:.2f} s")
+            st.dataframe(
+                [
+                    {
+                        "Etapa": STAGE_LABELS.get(stage["stage"], stage["stage"]),
+                        "s": round(stage["seconds"], 2),
+                        "Caché": {"hit": "sí", "miss": "no"}.get(stage.get("cache"), ""),
+                        "KB": round(stage["bytes"] / 1024, 1) if stage.get("bytes") is not None else None,
+                        "Registros": stage.get("records"),
+                        "Decodif. s": round(stage["decode_seconds"], 3) if stage.get("decode_seconds") is not None else None,
+                        "Tokens prompt": stage.get("prompt_tokens"),
+                        "Tokens resp.": stage.get("response_tokens"),
+                        "Espera límite s": round(stage["wait_seconds"], 2) if stage.get("wait_seconds") else None,
+                        "Modelo": stage.get("model"),
+                    }
+                    for stage in entry["stages"]
+                ],
+                hide_index=True,
+                use_container_width=True
+            )
+
+# --- Análisis en segundo plano ---
+ANALYSIS_POLL_SECONDS = 1.0 # Cada cuánto se consulta el estado del trabajo en la cola
+
+@st.fragment(run_every=ANALYSIS_POLL_SECONDS)
+def render_analysis_job():
+    """Estado y progreso del análisis encolado; al terminar guarda el resultado y recarga la página."""
+    job = analysis_job_queue.get(st.session_state.analysis_job_id)
+    if job is None:
+        st.session_state.analysis_job_id = None
+        st.session_state.analysis_messages = [("warning", "El análisis en curso ya no está disponible (¿se reinició la app?). Vuelva a generarlo.")]
+        st.rerun()
+    if job.finished:
+        finish_analysis_job(job)
+        st.rerun()
+
+    if job.status == "queued":
+        st.info(
+            f"Análisis en cola ({job.label}): posición {analysis_job_queue.position(job.id)} "
+            f"de {analysis_job_queue.stats()['queued']} · esperando hace {job.wait_seconds():.0f} s."
+        )
+        return
+    if job.sections:
+        progress = f" · {sum(1 for section in job.sections if section is not None)} de {len(job.sections)} secciones"
+    elif job.text:
+        progress = f" · {len(job.text):,} caracteres recibidos"
+    else:
+        progress = ""
+    st.info(f"Generando análisis clínico ({job.label})... {job.run_seconds():.0f} s{progress}")
+    if job.sections or job.text:
+        st.subheader("Resultado del Análisis Clínico:")
+        renderer = st.session_state.analysis_renderer
+        if renderer is None or renderer.job_id != job.id:
+            renderer = StreamingReportRenderer(st.container(), job.started_at, job_id=job.id)
+            st.session_state.analysis_renderer = renderer
+        else:
+            renderer.attach(st.container())
+        if job.sections:
+            for index, section_text in enumerate(list(job.sections)):
+                if section_text is not None:
+                    renderer.add_section(index, len(job.sections), section_text)
+        else:
+            job_text = job.text
+            renderer.add(job_text[len(renderer.text):])
+            renderer.finish()
+
+def run_analysis_job(job, combined_data_for_llm, model_name, gemini_api_key, stream_output, **generate_kwargs):
+    """Cuerpo del trabajo (corre en un hilo de la cola, sin acceso a st.session_state)."""
+    analysis_text = generate_clinical_analysis_with_llm(
+        combined_data_for_llm, model_name, PROMPT_INSTRUCTIONS_TEMPLATE, gemini_api_key,
+        on_chunk=job.add_chunk if stream_output else None,
+        on_section=job.add_section if stream_output else None,
+        **generate_kwargs
+    )
+    job.stats = last_analysis_stats()
+    return analysis_text
+
+def finish_analysis_job(job):
+    """Pasa el resultado del trabajo a la sesión: análisis, mensajes y métricas."""
+    request_metrics = st.session_state.analysis_job_metrics
+    if request_metrics is not None:
+        analysis_stats = job.stats
+        request_metrics.add("queue", job.wait_seconds())
+        request_metrics.add(
+            "llm", job.run_seconds(),
+            cache="hit" if analysis_stats.get("mode") in ("cache", "reuse") else "miss",
+            mode=analysis_stats.get("mode"),
+            model=analysis_stats.get("model"),
+            prompt_tokens=analysis_stats.get("prompt_tokens"),
+            response_tokens=analysis_stats.get("response_tokens"),
+            wait_seconds=analysis_stats.get("wait_seconds"),
+        )
+        record_request_metrics(request_metrics)
+
+    messages = st.session_state.analysis_messages + job.messages
+    messages.append(("write", f"Proceso Completado es {job.wait_seconds() + job.run_seconds():.2f} segundos ({job.wait_seconds():.2f} s en cola)."))
+    renderer = st.session_state.analysis_renderer
+    first_content_seconds = renderer.first_content_seconds if renderer is not None and renderer.job_id == job.id else None
+    st.session_state.analysis_renderer = None
+    if job.first_output_at is not None:
+        st.session_state.llm_stream_timings = {
+            "first_token_seconds": job.first_output_at - job.started_at,
+            "first_content_seconds": first_content_seconds,
+            "queue_seconds": job.wait_seconds(),
+            "total_seconds": job.run_seconds(),
+        }
+        messages.append((
+            "caption",
+            f"Primer token a los {job.first_output_at - job.started_at:.2f} s de iniciada la generación"
+            + (f" · primer contenido en pantalla a los {first_content_seconds:.2f} s." if first_content_seconds is not None else ".")
+        ))
+    if job.result:
+        st.session_state.clinical_analysis_text = job.result
+        messages.append(("success", "Análisis clínico generado exitosamente."))
+    else:
+        messages.append(("error", "Fallo al generar el análisis clínico con el LLM."))
+    st.session_state.analysis_messages = messages
+    st.session_state.analysis_job_id = None
+    st.session_state.analysis_job_metrics = None
+
 # --- Inicializar Flags y Estado ---
 if 'kpi_run_processed' not in st.session_state:
     st.session_state.kpi_run_processed = False
@@ -373,24 +254,39 @@ if 'exam_data' not in st.session_state: # Para almacenar los datos de Exámenes
     st.session_state.exam_data = None
 if 'lab_data' not in st.session_state: # Para almacenar los datos de Laboratorios
     st.session_state.lab_data = None
+if 'kpi_country_id' not in st.session_state: # Cédula de los datos consultados
+    st.session_state.kpi_country_id = None
+if 'lab_results_table' not in st.session_state: # Tabla de laboratorios a través del tiempo (pandas)
+    st.session_state.lab_results_table = None
 if 'clinical_analysis_text' not in st.session_state: # Para almacenar el análisis del LLM
     st.session_state.clinical_analysis_text = None
+if 'llm_stream_timings' not in st.session_state: # Tiempos del último análisis en streaming
+    st.session_state.llm_stream_timings = None
+if 'analysis_renderer' not in st.session_state: # StreamingReportRenderer del trabajo en curso, conservado entre ejecuciones del fragmento
+    st.session_state.analysis_renderer = None
+if 'analysis_job_id' not in st.session_state: # Trabajo de análisis en la cola (analysis_jobs) de esta sesión
+    st.session_state.analysis_job_id = None
+if 'analysis_job_metrics' not in st.session_state: # Métricas de la consulta que originó el trabajo
+    st.session_state.analysis_job_metrics = None
+if 'analysis_messages' not in st.session_state: # Mensajes del último análisis terminado
+    st.session_state.analysis_messages = []
 if 'gemini_api_key_verified' not in st.session_state:
     st.session_state.gemini_api_key_verified = False
+if 'prefetch_request' not in st.session_state: # (entorno, usuario, cédula) de la última precarga iniciada
+    st.session_state.prefetch_request = None
+if 'request_metrics' not in st.session_state: # Métricas por etapa de las últimas consultas (la más reciente primero)
+    st.session_state.request_metrics = []
+if 'limiter_session' not in st.session_state: # Id de la sesión para la cola justa de los límites de concurrencia
+    st.session_state.limiter_session = uuid.uuid4().hex
+# Las llamadas al CRM y a Gemini de este rerun (y de sus hilos de trabajo) esperan turno como esta sesión
+set_session(st.session_state.limiter_session)
 
 
 # --- Cargar Configuraciones de Entorno ---
 selected_config = None
-ENVIRONMENT_CONFIGS = {}
 try:
-    if hasattr(st.secrets, 'items'):
-        all_secrets = st.secrets.items()
-    else:
-        all_secrets = [(key, st.secrets[key]) for key in st.secrets.keys()]
-
-    for section_key, section_content in all_secrets:
-        if isinstance(section_content, dict) and section_content.get('display_name') and section_content.get('api_base_url'):
-            ENVIRONMENT_CONFIGS[section_content['display_name']] = section_key
+    # Se recorre secrets.toml solo cuando cambia; entre reruns se reutiliza
+    ENVIRONMENT_CONFIGS = environment_configs(st.secrets, st.get_option("secrets.files") or ())
 
     if not ENVIRONMENT_CONFIGS:
         st.sidebar.error("Error: No se encontraron configuraciones de entorno válidas en secrets.toml.")
@@ -403,8 +299,7 @@ try:
         index=0,
         key="kpi_env_select"
     )
-    selected_secret_key = ENVIRONMENT_CONFIGS[selected_display_name]
-    selected_config = st.secrets[selected_secret_key]
+    selected_secret_key, selected_config = ENVIRONMENT_CONFIGS[selected_display_name]
 
 except AttributeError:
     st.sidebar.error("Error: Fallo al acceder a st.secrets. Asegúrese de que el archivo secrets.toml exista y sea accesible.")
@@ -447,6 +342,61 @@ input_api_password = st.sidebar.text_input(
 )
 st.sidebar.caption("Credenciales para el entorno CRM seleccionado.")
 
+st.sidebar.divider()
+st.sidebar.header("Opciones de Consulta")
+st.sidebar.checkbox(
+    "Consulta concurrente",
+    value=True,
+    key="kpi_concurrent_fetch",
+    help="Consulta HMs, Exámenes y Laboratorios en paralelo en lugar de uno tras otro."
+)
+st.sidebar.checkbox(
+    "Precargar al ingresar la cédula",
+    value=False,
+    key="kpi_prefetch",
+    help="Al confirmar una cédula válida, autentica y consulta los datos en segundo plano para que el botón "
+         "\"1. Obtener...\" los encuentre listos. Cambiar de cédula cancela la precarga anterior."
+)
+st.sidebar.number_input(
+    "Presupuesto de tokens del prompt",
+    min_value=10_000,
+    value=PROMPT_TOKEN_BUDGET_DEFAULT,
+    step=10_000,
+    key="llm_token_budget",
+    help="Si el prompt supera este número de tokens, el historial se resume por lotes en paralelo antes del análisis final."
+)
+st.sidebar.checkbox(
+    "Análisis incremental",
+    value=True,
+    key="llm_incremental",
+    help="Si el paciente ya tiene un análisis, envía a Gemini solo los registros nuevos junto con ese análisis. Desactívelo para reconstruir el análisis completo."
+)
+st.sidebar.checkbox(
+    "Mostrar el análisis mientras se genera",
+    value=True,
+    key="llm_stream_output",
+    help="Recibe la respuesta de Gemini en streaming y muestra cada sección en cuanto está lista."
+)
+st.sidebar.checkbox(
+    "Generar secciones en paralelo",
+    value=False,
+    key="llm_sectioned",
+    help="Pide a Gemini cada parte del informe (A-B, C, D y E) en una llamada separada y simultánea, con solo los datos que necesita, y las une en orden."
+)
+st.sidebar.checkbox(
+    "Secciones A y C sin IA",
+    value=True,
+    key="llm_templated_sections",
+    help="Arma la identificación (A) y el detalle de cada consulta (C) directamente desde las historias médicas; "
+         "Gemini genera solo antecedentes, análisis longitudinal y hallazgos de exámenes. Menos tokens de respuesta y menos espera."
+)
+cache_entries, cache_bytes = kpi_response_cache.stats()
+st.sidebar.caption(f"Caché de respuestas: {cache_entries} entradas, {cache_bytes / (1024 * 1024):.1f} MB.")
+analysis_entries, analysis_bytes = analysis_cache.stats()
+st.sidebar.caption(f"Caché de análisis: {analysis_entries} análisis, {analysis_bytes / (1024 * 1024):.1f} MB.")
+store_patients, store_reports, store_bytes = patient_store.stats()
+st.sidebar.caption(f"Almacén local: {store_patients} pacientes, {store_reports} análisis, {store_bytes / (1024 * 1024):.1f} MB.")
+
 # --- Parámetros de Consulta ---
 col1_params, col2_params = st.columns(2)
 with col1_params:
@@ -456,30 +406,61 @@ with col1_params:
         placeholder="Número de Cédula 12345678",
         key="kpi_country_id_input"
     )
+    # Precarga especulativa: se inicia una vez por (entorno, usuario, cédula); si se alcanzó
+    # el límite de la sesión se reintenta en el próximo rerun
+    if st.session_state.kpi_prefetch and selected_config:
+        prefetch_request = (selected_config.get('api_base_url'), st.session_state.kpi_api_user, input_country_id_str.strip())
+        if prefetch_request != st.session_state.prefetch_request and is_prefetchable_country_id(prefetch_request[2]) \
+                and st.session_state.kpi_api_user and st.session_state.kpi_api_pass \
+                and patient_prefetcher.start(
+                    st.session_state.kpi_api_user, st.session_state.kpi_api_pass, prefetch_request[2], selected_config,
+                    concurrent=st.session_state.kpi_concurrent_fetch, session=st.session_state.limiter_session
+                ):
+            st.session_state.prefetch_request = prefetch_request
 
 with col2_params:
     st.subheader("Modelo IA (para Análisis)")
-    model_options = ['gemini-2.5-flash-lite-preview-06-17','gemini-2.5-pro']
+    model_options = [FLASH_MODEL, PRO_MODEL, AUTO_MODEL]
     selected_model_name = st.selectbox(
         "Modelo Gemini:",
         options=model_options,
         index=0, # Default to flash
         key="llm_model_select",
-        help="Selecciona el modelo Gemini para generar el análisis clínico."
+        format_func=lambda option: "auto (según tamaño y latencia)" if option == AUTO_MODEL else option,
+        help="Selecciona el modelo Gemini para generar el análisis clínico. "
+             "'auto' elige flash o pro según el tamaño del prompt y la latencia observada, "
+             "y reintenta con el otro modelo si el primero tarda demasiado."
     )
 
 
 # --- Botón de Acción para Obtener KPIs y Exámenes ---
 st.divider()
-process_data_button_pressed = st.button(
-    "1. Obtener Historias Médicas y Exámenes",
-    key="kpi_submit_button"
-)
+col1_actions, col2_actions = st.columns([3, 1])
+with col1_actions:
+    process_data_button_pressed = st.button(
+        "1. Obtener Historias Médicas y Exámenes",
+        key="kpi_submit_button"
+    )
+with col2_actions:
+    refresh_data_button_pressed = st.button(
+        "Refrescar desde la API",
+        key="kpi_refresh_button",
+        help="Ignora los datos en caché y vuelve a consultar el CRM."
+    )
 
-if process_data_button_pressed:
+if process_data_button_pressed or refresh_data_button_pressed:
     st.session_state.kpi_data = None
     st.session_state.exam_data = None
+    st.session_state.lab_data = None
+    st.session_state.lab_results_table = None
     st.session_state.clinical_analysis_text = None
+    if st.session_state.analysis_job_id is not None: # Su resultado ya no corresponde a esta consulta
+        analysis_job_queue.cancel(st.session_state.analysis_job_id)
+    st.session_state.analysis_job_id = None
+    st.session_state.analysis_renderer = None
+    st.session_state.analysis_job_metrics = None
+    st.session_state.analysis_messages = []
+    st.session_state.llm_stream_timings = None
 
     if not selected_config:
         st.error("Error crítico: No hay configuración de entorno seleccionada.")
@@ -500,7 +481,7 @@ if process_data_button_pressed:
 
     current_country_id = current_country_id_str.strip()
     # No se convierte a int aquí, la API puede esperar string o int.
-    # La función get_kpi_data y get_exam_data lo enviarán tal cual.
+    # La función get_kpi la enviará tal cual.
     # La validación de si debe ser numérico o alfanumérico dependerá de la API.
     # Si la API requiere estrictamente un int, convertir aquí:
     # try:
@@ -512,69 +493,59 @@ if process_data_button_pressed:
     #    current_country_id_for_api = current_country_id # si puede ser alfanumérico
 
     st.session_state.kpi_clear_password_input = True
+    st.session_state.kpi_country_id = current_country_id
     st.info(f"Iniciando consulta de datos para la Cédula: {current_country_id}")
+    request_metrics = RequestMetrics("consulta", selected_config.get('display_name'))
 
-    with st.spinner("Autenticando con API del Entorno..."):
+    with st.spinner("Autenticando con API del Entorno..."), request_metrics.stage("login") as login_stage:
         token = get_api_token(current_api_user, current_api_pass, selected_config)
+        login_stage["cache"] = "hit" if last_token_source() == "cache" else "miss"
 
     if token:
         st.success(f"Autenticación API Entorno exitosa para {selected_config.get('display_name', 'entorno')}.")
-        # Obtener Historias Médicas
-        with st.spinner(f"Obteniendo HMs para Cédula: {current_country_id}..."):
-            raw_kpi_data = get_kpi_data(token, current_country_id, selected_config)
-
-        if raw_kpi_data is not None:
-            st.session_state.kpi_data = raw_kpi_data
-            st.success("Historias Médicas (HMs) obtenidas exitosamente.")
-            st.subheader("Respuesta JSON de HMs (Datos Crudos):")
-            try:
-                pretty_json_kpi = json.dumps(raw_kpi_data, indent=2, ensure_ascii=False)
-                with st.expander("Ver/Ocultar JSON de HMs", expanded=False):
-                    st.code(pretty_json_kpi, language='json')
-            except Exception as e:
-                st.error(f"No se pudo formatear el JSON de HMs para mostrar: {e}")
-                st.text(raw_kpi_data)
-        else:
-            st.warning("No se pudieron obtener las HMs o la respuesta estaba vacía. Se continuará con exámenes si es posible.")
-            st.session_state.kpi_data = None # Asegurar que es None
-
-        # Obtener Resultados de Exámenes
-        with st.spinner(f"Obteniendo Resultados de Exámenes para Cédula: {current_country_id}..."):
-            raw_exam_data = get_exam_data(token, current_country_id, selected_config)
-
-        if raw_exam_data is not None:
-            st.session_state.exam_data = raw_exam_data
-            st.success("Resultados de Exámenes obtenidos exitosamente.")
-            st.subheader("Respuesta JSON de Exámenes (Datos Crudos):")
-            try:
-                pretty_json_exam = json.dumps(raw_exam_data, indent=2, ensure_ascii=False)
-                with st.expander("Ver/Ocultar JSON de Exámenes", expanded=False):
-                    st.code(pretty_json_exam, language='json')
-            except Exception as e:
-                st.error(f"No se pudo formatear el JSON de Exámenes para mostrar: {e}")
-                st.text(raw_exam_data)
-        else:
-            st.warning("No se pudieron obtener los Resultados de Exámenes o la respuesta estaba vacía.")
-            st.session_state.exam_data = None # Asegurar que es None
-
-        # Obtener Resultados de Laboratorios
-        with st.spinner(f"Obteniendo Resultados de Exámenes para Cédula: {current_country_id}..."):
-            raw_lab_data = get_lab_data(token, current_country_id, selected_config)
-
-        if raw_lab_data is not None:
-            st.session_state.lab_data = raw_lab_data
-            st.success("Resultados de Laboratorio obtenidos exitosamente.")
-            st.subheader("Respuesta JSON de Laboratorio (Datos Crudos):")
-            try:
-                pretty_json_lab = json.dumps(raw_lab_data, indent=2, ensure_ascii=False)
-                with st.expander("Ver/Ocultar JSON de Laboratorio", expanded=False):
-                    st.code(pretty_json_lab, language='json')
-            except Exception as e:
-                st.error(f"No se pudo formatear el JSON de Laboratorio para mostrar: {e}")
-                st.text(raw_exam_data)
-        else:
-            st.warning("No se pudieron obtener los Resultados de Laboratorio o la respuesta estaba vacía.")
-            st.session_state.exam_data = None # Asegurar que es None
+        source_labels = {state_key: (label, short_label) for state_key, _, label, short_label in PATIENT_DATA_SOURCES}
+        fetch_start_time = time.time()
+        with st.spinner(f"Obteniendo HMs, Exámenes y Laboratorios para Cédula: {current_country_id}..."):
+            prefetched = None
+            if refresh_data_button_pressed:
+                patient_prefetcher.cancel(session=st.session_state.limiter_session)
+            elif st.session_state.kpi_prefetch:
+                prefetched = patient_prefetcher.take(current_api_user, current_country_id, selected_config, session=st.session_state.limiter_session)
+            # Cada resultado se muestra en cuanto llega
+            for result in prefetched or fetch_patient_data(
+                token, current_country_id, selected_config,
+                concurrent=st.session_state.kpi_concurrent_fetch,
+                refresh=refresh_data_button_pressed
+            ):
+                label, short_label = source_labels[result.state_key]
+                for level, text in result.messages:
+                    render_message(level, text)
+                request_metrics.add(
+                    result.state_key, result.seconds,
+                    cache="hit" if result.source in ("cache", "store", "prefetch") else "miss",
+                    bytes=result.response_bytes,
+                    decode_seconds=result.decode_seconds,
+                    records=len(result.data.records) if result.data else 0,
+                    wait_seconds=result.wait_seconds
+                )
+
+                if result.data is not None:
+                    # El cliente KPI ya entrega la versión compacta (HTML a texto, sin campos vacíos)
+                    st.session_state[result.state_key] = result.data
+                    source_label = {"cache": "desde caché", "store": "desde el almacén local", "prefetch": "de la precarga"}.get(result.source, "desde la API")
+                    st.success(
+                        f"{label} obtenidos exitosamente {source_label} "
+                        f"({result.seconds:.2f} s, {result.response_bytes / 1024:,.0f} KB, "
+                        f"decodificación {result.decode_seconds:.2f} s)."
+                    )
+                else:
+                    st.warning(f"No se pudieron obtener los {label} o la respuesta estaba vacía.")
+                    st.session_state[result.state_key] = None # Asegurar que es None
+        st.write(f"Consulta de datos completada en {time.time() - fetch_start_time:.2f} segundos.")
+
+        with request_metrics.stage("lab_table") as lab_table_stage:
+            st.session_state.lab_results_table = build_lab_results_table(st.session_state.lab_data)
+            lab_table_stage["records"] = len(st.session_state.lab_results_table)
 
         if st.session_state.kpi_data is None and st.session_state.exam_data is None and st.session_state.lab_data is None:
             st.error("No se pudo obtener información de Historias Médicas ni de Exámenes ni de Laboratorios.")
@@ -587,7 +558,80 @@ if process_data_button_pressed:
         st.session_state.kpi_data = None
         st.session_state.exam_data = None
         st.session_state.lab_data = None
+    record_request_metrics(request_metrics)
+
+
+# --- Visor de datos del paciente (paginado; solo serializa la página visible) ---
+RAW_VIEWER_PAGE_SIZE = 10
+
+def render_records_viewer(state_key, short_label):
+    """Muestra los registros de una fuente por páginas, solo si el usuario activa el visor."""
+    record_set = st.session_state[state_key]
+    if not record_set:
+        return
+    records = record_set.records
+    dated_records = record_set.by_date()
+    if dated_records:
+        st.caption(
+            f"{len(records)} registros, del {dated_records[0].timestamp:%d/%m/%Y} "
+            f"al {dated_records[-1].timestamp:%d/%m/%Y}."
+        )
+    if not st.toggle(f"Ver JSON de {short_label}", key=f"raw_viewer_{state_key}"):
+        return
+    if not records:
+        # Sin registros: se muestra la respuesta completa
+        st.code(json.dumps(record_set.to_response(), indent=2, ensure_ascii=False), language='json')
+        return
+    page_count = max(1, -(-len(records) // RAW_VIEWER_PAGE_SIZE))
+    page = st.number_input(
+        f"Página ({len(records)} registros, {page_count} páginas)",
+        min_value=1,
+        max_value=page_count,
+        value=1,
+        key=f"raw_viewer_page_{state_key}"
+    )
+    start = (page - 1) * RAW_VIEWER_PAGE_SIZE
+    page_records = record_set.record_dicts(records[start:start + RAW_VIEWER_PAGE_SIZE])
+    st.code(json.dumps(page_records, indent=2, ensure_ascii=False), language='json')
 
+if st.session_state.kpi_data or st.session_state.exam_data or st.session_state.lab_data:
+    st.divider()
+    st.subheader("Datos del Paciente (JSON compactado)")
+    viewer_columns = st.columns(len(PATIENT_DATA_SOURCES))
+    for viewer_column, (state_key, _, _, short_label) in zip(viewer_columns, PATIENT_DATA_SOURCES):
+        with viewer_column:
+            render_records_viewer(state_key, short_label)
+
+# --- Tabla de Laboratorios a través del tiempo (calculada en Python, no por el LLM) ---
+lab_results_table = st.session_state.lab_results_table
+if lab_results_table is not None and not lab_results_table.empty:
+    st.divider()
+    st.subheader("Resultados de Laboratorio a través del Tiempo")
+    selected_exam_types = st.multiselect(
+        "Tipo de Examen",
+        options=sorted(st.session_state.lab_data.by_exam_type) if st.session_state.lab_data else [],
+        key="lab_exam_type_filter",
+        help="Vacío muestra todos los tipos de examen."
+    )
+    if selected_exam_types:
+        lab_results_table = lab_results_table[lab_results_table["Tipo de Examen"].isin(selected_exam_types)]
+    tab_long, tab_pivot = st.tabs(["Tabla", "Evolución por fecha"])
+    with tab_long:
+        st.dataframe(
+            lab_results_table,
+            hide_index=True,
+            use_container_width=True,
+            column_config={"Fecha": st.column_config.DatetimeColumn("Fecha", format="DD/MM/YYYY hh:mm A")}
+        )
+    with tab_pivot:
+        st.dataframe(pivot_lab_results(lab_results_table), hide_index=True, use_container_width=True)
+    st.download_button(
+        "Descargar CSV de Laboratorios",
+        data=lab_results_csv(lab_results_table),
+        file_name=f"laboratorios_{st.session_state.kpi_country_id}.csv",
+        mime="text/csv",
+        key="lab_results_csv_download"
+    )
 
 # --- Botón y Lógica para Generar Análisis Clínico con LLM ---
 if st.session_state.kpi_data or st.session_state.exam_data or st.session_state.lab_data: # Si tenemos al menos uno de los dos
@@ -597,58 +641,76 @@ if st.session_state.kpi_data or st.session_state.exam_data or st.session_state.l
     if not st.session_state.gemini_api_key_verified:
         st.warning("La API Key de Google Gemini no está configurada en los secretos. El análisis con IA no está disponible.")
     else:
-        if st.button("2. Generar Análisis Clínico con IA", key="generate_analysis_button"):
+        col1_analysis, col2_analysis = st.columns([3, 1])
+        with col1_analysis:
+            generate_analysis_button_pressed = st.button(
+                "2. Generar Análisis Clínico con IA",
+                key="generate_analysis_button",
+                disabled=st.session_state.analysis_job_id is not None
+            )
+        with col2_analysis:
+            regenerate_analysis_button_pressed = st.button(
+                "Regenerar análisis",
+                key="regenerate_analysis_button",
+                disabled=st.session_state.analysis_job_id is not None,
+                help="Ignora el análisis guardado para estos mismos datos y vuelve a generarlo con Gemini."
+            )
+        if generate_analysis_button_pressed or regenerate_analysis_button_pressed:
             st.session_state.clinical_analysis_text = None # Limpiar análisis previo
+            st.session_state.analysis_messages = []
+            request_metrics = RequestMetrics("análisis", selected_config.get('display_name'))
+
+            with request_metrics.stage("prompt") as prompt_stage:
+                combined_data_for_llm = build_llm_payload(
+                    st.session_state.kpi_data,
+                    st.session_state.exam_data,
+                    st.session_state.lab_data
+                )
+                if combined_data_for_llm:
+                    # Los registros ya están compactados (kpi_records); el ahorro se mide contra las respuestas crudas
+                    combined_data_for_llm, compaction_stats = compact_llm_payload(combined_data_for_llm, raw_response_bytes(
+                        st.session_state.kpi_data, st.session_state.exam_data, st.session_state.lab_data
+                    ))
+                    prompt_stage["records"] = sum(
+                        len(kpis.get("Records") or []) for kpis in combined_data_for_llm.values() if isinstance(kpis, dict)
+                    )
 
-            medical_history_kpis = None
-            if st.session_state.kpi_data:
-                medical_history_kpis = st.session_state.kpi_data.get("data", {}).get("kpis", None)
-                if not medical_history_kpis:
-                    st.warning("La estructura del JSON de HMs no contiene 'data.kpis'. Las HMs no se incluirán en el análisis si la estructura es incorrecta.")
-                    # st.json(st.session_state.kpi_data) # Mostrar JSON problemático
-
-            exam_results_kpis = None
-            if st.session_state.exam_data:
-                exam_results_kpis = st.session_state.exam_data.get("data", {}).get("kpis", None)
-                if not exam_results_kpis:
-                    st.warning("La estructura del JSON de Exámenes no contiene 'data.kpis'. Los exámenes no se incluirán en el análisis si la estructura es incorrecta.")
-                    # st.json(st.session_state.exam_data) # Mostrar JSON problemático
-
-            lab_results_kpis = None
-            if st.session_state.lab_data:
-                lab_results_kpis = st.session_state.lab_data.get("data", {}).get("kpis", None)
-                if not lab_results_kpis:
-                    st.warning("La estructura del JSON de Laboratorios no contiene 'data.kpis'. Los Laboratorios no se incluirán en el análisis si la estructura es incorrecta.")
-                    # st.json(st.session_state.lab_data) # Mostrar JSON problemático
-
-            if not medical_history_kpis and not exam_results_kpis and not lab_results_kpis:
+            if not combined_data_for_llm:
                 st.error("No hay datos válidos de Historias Médicas ni de Exámenes para enviar al LLM.")
+                record_request_metrics(request_metrics)
             else:
-                # Crear el JSON combinado para el LLM
-                combined_data_for_llm = {
-                    "medical_history": medical_history_kpis, # Puede ser None
-                    "exam_results": exam_results_kpis,      # Puede ser None
-                    "lab_results": lab_results_kpis      # Puede ser None
-                }
-
-                start_time = time.time()
-                with st.spinner(f"Generando análisis clínico con {st.session_state.llm_model_select}.. ",show_time=True):
-                    analysis_result = generate_clinical_analysis_with_llm(
-                        combined_data_for_llm,
-                        st.session_state.llm_model_select,
-                        PROMPT_INSTRUCTIONS_TEMPLATE,
-                        google_api_key
-                    )
-                end_time = time.time()
-                duration = end_time - start_time
-                
-                st.write(f"Proceso Completado es {duration:.2f} segundos.")
-
-                if analysis_result:
-                    st.session_state.clinical_analysis_text = analysis_result
-                    st.success("Análisis clínico generado exitosamente.")
-                else:
-                    st.error("Fallo al generar el análisis clínico con el LLM.")
+                st.session_state.analysis_messages = [("caption",
+                    f"Datos para el LLM compactados: {compaction_stats['original_bytes']:,} bytes de respuestas de la API → "
+                    f"{compaction_stats['compact_bytes']:,} bytes "
+                    f"(-{compaction_stats['saved_ratio']:.0%}, ~{compaction_stats['estimated_tokens_saved']:,} tokens de entrada menos)."
+                    if compaction_stats["saved_ratio"] is not None else
+                    f"Datos para el LLM compactados: {compaction_stats['compact_bytes']:,} bytes."
+                )]
+                # Gemini corre en la cola del proceso: la página solo consulta el estado del
+                # trabajo, así que interactuar con otros widgets no interrumpe la generación.
+                st.session_state.analysis_job_id = analysis_job_queue.submit(
+                    functools.partial(
+                        run_analysis_job,
+                        combined_data_for_llm=combined_data_for_llm,
+                        model_name=st.session_state.llm_model_select,
+                        gemini_api_key=google_api_key,
+                        stream_output=st.session_state.llm_stream_output,
+                        token_budget=int(st.session_state.llm_token_budget),
+                        use_cache=not regenerate_analysis_button_pressed,
+                        report_key=(selected_config.get('api_base_url'), st.session_state.kpi_country_id),
+                        incremental=st.session_state.llm_incremental and not regenerate_analysis_button_pressed,
+                        sectioned=st.session_state.llm_sectioned,
+                        templated_sections=st.session_state.llm_templated_sections,
+                    ),
+                    label=f"{st.session_state.llm_model_select}, cédula {st.session_state.kpi_country_id}"
+                )
+                st.session_state.analysis_job_metrics = request_metrics
+                st.rerun() # Dibuja la página con los botones deshabilitados y el estado del trabajo
+
+        if st.session_state.analysis_job_id is not None:
+            render_analysis_job()
+        for level, text in st.session_state.analysis_messages:
+            render_message(level, text)
 
 # Mostrar el análisis clínico si fue generado
 if st.session_state.clinical_analysis_text:
@@ -658,6 +720,8 @@ if st.session_state.clinical_analysis_text:
     st.markdown(st.session_state.clinical_analysis_text)
 
 
+render_metrics_panel()
+
 # --- Pie de página ---
 st.markdown("---")
 st.caption(f"CRM SUGOS HM & Exámenes & Laboratorios v0.0.3")
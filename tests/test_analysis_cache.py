@@ -0,0 +1,30 @@
+import os
+
+from analysis_cache import AnalysisCache
+
+PAYLOAD = '{"medical_history": {"Records": [{"ID": 1}]}}'
+TEMPLATE = "Informe:\n{json_data_placeholder}"
+
+def test_hit_requires_same_payload_model_and_prompt(tmp_path):
+    cache = AnalysisCache(str(tmp_path), max_bytes=1024 * 1024)
+    key = cache.key(PAYLOAD, "modelo-a", TEMPLATE)
+    assert cache.get(key) is None
+    cache.put(key, "informe", "modelo-a")
+    assert cache.get(cache.key(PAYLOAD, "modelo-a", TEMPLATE)) == "informe"
+    assert cache.get(cache.key(PAYLOAD, "modelo-b", TEMPLATE)) is None
+    assert cache.get(cache.key(PAYLOAD, "modelo-a", TEMPLATE + " v2")) is None
+    assert cache.get(cache.key(PAYLOAD.replace("1", "2"), "modelo-a", TEMPLATE)) is None
+
+def test_least_recently_used_analyses_are_evicted(tmp_path):
+    cache = AnalysisCache(str(tmp_path), max_bytes=1024 * 1024)
+    keys = [cache.key(PAYLOAD, f"modelo-{number}", TEMPLATE) for number in range(3)]
+    for age, key in zip((300, 200, 100), keys):
+        cache.put(key, "x" * 400, "modelo")
+        os.utime(os.path.join(tmp_path, f"{key}.json"), (0, os.path.getmtime(os.path.join(tmp_path, f"{key}.json")) - age))
+    assert cache.get(keys[0]) is not None  # El más antiguo pasa a ser el último usado
+    entry_bytes = cache.stats()[1] // 3
+    cache.max_bytes = entry_bytes * 3
+    cache.put(cache.key(PAYLOAD, "modelo-3", TEMPLATE), "x" * 400, "modelo")
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None and cache.get(keys[2]) is not None
+    assert cache.stats()[0] == 3
@@ -0,0 +1,103 @@
+import threading
+import time
+
+import clinical_llm
+from analysis_jobs import AnalysisJobQueue
+from ui_messages import show_message
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def test_cancelled_running_job_stops_at_the_next_chunk_and_is_discarded():
+    queue = AnalysisJobQueue(1)
+    started, chunks = threading.Event(), []
+
+    def stream(job):
+        started.set()
+        for number in range(200):
+            job.add_chunk(f"{number} ")
+            chunks.append(number)
+            time.sleep(0.01)
+        return job.text
+
+    job_id = queue.submit(stream)
+    assert started.wait(5)
+    job = queue.get(job_id)
+    queue.cancel(job_id)
+    assert wait_until(lambda: job.status == "cancelled")
+    assert len(chunks) < 200
+    assert queue.get(job_id) is None
+    assert queue.stats()["running"] == 0
+
+def test_cancelled_queued_job_never_runs():
+    queue = AnalysisJobQueue(1)
+    release, ran = threading.Event(), []
+    first = queue.submit(lambda job: release.wait(5) and "primero")
+    second = queue.submit(lambda job: ran.append(job.id) or "segundo")
+    second_job = queue.get(second)
+    queue.cancel(second)
+    assert queue.get(second) is None
+    assert queue.stats()["queued"] == 0
+    release.set()
+    assert wait_until(lambda: queue.get(first).finished)
+    assert wait_until(lambda: second_job.status == "cancelled")
+    assert ran == []
+
+def test_cancelled_sectioned_job_stops_waiting_for_the_other_sections(monkeypatch):
+    queue = AnalysisJobQueue(1)
+    release = threading.Event()
+
+    def generate_with_fallback(gemini_api_key, models, prompt, prompt_tokens, on_chunk=None):
+        if prompt != "rápida":
+            release.wait(5)
+        return prompt, None, models[0]
+
+    def run(job):
+        job.cancel()  # La sesión cambió de consulta antes de la primera sección
+        return clinical_llm._generate_sections("key", ["modelo"], ["rápida", "lenta"], job.add_section)
+
+    monkeypatch.setattr(clinical_llm, "_generate_with_fallback", generate_with_fallback)
+    try:
+        job_id = queue.submit(run)
+        job = queue.get(job_id)
+        assert wait_until(lambda: job.status == "cancelled", timeout=2)
+        assert job.sections is None
+    finally:
+        release.set()
+
+def test_finished_jobs_keep_result_messages_and_timings():
+    queue = AnalysisJobQueue(2)
+
+    def analysis(job):
+        show_message("caption", "Tokens del prompt: 100.")
+        job.add_chunk("**A. IDENTIFICACIÓN**")
+        return "informe"
+
+    def failing(job):
+        raise RuntimeError("Gemini caído")
+
+    done, failed, empty = queue.submit(analysis, "123"), queue.submit(failing, "456"), queue.submit(lambda job: None, "789")
+    assert wait_until(lambda: all(queue.get(job_id).finished for job_id in (done, failed, empty)))
+    job = queue.get(done)
+    assert (job.status, job.result, job.text, job.label) == ("done", "informe", "**A. IDENTIFICACIÓN**", "123")
+    assert job.messages == [("caption", "Tokens del prompt: 100.")]
+    assert job.first_output_at >= job.started_at and job.run_seconds() >= 0 and job.wait_seconds() >= 0
+    assert queue.get(failed).status == "error"
+    assert queue.get(failed).messages == [("error", "Error inesperado: Gemini caído")]
+    assert queue.get(empty).status == "error"  # Sin texto, el análisis cuenta como fallido
+    assert queue.stats()["running"] == queue.stats()["queued"] == 0
+
+def test_queue_positions_and_history_limit():
+    queue = AnalysisJobQueue(1, history=2)
+    release = threading.Event()
+    job_ids = [queue.submit(lambda job: release.wait(5) and "informe") for _ in range(4)]
+    assert wait_until(lambda: queue.get(job_ids[0]).status == "running")
+    assert [queue.position(job_id) for job_id in job_ids] == [0, 1, 2, 3]
+    release.set()
+    assert wait_until(lambda: queue.get(job_ids[3]) is not None and queue.get(job_ids[3]).finished)
+    queue.submit(lambda job: "informe")
+    # Solo se conservan los dos últimos terminados
+    assert [queue.get(job_id) is not None for job_id in job_ids] == [False, False, True, True]
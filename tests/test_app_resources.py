@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+import types
+
+import app_resources
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class FakeGenai:
+    def __init__(self):
+        self.configured = []
+        self.created = []
+
+    def configure(self, api_key):
+        self.configured.append(api_key)
+
+    def GenerativeModel(self, model_name):
+        self.created.append(model_name)
+        return types.SimpleNamespace(model_name=model_name)
+
+class CountingSecrets(dict):
+    reads = 0
+
+    def __getitem__(self, key):
+        CountingSecrets.reads += 1
+        return super().__getitem__(key)
+
+def test_gemini_models_are_built_once_per_key_and_model(monkeypatch):
+    fake = FakeGenai()
+    monkeypatch.setattr(app_resources, "genai", lambda: fake)
+    monkeypatch.setattr(app_resources, "_gemini_models", {})
+    monkeypatch.setattr(app_resources, "_configured_api_key", None)
+    first = app_resources.gemini_model("clave-1", "modelo-a")
+    assert app_resources.gemini_model("clave-1", "modelo-a") is first
+    app_resources.gemini_model("clave-1", "modelo-b")
+    app_resources.gemini_model("clave-2", "modelo-a")
+    assert fake.created == ["modelo-a", "modelo-b", "modelo-a"]
+    assert fake.configured == ["clave-1", "clave-2"]
+
+def test_environment_configs_are_rebuilt_only_when_secrets_change(monkeypatch, tmp_path):
+    monkeypatch.setattr(app_resources, "_environment_configs", (None, None))
+    secrets_file = tmp_path / "secrets.toml"
+    secrets_file.write_text("", encoding="utf-8")
+    secrets = CountingSecrets(prod={"display_name": "Producción", "api_base_url": "http://crm.test/"}, GOOGLE_API_KEY="clave")
+    configs = app_resources.environment_configs(secrets, [str(secrets_file)])
+    assert configs == {"Producción": ("prod", {"display_name": "Producción", "api_base_url": "http://crm.test/"})}
+    reads = CountingSecrets.reads
+    assert app_resources.environment_configs(secrets, [str(secrets_file)]) is configs
+    assert CountingSecrets.reads == reads
+    os.utime(secrets_file, ns=(0, os.stat(secrets_file).st_mtime_ns + 10**9))
+    assert app_resources.environment_configs(secrets, [str(secrets_file)]) is not configs
+
+def test_heavy_libraries_are_not_imported_with_the_app_modules():
+    code = (
+        "import sys, analysis_jobs, clinical_llm, crm_api, lab_table, patient_store; "
+        "print(sorted(name for name in ('google.generativeai', 'pandas', 'bs4') if name in sys.modules))"
+    )
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    assert output.strip() == "[]"
@@ -0,0 +1,47 @@
+import json
+
+import batch_runner
+from batch_runner import BatchRunner
+from kpi_records import KpiRecordSet
+
+def _raw():
+    response = {"data": {"kpis": {"Records": [{"ID": 1, "Date": "2024-01-15 09:00:00", "Reason": "Control"}]}}}
+    return {"kpi_data": KpiRecordSet.from_response(response), "exam_data": None, "lab_data": None}
+
+def _runner(tmp_path):
+    return BatchRunner({"api_base_url": "http://crm.test/"}, "u", "p", "key", "modelo", str(tmp_path))
+
+def _capture_generate(monkeypatch):
+    calls = []
+
+    def generate(*args, **kwargs):
+        calls.append(kwargs)
+        return "informe"
+    monkeypatch.setattr(batch_runner, "generate_clinical_analysis_with_llm", generate)
+    return calls
+
+def test_analyse_uses_cache_and_incremental_by_default(tmp_path, monkeypatch):
+    calls = _capture_generate(monkeypatch)
+    assert _runner(tmp_path).analyse("123", _raw()) == "informe"
+    assert calls[0]["use_cache"] is True
+    assert calls[0]["incremental"] is True
+
+def test_force_skips_analysis_cache_and_incremental_reuse(tmp_path, monkeypatch):
+    calls = _capture_generate(monkeypatch)
+    _runner(tmp_path).analyse("123", _raw(), force=True)
+    assert calls[0]["use_cache"] is False
+    assert calls[0]["incremental"] is False
+
+def test_run_with_force_regenerates_existing_reports(tmp_path, monkeypatch):
+    calls = _capture_generate(monkeypatch)
+    runner = _runner(tmp_path)
+    monkeypatch.setattr(runner, "fetch", lambda cedula: _raw())
+    (tmp_path / "123.md").write_text("informe anterior", encoding="utf-8")
+    (tmp_path / batch_runner.PROGRESS_FILE).write_text(json.dumps({"cedula": "123", "status": "ok"}) + "\n", encoding="utf-8")
+
+    runner.run(["123"])
+    assert calls == []
+
+    runner.run(["123"], force=True)
+    assert [call["use_cache"] for call in calls] == [False]
+    assert (tmp_path / "123.md").read_text(encoding="utf-8") == "informe"
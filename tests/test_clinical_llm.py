@@ -0,0 +1,190 @@
+import json
+import threading
+import time
+import types
+
+import pytest
+
+import clinical_llm
+import ui_messages
+from analysis_cache import prompt_template_version
+from clinical_llm import build_llm_payload, compact_llm_payload, covered_record_ids, generate_clinical_analysis_with_llm, last_analysis_stats, raw_response_bytes, serialize_llm_payload
+from kpi_records import KpiRecordSet
+from patient_store import patient_store
+
+TEMPLATE = "Informe del paciente:\n{json_data_placeholder}"
+PAYLOAD = {"medical_history": {"Records": [{"ID": 1, "Date": "2024-01-15 09:00:00", "Reason": "Control"}]}}
+REPORT_KEY = ("http://crm.test/", "123")
+
+class FakeModel:
+    def __init__(self, model_name, calls):
+        self.model_name = model_name
+        self.calls = calls
+
+    def count_tokens(self, prompt):
+        return types.SimpleNamespace(total_tokens=len(prompt) // 4)
+
+    def generate_content(self, prompt, generation_config=None, request_options=None, stream=False):
+        self.calls.append(self.model_name)
+        return types.SimpleNamespace(text=f"informe de {self.model_name}", usage_metadata=types.SimpleNamespace(candidates_token_count=3))
+
+@pytest.fixture
+def gemini_calls(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(patient_store, "path", str(tmp_path / "patients.sqlite3"))
+    monkeypatch.setattr(clinical_llm, "gemini_model", lambda api_key, model_name: FakeModel(model_name, calls))
+    monkeypatch.setattr(clinical_llm, "_generation_config", lambda: None)
+    patient_store.put_report(REPORT_KEY, "informe anterior", "modelo-a", prompt_template_version(TEMPLATE), covered_record_ids(PAYLOAD))
+    return calls
+
+def _generate(model_name):
+    return generate_clinical_analysis_with_llm(PAYLOAD, model_name, TEMPLATE, "key", use_cache=False, report_key=REPORT_KEY)
+
+def test_unchanged_data_reuses_report_of_same_model(gemini_calls):
+    assert _generate("modelo-a") == "informe anterior"
+    assert last_analysis_stats()["mode"] == "reuse"
+    assert gemini_calls == []
+
+def test_switching_model_regenerates(gemini_calls):
+    assert _generate("modelo-b") == "informe de modelo-b"
+    assert last_analysis_stats()["mode"] == "full"
+    assert gemini_calls == ["modelo-b"]
+
+def test_record_edited_in_place_is_not_reused(gemini_calls):
+    edited = {"medical_history": {"Records": [dict(PAYLOAD["medical_history"]["Records"][0], Reason="Control y ajuste de dosis")]}}
+    assert generate_clinical_analysis_with_llm(edited, "modelo-a", TEMPLATE, "key", use_cache=False, report_key=REPORT_KEY) == "informe de modelo-a"
+    assert last_analysis_stats()["mode"] == "full"
+    assert gemini_calls == ["modelo-a"]
+
+def test_report_stored_with_only_record_ids_is_rebuilt(gemini_calls):
+    patient_store.put_report(REPORT_KEY, "informe anterior", "modelo-a", prompt_template_version(TEMPLATE), {"medical_history": ["1"]})
+    assert _generate("modelo-a") == "informe de modelo-a"
+    assert last_analysis_stats()["mode"] == "full"
+
+def test_new_record_is_sent_as_delta(gemini_calls):
+    extended = {"medical_history": {"Records": PAYLOAD["medical_history"]["Records"] + [{"ID": 2, "Date": "2024-02-15 09:00:00", "Reason": "Control"}]}}
+    assert generate_clinical_analysis_with_llm(extended, "modelo-a", TEMPLATE, "key", use_cache=False, report_key=REPORT_KEY) == "informe de modelo-a"
+    assert last_analysis_stats()["mode"] == "delta"
+
+def test_compact_payload_keeps_text_decoded_from_html():
+    exam = {"ID": 7, "ExamResults": "<p>Hemoglobina: 10 &lt;normal 12-16&gt; g/dL</p><p>Conclusión: anemia</p>"}
+    exam_data = KpiRecordSet.from_response({"data": {"kpis": {"Records": [exam]}}})
+    payload, stats = compact_llm_payload(build_llm_payload(None, exam_data, None))
+    assert payload["exam_results"]["Records"][0]["ExamResults"] == "Hemoglobina: 10 <normal 12-16> g/dL\nConclusión: anemia"
+    assert stats["saved_ratio"] is None  # Sin el tamaño de la respuesta cruda no se informa ahorro
+
+def test_compaction_savings_are_measured_against_the_raw_response():
+    raw = {"data": {"kpis": {"Records": [
+        {"ID": 7, "Notes": None, "ExamResults": "<div><p><b>Hemoglobina</b>: 10 g/dL</p></div>" * 20},
+        {"ID": 7, "Notes": None, "ExamResults": "<div><p><b>Hemoglobina</b>: 10 g/dL</p></div>" * 20},
+    ]}}}
+    body = json.dumps(raw, indent=2).encode("utf-8")
+    exam_data = KpiRecordSet.from_response(json.loads(body))
+    exam_data.response_bytes = len(body)
+    payload, stats = compact_llm_payload(build_llm_payload(None, exam_data, None), raw_response_bytes(None, exam_data, None))
+    assert stats["original_bytes"] == len(body)
+    assert stats["compact_bytes"] == len(serialize_llm_payload(payload).encode("utf-8"))
+    # HTML, nulos y el registro duplicado cuentan en el ahorro, no solo la indentación
+    assert stats["saved_ratio"] > 0.6
+    assert stats["estimated_tokens_saved"] == (stats["original_bytes"] - stats["compact_bytes"]) // 4
+
+def test_sectioned_analysis_is_cached_under_requested_model(gemini_calls, monkeypatch):
+    monkeypatch.setattr(clinical_llm.analysis_cache, "directory", patient_store.path + "-analyses")
+    template = "Datos: {json_data_placeholder}\nA. IDENTIFICACIÓN\nB. ANTECEDENTES\nC. ORGANIZACIÓN\nD. GENERACIÓN\nE. RESULTADOS\nFormato de Salida: texto."
+
+    def generate(use_cache):
+        return generate_clinical_analysis_with_llm(PAYLOAD, "modelo-a", template, "key", use_cache=use_cache, incremental=False, sectioned=True)
+
+    generate(use_cache=False)
+    assert last_analysis_stats()["mode"] == "sectioned"
+    generate(use_cache=True)
+    assert (last_analysis_stats()["mode"], last_analysis_stats()["model"]) == ("cache", "modelo-a")
+
+class StreamingModel:
+    """Responde con chunks fragmentos separados por pause segundos, después de first_delay; respeta el timeout de la llamada."""
+
+    def __init__(self, model_name, calls, first_delay, pause, chunks=3):
+        self.model_name, self.calls = model_name, calls
+        self.first_delay, self.pause, self.chunks = first_delay, pause, chunks
+        self.yielded = 0
+        self.closed = threading.Event()
+
+    def generate_content(self, prompt, generation_config=None, request_options=None, stream=False):
+        self.calls.append(self.model_name)
+        deadline = time.monotonic() + request_options["timeout"]
+        time.sleep(self.first_delay)
+
+        def chunks():
+            try:
+                for index in range(self.chunks):
+                    if index:
+                        time.sleep(self.pause)
+                    if time.monotonic() > deadline:
+                        raise TimeoutError("Deadline Exceeded")
+                    self.yielded += 1
+                    yield types.SimpleNamespace(text=f"{self.model_name}-{index} ")
+            finally:
+                self.closed.set()
+        return chunks()
+
+def _stream_with_fallback(monkeypatch, tmp_path, models):
+    calls, received = [], []
+    monkeypatch.setattr(clinical_llm.model_latency_stats, "path", str(tmp_path / "latency.json"))
+    monkeypatch.setattr(clinical_llm, "AUTO_LATENCY_BUDGET_SECONDS", 0.2)
+    monkeypatch.setattr(clinical_llm, "_generation_config", lambda: None)
+    monkeypatch.setattr(clinical_llm, "gemini_model", lambda api_key, model_name: models[model_name](calls))
+    text, _, used_model = clinical_llm._generate_with_fallback("key", list(models), "prompt", 10, on_chunk=received.append)
+    return text, used_model, calls, received
+
+def test_stream_longer_than_budget_is_not_cut_after_first_chunk(monkeypatch, tmp_path):
+    models = {
+        "lento": lambda calls: StreamingModel("lento", calls, first_delay=0.0, pause=0.15),
+        "respaldo": lambda calls: StreamingModel("respaldo", calls, first_delay=0.0, pause=0.0),
+    }
+    text, used_model, calls, received = _stream_with_fallback(monkeypatch, tmp_path, models)
+    assert used_model == "lento" and calls == ["lento"]
+    assert text == "".join(received) == "lento-0 lento-1 lento-2 "
+
+def test_stream_without_first_chunk_in_budget_falls_back(monkeypatch, tmp_path):
+    models = {
+        "lento": lambda calls: StreamingModel("lento", calls, first_delay=1.0, pause=0.0),
+        "respaldo": lambda calls: StreamingModel("respaldo", calls, first_delay=0.0, pause=0.0),
+    }
+    text, used_model, calls, received = _stream_with_fallback(monkeypatch, tmp_path, models)
+    assert used_model == "respaldo" and calls == ["lento", "respaldo"]
+    assert text == "".join(received) == "respaldo-0 respaldo-1 respaldo-2 "
+
+def test_abandoned_stream_keeps_its_model_slot_until_it_is_cut(monkeypatch, tmp_path):
+    abandoned = StreamingModel("lento-abandonado", [], first_delay=0.5, pause=0.0)
+    models = {
+        "lento-abandonado": lambda calls: abandoned,
+        "respaldo": lambda calls: StreamingModel("respaldo", calls, first_delay=0.0, pause=0.0),
+    }
+    _, used_model, _, _ = _stream_with_fallback(monkeypatch, tmp_path, models)
+    limiter = clinical_llm.model_limiter("lento-abandonado")
+    assert used_model == "respaldo"
+    assert limiter.stats()["active"] == 1
+    assert abandoned.closed.wait(5)
+    deadline = time.monotonic() + 5
+    while limiter.stats()["active"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert limiter.stats()["active"] == 0
+    assert abandoned.yielded == 1
+
+def test_section_worker_messages_reach_the_caller_collector(monkeypatch, tmp_path):
+    class TimingOutModel(FakeModel):
+        def generate_content(self, prompt, generation_config=None, request_options=None, stream=False):
+            if self.model_name == "modelo-a":
+                raise TimeoutError("Deadline Exceeded")
+            return super().generate_content(prompt, generation_config, request_options, stream)
+
+    def render_message(level, text):
+        raise AssertionError(f"mensaje fuera del colector: {text}")
+
+    monkeypatch.setattr(clinical_llm.model_latency_stats, "path", str(tmp_path / "latency.json"))
+    monkeypatch.setattr(clinical_llm, "_generation_config", lambda: None)
+    monkeypatch.setattr(clinical_llm, "gemini_model", lambda api_key, model_name: TimingOutModel(model_name, []))
+    monkeypatch.setattr(ui_messages, "render_message", render_message)
+    result, messages = ui_messages.call_collecting_messages(clinical_llm._generate_sections, "key", ["modelo-a", "modelo-b"], ["p1", "p2"], None)
+    assert result[0] == "informe de modelo-b\n\ninforme de modelo-b"
+    assert [level for level, _ in messages] == ["warning", "warning"]
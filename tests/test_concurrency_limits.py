@@ -0,0 +1,44 @@
+import threading
+import time
+
+from concurrency_limits import FairLimiter
+
+def _wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def test_waiting_sessions_are_served_round_robin():
+    limiter = FairLimiter("prueba", 1)
+    order = []
+
+    def call(session, name):
+        with limiter.slot(session):
+            order.append(name)
+
+    threads = []
+    with limiter.slot("sesion-h"):
+        for session, name in [("sesion-a", "a1"), ("sesion-a", "a2"), ("sesion-a", "a3"), ("sesion-b", "b1")]:
+            threads.append(threading.Thread(target=call, args=(session, name), daemon=True))
+            threads[-1].start()
+            _wait_until(lambda: limiter.stats()["queued"] == len(threads))
+    for thread in threads:
+        thread.join(5)
+    assert order == ["a1", "b1", "a2", "a3"]
+
+def test_nested_slot_in_same_thread_does_not_take_another_place():
+    limiter = FairLimiter("prueba", 1)
+    results = []
+
+    def nested():
+        with limiter.slot("sesion-a"):
+            with limiter.slot("sesion-a") as waited:
+                results.append((waited, limiter.stats()["active"]))
+        results.append(limiter.stats()["active"])
+
+    thread = threading.Thread(target=nested, daemon=True)
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert results == [(0.0, 1), 0]
@@ -0,0 +1,213 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import crm_api
+from kpi_records import KpiRecordSet
+from ui_messages import call_collecting_messages
+
+class RevokingCrm:
+    """CRM local: cada login entrega un token nuevo; los GET con un token revocado responden 401 tras latency segundos."""
+
+    def __init__(self, latency=0.3):
+        self.latency = latency
+        self.valid = set()
+        self.logins = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/"
+
+    def revoke_all(self):
+        with self._lock:
+            self.valid.clear()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self):
+        crm = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body):
+                body = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                with crm._lock:
+                    crm.logins += 1
+                    token = f"token-{crm.logins}"
+                    crm.valid.add(token)
+                self._send(200, {"token": token, "expires_in": 900})
+
+            def do_GET(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                time.sleep(crm.latency)
+                with crm._lock:
+                    authorized = self.headers.get("Authorization", "").removeprefix("Bearer ") in crm.valid
+                if not authorized:
+                    self._send(401, {"error": "token expirado"})
+                    return
+                self._send(200, {"data": {"kpis": {"Records": [{"ID": 1, "Date": "15/01/2024"}]}}})
+
+        return Handler
+
+@pytest.fixture
+def crm():
+    server = RevokingCrm()
+    yield server
+    server.stop()
+
+def test_relogin_after_401_does_not_deadlock_with_a_login_waiting_for_the_limiter(crm):
+    config = {"api_base_url": crm.base_url, "display_name": "Prueba 401", "max_concurrent_requests": 1, "kpi_cache_ttl": 0, "kpi_store_ttl": 0}
+    expired_token = crm_api.get_api_token("api", "clave", config)
+    crm.revoke_all()
+    # El token sigue en caché pero vencido: el segundo hilo hace login con el lock de las credenciales tomado
+    with crm_api._token_cache_lock:
+        crm_api._token_cache[crm_api._token_cache_key("api", "clave", config)]["expires_at"] = 0
+    results = {}
+
+    def query():
+        results["kpi"] = crm_api._request_kpi(expired_token, "medicalrecords", "1", config)
+
+    def login():
+        results["token"] = crm_api.get_api_token("api", "clave", config)
+
+    threads = [threading.Thread(target=query, daemon=True), threading.Thread(target=login, daemon=True)]
+    threads[0].start()
+    time.sleep(crm.latency / 3)  # La consulta ya ocupa el único lugar del límite
+    threads[1].start()
+    for thread in threads:
+        thread.join(10)
+    assert not any(thread.is_alive() for thread in threads)
+    assert [record.id for record in results["kpi"].records] == [1]
+    assert results["token"] in crm.valid
+    assert crm.logins == 2
+
+def test_api_token_keeps_no_password_and_still_refreshes_after_401(crm):
+    config = {"api_base_url": crm.base_url, "display_name": "Prueba sin clave", "max_concurrent_requests": 2, "kpi_cache_ttl": 0, "kpi_store_ttl": 0}
+    token = crm_api.get_api_token("api", "clave-secreta", config)
+    assert not any("clave-secreta" in repr(value) for value in vars(token).values())
+    assert not any("clave-secreta" in repr(value) for value in crm_api._token_cache.values())
+    crm.revoke_all()
+    kpi = crm_api._request_kpi(token, "medicalrecords", "1", config)
+    assert [record.id for record in kpi.records] == [1]
+    assert crm.logins == 2
+
+def test_patient_sources_are_fetched_concurrently_and_a_failure_stays_isolated(monkeypatch):
+    def get_kpi(token, kpi_name, country_id, config, refresh=False):
+        time.sleep(0.3)
+        if kpi_name == "exams":
+            raise RuntimeError("CRM caído")
+        return f"{kpi_name}-{country_id}"
+
+    monkeypatch.setattr(crm_api, "get_kpi", get_kpi)
+    start_time = time.perf_counter()
+    results = {result.state_key: result for result in crm_api.fetch_patient_data("token", "123", {"api_base_url": "http://crm.test/"})}
+    assert time.perf_counter() - start_time < 0.6  # Las tres consultas se solapan
+    assert results["kpi_data"].data == "medicalrecords-123"
+    assert results["lab_data"].data == "labresults-123"
+    assert results["exam_data"].data is None
+    assert results["exam_data"].messages == [("error", "Error inesperado: CRM caído")]
+    assert results["kpi_data"].messages == []
+
+class FlakyCrm(ThreadingHTTPServer):
+    """CRM local cuyos primeros GET responden 503; registra el puerto de cada conexión del cliente."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.requests = 0
+        self.client_ports = set()
+        crm = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Conexiones keep-alive
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                crm.requests += 1
+                crm.client_ports.add(self.client_address[1])
+                status, body = (503, b"{}") if crm.requests <= crm.failures else (200, b'{"data": {"kpis": {"Records": [{"ID": 1}]}}}')
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.daemon_threads = True
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+def test_kpi_get_retries_transient_errors_over_one_reused_session():
+    crm = FlakyCrm(failures=2)
+    config = {"api_base_url": f"http://127.0.0.1:{crm.server_address[1]}/", "display_name": "Prueba reintentos", "http_retry_backoff": 0}
+    try:
+        assert crm_api.get_http_session(config) is crm_api.get_http_session(dict(config))
+        for _ in range(3):
+            assert [record.id for record in crm_api._request_kpi("token", "medicalrecords", "1", config).records] == [1]
+        assert crm.requests == 5  # Dos 503 reintentados y tres respuestas correctas
+        assert len(crm.client_ports) == 1  # Todas por la misma conexión keep-alive
+    finally:
+        crm.shutdown()
+        crm.server_close()
+
+def test_kpi_response_cache_expires_by_ttl_and_evicts_least_recently_used():
+    cache = crm_api.KpiResponseCache(max_bytes=100)
+    cache.put(("url", "1", "exams"), "viejo", 10, stored_at=time.time() - 60)
+    assert cache.get(("url", "1", "exams"), ttl=30) is None
+    assert cache.stats() == (0, 0)  # La entrada vencida se descarta al consultarla
+
+    cache.put(("url", "1", "medicalrecords"), "a", 40)
+    cache.put(("url", "2", "medicalrecords"), "b", 40)
+    assert cache.get(("url", "1", "medicalrecords"), ttl=30) == ("a", 40)  # "a" pasa a ser la más reciente
+    cache.put(("url", "3", "medicalrecords"), "c", 40)
+    assert cache.get(("url", "2", "medicalrecords"), ttl=30) is None
+    assert cache.get(("url", "1", "medicalrecords"), ttl=30) == ("a", 40)
+    assert cache.stats() == (2, 80)
+    cache.put(("url", "4", "medicalrecords"), "grande", 101)  # Mayor que la caché entera: no se guarda
+    assert cache.stats() == (2, 80)
+
+def test_fetch_kpis_batches_country_ids_and_falls_back_to_single_requests(monkeypatch):
+    batches, singles = [], []
+
+    def request_kpi(token, kpi_name, country_ids, config):
+        batches.append((kpi_name, country_ids))
+        if kpi_name == "exams":
+            return None  # El lote falla: sus cédulas se consultan una por una
+        records = [{"ID": int(country_id), "Patient": {"CountryID": country_id}} for country_id in country_ids.split(",")]
+        return KpiRecordSet.from_response({"data": {"kpis": {"Records": records}}})
+
+    def get_kpi(token, kpi_name, country_id, config, refresh=False):
+        singles.append((kpi_name, country_id))
+        return f"{kpi_name}-{country_id}"
+
+    monkeypatch.setattr(crm_api, "_request_kpi", request_kpi)
+    monkeypatch.setattr(crm_api, "get_kpi", get_kpi)
+    monkeypatch.setattr(crm_api, "_cached_kpi", lambda config, country_id, kpi_name: None)
+    monkeypatch.setattr(crm_api, "_remember_kpi", lambda *args: None)
+    config = {"api_base_url": "http://crm.test/", "kpi_batch_country_ids": True, "kpi_batch_size": 2}
+    results, messages = call_collecting_messages(crm_api.fetch_kpis, "token", ["medicalrecords", "exams"], ["1", "2", "2", "3"], config)
+    assert batches == [("medicalrecords", "1,2"), ("medicalrecords", "3"), ("exams", "1,2"), ("exams", "3")]
+    assert {country_id: [record.id for record in results[(country_id, "medicalrecords")].records] for country_id in ("1", "2", "3")} == {"1": [1], "2": [2], "3": [3]}
+    assert sorted(singles) == [("exams", "1"), ("exams", "2"), ("exams", "3")]
+    assert results[("2", "exams")] == "exams-2"
+    assert len(messages) == 2 and all(level == "warning" for level, _ in messages)
@@ -0,0 +1,63 @@
+import json
+import time
+
+import pytest
+
+import kpi_records
+
+from kpi_records import KpiRecordSet, KpiResponseDecoder
+
+RESPONSE = {
+    "status": "success",
+    "data": {
+        "title": "Índice \"KPI\" [resumen]",
+        "kpis": {
+            "Total": 2,
+            "Records": [
+                {"ID": 1, "Date": "15/01/2024 09:30", "Reason": "Control {anual}, \"ñandú\" ]", "Patient": {"Name": "José Núñez"}},
+                {"ID": 2, "Date": "03/02/2024", "ExamResults": "<p>Glucosa &lt;100&gt; mg/dL</p>", "Patient": {"Name": "José Núñez"}, "Empty": ""},
+            ],
+            "Footer": {"next": None},
+        },
+    },
+}
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64])
+def test_decoder_matches_from_response_for_any_chunk_boundary(chunk_size):
+    body = json.dumps(RESPONSE, ensure_ascii=False).encode("utf-8")
+    decoder = KpiResponseDecoder()
+    for start in range(0, len(body), chunk_size):
+        decoder.feed(body[start:start + chunk_size])
+    assert decoder.close().to_response() == KpiRecordSet.from_response(json.loads(body)).to_response()
+
+def test_decoder_accepts_records_that_are_not_objects():
+    body = b'{"data": {"kpis": {"Records": [null, 5, "texto, con ] y \\"", {"ID": 1}, [2]]}}}'
+    decoder = KpiResponseDecoder()
+    for start in range(len(body)):
+        decoder.feed(body[start:start + 1])
+    assert decoder.close().to_response() == KpiRecordSet.from_response(json.loads(body)).to_response()
+
+def test_large_single_record_decodes_in_linear_time(monkeypatch):
+    # Un informe HTML de ~5 MB en bloques de 1 KB: re-decodificar el registro en cada bloque tardaría minutos.
+    # Se mide solo el decodificador (la conversión del HTML a texto es aparte y lineal).
+    monkeypatch.setattr(kpi_records, "compact_value", lambda value: value)
+    html = '<p>Hemoglobina: 10 g/dL &lt;normal 12-16&gt; "ok" \\ </p>' * 80_000
+    body = json.dumps({"data": {"kpis": {"Records": [{"ID": 1, "ExamResults": html}]}}}).encode("utf-8")
+    decoder = KpiResponseDecoder()
+    start_time = time.perf_counter()
+    for start in range(0, len(body), 1024):
+        decoder.feed(body[start:start + 1024])
+    record_set = decoder.close()
+    assert time.perf_counter() - start_time < 3
+    assert [record.to_dict()["ExamResults"] for record in record_set.records] == [html]
+
+def test_split_by_country_id_groups_a_batched_response_per_patient():
+    response = {"data": {"kpis": {"Records": [
+        {"ID": 1, "Patient": {"CountryID": "111"}},
+        {"ID": 2, "Patient": {"CountryID": " 222 "}},
+        {"ID": 3, "Patient": {"CountryID": 111}},
+    ]}}}
+    by_patient = KpiRecordSet.from_response(response).split_by_country_id(["111", "222", "333"])
+    assert {country_id: [record.id for record in record_set.records] for country_id, record_set in by_patient.items()} == {"111": [1, 3], "222": [2], "333": []}
+    # Un registro sin una de las cédulas pedidas impide repartir la respuesta
+    assert KpiRecordSet.from_response(response).split_by_country_id(["111"]) is None
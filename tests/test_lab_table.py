@@ -0,0 +1,25 @@
+from kpi_records import KpiRecordSet
+from lab_table import build_lab_results_table, pivot_lab_results
+
+def _lab_data(records):
+    return KpiRecordSet.from_response({"data": {"kpis": {"Records": records}}})
+
+def _hemoglobin(record_id, date, value):
+    return {"ID": record_id, "Date": date, "LabResults": [{"ExamType": {"Code": "H1", "Type": "HEMATOLOGIA"}, "Item": "HB", "Value": value}]}
+
+def test_dates_are_day_first():
+    table = build_lab_results_table(_lab_data([_hemoglobin(1, "03/04/2025 08:00", "12")]))
+    assert (table["Fecha"][0].day, table["Fecha"][0].month) == (3, 4)
+
+def test_exam_type_matches_filter_options():
+    lab_data = _lab_data([_hemoglobin(1, "2025-04-03 08:00:00", "12")])
+    assert set(build_lab_results_table(lab_data)["Tipo de Examen"]) == set(lab_data.by_exam_type) == {"HEMATOLOGIA"}
+
+def test_pivot_columns_include_time_only_for_same_day_results():
+    lab_data = _lab_data([
+        _hemoglobin(1, "03/04/2025 08:00", "12"),
+        _hemoglobin(2, "03/04/2025 15:30", "13"),
+        _hemoglobin(3, "01/05/2025 10:00", "14"),
+    ])
+    columns = list(pivot_lab_results(build_lab_results_table(lab_data)).columns)
+    assert columns[-3:] == ["03/04/2025 08:00", "03/04/2025 15:30", "01/05/2025"]
@@ -0,0 +1,33 @@
+import pytest
+
+from load_test import mark_ceiling, summarize
+
+def _level(sessions, throughput):
+    return {"sessions": sessions, "throughput": throughput}
+
+def test_ceiling_is_the_first_level_that_stops_scaling():
+    summaries = [_level(1, 1.0), _level(2, 1.9), _level(4, 2.05), _level(8, 1.5)]
+    assert mark_ceiling(summaries) is summaries[2]  # 2.05 < 1.9 * 1.1
+    assert [summary.get("ceiling", False) for summary in summaries] == [False, False, True, False]
+
+def test_no_ceiling_while_throughput_keeps_growing():
+    summaries = [_level(1, 1.0), _level(2, 2.0), _level(4, 3.9)]
+    assert mark_ceiling(summaries) is None
+    assert not any("ceiling" in summary for summary in summaries)
+    assert mark_ceiling([_level(1, 1.0)]) is None
+
+def test_summary_of_a_level():
+    def run(total_seconds, crm_wait, gemini_wait):
+        return {"total_seconds": total_seconds, "stages": [
+            {"stage": "kpi_data", "wait_seconds": crm_wait},
+            {"stage": "exam_data", "wait_seconds": None},
+            {"stage": "llm", "wait_seconds": gemini_wait},
+        ]}
+
+    summary = summarize(2, 4.0, [[run(1.0, 0.2, 0.0), run(3.0, 0.4, 1.0)], [run(2.0, 0.0, 0.5)]], ["operador-1: error"])
+    assert summary["patients"] == 3 and summary["errors"] == 1
+    assert summary["throughput"] == pytest.approx(0.75)
+    assert summary["latency_p50"] == 2.0 and summary["latency_max"] == 3.0
+    assert summary["crm_wait_mean"] == pytest.approx(0.1)
+    assert summary["gemini_wait_mean"] == pytest.approx(0.5)
+    assert summary["session_spread"] == pytest.approx(1.0)
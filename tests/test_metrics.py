@@ -0,0 +1,36 @@
+import json
+
+from metrics import MetricsRecorder, RequestMetrics
+
+def _request(cache):
+    request_metrics = RequestMetrics("app", "Prueba")
+    with request_metrics.stage("kpi_data", cache=cache) as stage:
+        stage["bytes"] = 1000
+        stage["records"] = 5
+    request_metrics.add("llm", 2.5, prompt_tokens=300, response_tokens=None)
+    return request_metrics
+
+def test_each_request_is_one_jsonl_line(tmp_path):
+    recorder = MetricsRecorder(str(tmp_path / "logs" / "metrics.jsonl"), "")
+    recorder.record(_request("miss"))
+    recorder.record(_request("hit"))
+    lines = [json.loads(line) for line in (tmp_path / "logs" / "metrics.jsonl").read_text(encoding="utf-8").splitlines()]
+    assert [entry["kind"] for entry in lines] == ["app", "app"]
+    assert [stage["stage"] for stage in lines[0]["stages"]] == ["kpi_data", "llm"]
+    assert lines[1]["stages"][0]["cache"] == "hit"
+    assert lines[0]["stages"][1] == {"stage": "llm", "seconds": 2.5, "prompt_tokens": 300, "response_tokens": None}
+
+def test_textfile_accumulates_counters_per_kind_stage_and_cache(tmp_path):
+    textfile = tmp_path / "sugos.prom"
+    recorder = MetricsRecorder("", str(textfile))
+    for cache in ("miss", "miss", "hit"):
+        recorder.record(_request(cache))
+    lines = textfile.read_text(encoding="utf-8").splitlines()
+    assert 'sugos_stage_runs_total{kind="app",stage="kpi_data",cache="miss"} 2' in lines
+    assert 'sugos_stage_runs_total{kind="app",stage="kpi_data",cache="hit"} 1' in lines
+    assert 'sugos_stage_bytes_total{kind="app",stage="kpi_data",cache="miss"} 2000' in lines
+    assert 'sugos_stage_prompt_tokens_total{kind="app",stage="llm",cache=""} 900' in lines
+    assert 'sugos_stage_seconds_total{kind="app",stage="llm",cache=""} 7.5' in lines
+    assert "# TYPE sugos_stage_bytes_total counter" in lines
+    # Los valores que faltan (None) no generan la métrica
+    assert not any(line.startswith("sugos_stage_response_tokens_total") for line in lines)
@@ -0,0 +1,24 @@
+import json
+
+import model_router
+from model_router import ModelLatencyStats
+
+def test_recent_timeout_excludes_model_and_old_one_does_not(tmp_path, monkeypatch):
+    stats = ModelLatencyStats(str(tmp_path / "latency.json"))
+    for tokens in (1000, 2000, 3000):
+        stats.record("modelo", tokens, tokens / 100)
+    stats.record("modelo", 1000, 180, timed_out=True)
+    assert stats.predict_seconds("modelo", 2000) == float("inf")
+
+    now = model_router.time.time()
+    monkeypatch.setattr(model_router.time, "time", lambda: now + model_router.LATENCY_TIMEOUT_WINDOW_SECONDS + 1)
+    assert stats.predict_seconds("modelo", 2000) == 20
+
+def test_loads_observations_without_timestamp_and_caps_history(tmp_path):
+    path = tmp_path / "latency.json"
+    path.write_text(json.dumps({"modelo": [[1000, 10, False], [2000, 20, False], [3000, 30, False], [500, 180, True]]}))
+    stats = ModelLatencyStats(str(path), history=4)
+    assert stats.predict_seconds("modelo", 2000) == 20
+    for _ in range(10):
+        stats.record("modelo", 1000, 10)
+    assert stats.summary()["modelo"]["calls"] == 4
@@ -0,0 +1,32 @@
+import pytest
+
+import crm_api
+from kpi_records import KpiRecordSet
+from patient_store import patient_store
+
+RESPONSE = {"data": {"kpis": {"Records": [{"ID": 1, "Date": "15/01/2024", "Reason": "Control"}]}}}
+CONFIG = {"api_base_url": "http://crm.test/", "kpi_cache_ttl": 60, "kpi_store_ttl": 600}
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(patient_store, "path", str(tmp_path / "patients.sqlite3"))
+    monkeypatch.setattr(crm_api, "kpi_response_cache", crm_api.KpiResponseCache(crm_api.KPI_CACHE_MAX_BYTES))
+    return patient_store
+
+def test_unchanged_response_only_renews_confirmation(store):
+    assert store.put_kpi("http://crm.test/", "1", "medicalrecords", KpiRecordSet.from_response(RESPONSE), 100)
+    assert not store.put_kpi("http://crm.test/", "1", "medicalrecords", KpiRecordSet.from_response(RESPONSE), 100)
+    data, response_bytes, _ = store.get_kpi("http://crm.test/", "1", "medicalrecords", 60)
+    assert data.to_response() == KpiRecordSet.from_response(RESPONSE).to_response() and response_bytes == 100
+
+def test_report_without_row_is_none(store):
+    assert store.get_report(("http://crm.test/", "1")) is None
+
+def test_store_hit_is_served_from_memory_until_the_original_confirmation_expires(store, monkeypatch):
+    store.put_kpi("http://crm.test/", "1", "medicalrecords", KpiRecordSet.from_response(RESPONSE), 100)
+    assert crm_api._cached_kpi(CONFIG, "1", "medicalrecords")[2] == "store"
+    assert crm_api._cached_kpi(CONFIG, "1", "medicalrecords")[2] == "cache"
+
+    now = crm_api.time.time()
+    monkeypatch.setattr(crm_api.time, "time", lambda: now + 61)
+    assert crm_api._cached_kpi(CONFIG, "1", "medicalrecords")[2] == "store"
@@ -0,0 +1,42 @@
+import threading
+
+import pytest
+
+import prefetch
+from crm_api import PATIENT_DATA_SOURCES, PatientDataResult
+from prefetch import PatientPrefetcher
+
+CONFIG = {"api_base_url": "http://crm.test/"}
+
+@pytest.fixture
+def release(monkeypatch):
+    """Las precargas terminan recién cuando se llama release.set()."""
+    event = threading.Event()
+
+    def fetch_patient_data(token, country_id, config, concurrent=True):
+        event.wait(5)
+        for state_key, *_ in PATIENT_DATA_SOURCES:
+            yield PatientDataResult(state_key, country_id, [], 0.1, "api", 0, 0.0, 0.0)
+
+    monkeypatch.setattr(prefetch, "get_api_token", lambda username, password, config: "token")
+    monkeypatch.setattr(prefetch, "fetch_patient_data", fetch_patient_data)
+    return event
+
+def test_sessions_sharing_credentials_keep_their_own_prefetches(release):
+    prefetcher = PatientPrefetcher(4)
+    assert prefetcher.start("api", "clave", "11111", CONFIG, session="sesion-a")
+    assert prefetcher.start("api", "clave", "22222", CONFIG, session="sesion-b")
+    release.set()
+    assert prefetcher.take("api", "11111", CONFIG, timeout=5, session="sesion-b") is None
+    assert [result.data for result in prefetcher.take("api", "11111", CONFIG, timeout=5, session="sesion-a")] == ["11111"] * 3
+    assert [result.data for result in prefetcher.take("api", "22222", CONFIG, timeout=5, session="sesion-b")] == ["22222"] * 3
+
+def test_limit_and_cancel_apply_per_session(release):
+    prefetcher = PatientPrefetcher(4, max_per_session=1)
+    assert prefetcher.start("api", "clave", "11111", CONFIG, session="sesion-a")
+    # La precarga cancelada sigue en curso: la sesión ya está en su límite
+    assert not prefetcher.start("api", "clave", "22222", CONFIG, session="sesion-a")
+    assert prefetcher.start("api", "clave", "22222", CONFIG, session="sesion-b")
+    prefetcher.cancel(session="sesion-a")
+    release.set()
+    assert prefetcher.take("api", "22222", CONFIG, timeout=5, session="sesion-b") is not None
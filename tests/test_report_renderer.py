@@ -0,0 +1,55 @@
+import time
+
+from report_renderer import StreamingReportRenderer
+
+class Placeholder:
+    def __init__(self):
+        self.renders = []
+
+    def markdown(self, text):
+        self.renders.append(text)
+
+class Container:
+    def __init__(self):
+        self.placeholders = []
+
+    def empty(self):
+        self.placeholders.append(Placeholder())
+        return self.placeholders[-1]
+
+    def markdown(self, text):
+        self.empty().markdown(text)
+
+def test_complete_sections_are_written_once_and_only_the_current_one_is_redrawn():
+    container = Container()
+    renderer = StreamingReportRenderer(container, time.time(), min_interval=3600)
+    for chunk in ["**A. IDENTIFICACIÓN**\nPaciente", " de 40 años\n", "**B. ANTECEDENTES**\nHTA", "\n**C. CONSULTAS**\n", "Control"]:
+        renderer.add(chunk)
+    renderer.finish()
+    assert [placeholder.renders for placeholder in container.placeholders] == [
+        ["**A. IDENTIFICACIÓN**\nPaciente", "**A. IDENTIFICACIÓN**\nPaciente de 40 años\n"],
+        ["**B. ANTECEDENTES**\nHTA\n"],
+        ["**C. CONSULTAS**\nControl"],
+    ]
+    assert renderer.first_token_seconds is not None and renderer.first_content_seconds is not None
+
+def test_attach_redraws_what_was_received_for_the_next_fragment_run():
+    renderer = StreamingReportRenderer(Container(), time.time(), min_interval=0)
+    renderer.add("**A. IDENTIFICACIÓN**\nPaciente\n**B. ANTECEDENTES**\nHTA")
+    first_token_seconds = renderer.first_token_seconds
+    container = Container()
+    renderer.attach(container)
+    renderer.add(" controlada")
+    assert [placeholder.renders for placeholder in container.placeholders] == [
+        ["**A. IDENTIFICACIÓN**\nPaciente\n"],
+        ["**B. ANTECEDENTES**\nHTA controlada"],
+    ]
+    assert renderer.first_token_seconds == first_token_seconds
+
+def test_parallel_sections_fill_their_own_slot_in_any_order():
+    container = Container()
+    renderer = StreamingReportRenderer(container, time.time())
+    renderer.add_section(2, 3, "**C. CONSULTAS**")
+    renderer.add_section(0, 3, "**A. IDENTIFICACIÓN**")
+    renderer.add_section(2, 3, "**C. CONSULTAS**")  # Repetida entre ejecuciones del fragmento: no se redibuja
+    assert [placeholder.renders for placeholder in container.placeholders] == [["**A. IDENTIFICACIÓN**"], [], ["**C. CONSULTAS**"]]
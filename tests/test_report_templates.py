@@ -0,0 +1,35 @@
+import pytest
+
+from report_templates import ReportMerger, merge_report, strip_sections
+
+SECTIONS = {"A": "### A. IDENTIFICACIÓN\n\nNombre: José", "C": "### C. ORGANIZACIÓN\n\nConsulta 1"}
+GENERATED = (
+    "Informe clínico\n"
+    "### B. ANTECEDENTES PERSONALES Y FAMILIARES RELEVANTES DEL PACIENTE\n"
+    "Infección urinaria previa.\n"
+    "E. Coli aislada en el urocultivo.\n"
+    "**D. GENERACIÓN DE DIAGNÓSTICOS**\n"
+    "Cistitis.\n"
+    "### E. RESULTADOS\n"
+    "Sin hallazgos."
+)
+
+def _streamed(rendered_sections, text, chunk_size):
+    merger = ReportMerger(rendered_sections)
+    parts = [merger.feed(text[start:start + chunk_size]) for start in range(0, len(text), chunk_size)]
+    return "".join(parts) + merger.close()
+
+@pytest.mark.parametrize("text", [GENERATED, "### B. ANTECEDENTES\nNada.", "Sin títulos", ""])
+def test_streamed_merge_matches_merge_report_for_any_chunk_size(text):
+    expected = merge_report(SECTIONS, text)
+    for chunk_size in range(1, len(text) + 2):
+        assert _streamed(SECTIONS, text, chunk_size).strip() == expected
+        assert _streamed(SECTIONS, text, chunk_size) == _streamed(SECTIONS, text, len(text) + 1)
+
+def test_sections_are_inserted_before_the_next_heading_only():
+    report = merge_report(SECTIONS, GENERATED)
+    assert report.index("### A.") < report.index("### B.") < report.index("E. Coli") < report.index("### C.") < report.index("**D.")
+
+def test_line_starting_with_a_letter_and_a_lowercase_word_is_not_a_heading():
+    report = "### C. ORGANIZACIÓN\nE. Coli aislada.\n### D. GENERACIÓN\nCistitis."
+    assert strip_sections(report, {"C"}) == "### D. GENERACIÓN\nCistitis."
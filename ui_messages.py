@@ -0,0 +1,48 @@
+"""Mensajes de UI (error, warning...) que funcionan desde hilos de trabajo y sin Streamlit."""
+import threading
+
+# Los mensajes emitidos desde hilos de trabajo no tienen contexto de Streamlit,
+# así que se acumulan por hilo y se muestran luego desde el hilo principal.
+_message_sink = threading.local()
+
+def show_message(level, text):
+    """Muestra un mensaje en la UI o lo acumula si el hilo actual tiene un colector activo."""
+    buffer = getattr(_message_sink, "buffer", None)
+    if buffer is not None:
+        buffer.append((level, text))
+    else:
+        render_message(level, text)
+
+def render_message(level, text):
+    """Renderiza un mensaje (error, warning, code...) en la página."""
+    import streamlit as st # Import diferido: el modo batch no necesita Streamlit
+    if level == "code":
+        st.code(text, language='text')
+    else:
+        getattr(st, level)(text)
+
+def bind_messages(func):
+    """func ejecutada con el colector de mensajes del hilo actual, para pasarlo a hilos de trabajo."""
+    buffer = getattr(_message_sink, "buffer", None)
+
+    def bound(*args, **kwargs):
+        previous = getattr(_message_sink, "buffer", None)
+        _message_sink.buffer = buffer
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _message_sink.buffer = previous
+    return bound
+
+def call_collecting_messages(func, *args, **kwargs):
+    """Ejecuta func acumulando sus mensajes de UI. Devuelve (resultado, mensajes)."""
+    _message_sink.buffer = []
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        _message_sink.buffer.append(("error", f"Error inesperado: {e}"))
+        result = None
+    finally:
+        messages = _message_sink.buffer
+        _message_sink.buffer = None
+    return result, messages